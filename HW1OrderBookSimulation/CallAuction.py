@@ -3,53 +3,205 @@ Exercise 1. Call Auction. With the Excel spreadsheet distributed in class, showi
 • Read from a file the buy and sell orders. Fields within the file should consist of the price, side, quantity.
 • Determine the opening price, i.e. the price that matches all buy and sell pre-orders.
 • Determine the initial opening order book after the call auction.
+Large pre-open files (CSV or Parquet with price, side and quantity columns) are read in chunks and aggregated per
+price level as they stream in, so memory grows with the number of distinct prices rather than orders.
+Usage: python CallAuction.py [file.xlsx [sheet_name] | file.csv | file.parquet]
 '''
+import os
+import sys
+
+import numpy as np
 import pandas as pd
-Order = pd.read_excel('CallAuction.xlsx',sheet_name='Sheet2')
-records=Order.values.tolist()
-records.sort(key=(lambda x: x[0]), reverse=True)  # Sort by Price
-
-def listcreation():
-    buylist = {}
-    lastbuy = 0
-    for price, amount,side in records:
-        if (side == "Buy"):
-            lastbuy += amount
-        buylist[price] = lastbuy
-
-    selllist = {}
-    lastsell = 0
-    for price, amount,side in records[::-1]:
-        if (side == "Sell"):
-            lastsell += amount
-        selllist[price] = lastsell
-    return buylist,selllist
-
-def pricerender(buylist,selllist):
-    prices=list(buylist)
-    max_amount=0
-    best_price = 0
-    for price in prices:
-        if(min(buylist[price],selllist[price])>max_amount):
-            best_price=price
-            max_amount=min(buylist[price],selllist[price])
-    orderbook=[]
-    print('The Best Price for Call Auction is',best_price,'\nThe Amount Traded Under that Price is',max_amount)
-    #Buylist and Selllist quant are different
-    #Get First Item
-    if buylist[best_price]==max_amount:
-        orderbook.append([best_price,selllist[best_price]-max_amount,'Sell'])
+
+
+def read_orders(path='CallAuction.xlsx', sheet_name='Sheet2'):
+    """ Price, side and quantity columns of a spreadsheet of pre-open orders, as arrays for uncross """
+    orders = pd.read_excel(path, sheet_name=sheet_name)
+    return orders['Price'].to_numpy(dtype=np.float64), orders['Side'].to_numpy(), orders['Quantity'].to_numpy()
+
+
+def read_chunks(path, chunksize=1000000, columns=('price', 'side', 'quantity')):
+    """
+    (prices, sides, qtys) arrays of successive chunks of a CSV (optionally compressed) or Parquet file of orders.
+    Column names are matched case-insensitively. Parquet needs pyarrow.
+    """
+    if path.endswith(('.parquet', '.pq')):
+        import pyarrow.parquet as pq
+        parquet = pq.ParquetFile(path)
+        names = {name.lower(): name for name in parquet.schema_arrow.names}
+        selected = [names[column] for column in columns]
+        for batch in parquet.iter_batches(batch_size=chunksize, columns=selected):
+            yield tuple(batch.column(i).to_numpy(zero_copy_only=False) for i in range(len(selected)))
+    else:
+        for chunk in pd.read_csv(path, chunksize=chunksize, usecols=lambda name: name.lower() in columns):
+            chunk.columns = [name.lower() for name in chunk.columns]
+            yield tuple(chunk[column].to_numpy() for column in columns)
+
+
+def sell_flags(sides):
+    """ True for sell orders; sides are Side values (BUY=0/SELL=1) or 'Buy'/'Sell' strings """
+    sides = np.asarray(sides)
+    if sides.dtype.kind in 'USO':
+        return np.char.lower(sides.astype(str)) == 'sell'
+    return sides != 0
+
+
+def aggregate(prices, sides, qtys):
+    """
+    Distinct limit prices in ascending order with the total buy and sell quantity at each, and the total market buy
+    and sell quantity (orders with a NaN price). When the prices lie on an evenly spaced grid, which is the usual
+    case, orders are bucketed by grid position in one pass; otherwise each order's level is found by binary search.
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    qtys = np.asarray(qtys)
+    is_sell = sell_flags(sides)
+    is_market = np.isnan(prices)
+    market_buy = qtys[is_market & ~is_sell].sum()
+    market_sell = qtys[is_market & is_sell].sum()
+    if is_market.any():
+        prices, qtys, is_sell = prices[~is_market], qtys[~is_market], is_sell[~is_market]
+    levels = np.unique(prices)
+    if len(levels) == 0:
+        return levels, np.zeros(0, dtype=qtys.dtype), np.zeros(0, dtype=qtys.dtype), market_buy, market_sell
+    slots = None
+    if len(levels) > 1:
+        tick = np.diff(levels).min()
+        span = int(round((levels[-1] - levels[0]) / tick)) + 1
+        grid = levels[0] + np.rint((levels - levels[0]) / tick) * tick
+        if span <= 4 * len(prices) + 1024 and np.allclose(grid, levels, rtol=0, atol=1e-9 * tick):
+            slots = np.rint((prices - levels[0]) / tick).astype(np.int64)
+            present = np.zeros(span, dtype=bool)
+            present[slots] = True
+    if slots is None:
+        span = len(levels)
+        slots = np.searchsorted(levels, prices)
+        present = None
+    # one bincount for both sides: bucket 2 * slot for buys, 2 * slot + 1 for sells
+    slots *= 2
+    slots += is_sell
+    totals = np.bincount(slots, weights=qtys, minlength=2 * span).reshape(span, 2)
+    if present is not None:
+        totals = totals[present]
+    if qtys.dtype.kind in 'iu':
+        totals = np.rint(totals).astype(np.int64)
+    return levels, totals[:, 0], totals[:, 1], market_buy, market_sell
+
+
+def merge_levels(first, second):
+    """ Sum of two aggregate() results """
+    levels, slots = np.unique(np.concatenate([first[0], second[0]]), return_inverse=True)
+    totals = []
+    for side in (1, 2):
+        values = np.concatenate([first[side], second[side]])
+        total = np.zeros(len(levels), dtype=values.dtype)
+        np.add.at(total, slots, values)
+        totals.append(total)
+    return levels, totals[0], totals[1], first[3] + second[3], first[4] + second[4]
+
+
+def aggregate_file(path, chunksize=1000000):
+    """ aggregate() over a CSV or Parquet file of orders, read chunk by chunk """
+    aggregated = None
+    for prices, sides, qtys in read_chunks(path, chunksize):
+        chunk = aggregate(prices, sides, qtys)
+        aggregated = chunk if aggregated is None else merge_levels(aggregated, chunk)
+    if aggregated is None:
+        return aggregate([], [], [])
+    return aggregated
+
+
+def uncross(prices, sides, qtys, reference_price=None):
+    """
+    Opening price of a call auction over pre-open orders given as arrays of limit price (NaN for a market order),
+    side (Side values BUY=0/SELL=1, or 'Buy'/'Sell') and quantity. See uncross_levels.
+    """
+    return uncross_levels(*aggregate(prices, sides, qtys), reference_price=reference_price)
+
+
+def uncross_file(path, reference_price=None, chunksize=1000000, book=None):
+    """
+    uncross over a CSV or Parquet file streamed chunksize orders at a time. If book (an OrderBook or TickOrderBook)
+    is given, it is seeded with the residual book.
+    """
+    result = uncross_levels(*aggregate_file(path, chunksize), reference_price=reference_price)
+    if book is not None:
+        seed_book(book, *result[2:])
+    return result
+
+
+def seed_book(book, residual_prices, residual_sides, residual_qtys):
+    """
+    Rest the residual book of an auction in book, one limit order per price level, through process_orders.
+    Unfilled market orders are dropped. The residual book does not cross, so no trades are produced.
+    """
+    limit = ~np.isnan(residual_prices)
+    book.process_orders(residual_sides[limit], residual_prices[limit], residual_qtys[limit])
+    return book
+
+
+def uncross_levels(levels, buy, sell, market_buy, market_sell, reference_price=None):
+    """
+    Uncross aggregated levels as returned by aggregate: ascending limit prices with the buy and sell quantity at
+    each, and the total market buy and sell quantity.
+    Demand and supply at every distinct limit price come from cumulative sums over the aggregated levels. The
+    clearing price maximises the executed volume; ties are broken by the smallest imbalance, then by market pressure
+    (highest price if every remaining candidate has surplus demand, lowest if every one has surplus supply), then by
+    the price closest to reference_price, and finally by the highest price.
+    Returns (price, volume, residual_prices, residual_sides, residual_qtys): the clearing price (NaN if nothing
+    trades), the executed volume and the book left after the auction, one row per price level with sells first and
+    prices descending, and unfilled market orders last with a NaN price. Executions follow price priority, with
+    market orders ahead of limit orders.
+    """
+    demand = buy[::-1].cumsum()[::-1] + market_buy
+    supply = sell.cumsum() + market_sell
+    volume = np.minimum(demand, supply)
+    if len(levels) == 0 or volume.max() <= 0:
+        price, executed = np.nan, 0
+        candidates = np.zeros(0, dtype=np.int64)
     else:
-        orderbook.append([best_price, buylist[best_price] - max_amount, 'Buy'])
+        executed = volume.max()
+        candidates = np.flatnonzero(volume == executed)
+        imbalance = demand[candidates] - supply[candidates]
+        smallest = np.abs(imbalance) == np.abs(imbalance).min()
+        candidates, imbalance = candidates[smallest], imbalance[smallest]
+        if len(candidates) > 1 and (imbalance > 0).all():
+            candidates = candidates[-1:]
+        elif len(candidates) > 1 and (imbalance < 0).all():
+            candidates = candidates[:1]
+        elif len(candidates) > 1 and reference_price is not None:
+            distance = np.abs(levels[candidates] - reference_price)
+            candidates = candidates[distance == distance.min()]
+        price = levels[candidates[-1]]
+
+    # fill each side in priority order: market orders, then limit levels from the most aggressive price
+    executed_limit_buy = max(executed - market_buy, 0)
+    executed_limit_sell = max(executed - market_sell, 0)
+    buy_ahead = demand - market_buy - buy
+    sell_ahead = supply - market_sell - sell
+    buy_left = buy - np.clip(executed_limit_buy - buy_ahead, 0, buy)
+    sell_left = sell - np.clip(executed_limit_sell - sell_ahead, 0, sell)
 
-    for price, amount,side in records:
-        if side =='Buy' and price < best_price:
-            orderbook.append([price, amount,side])
-        elif side =='Sell' and price > best_price:
-            orderbook.append([price, amount, side])
-    orderbook.sort(key=(lambda x: x[0]), reverse=True)
-    print('After Auction, the unexcused orderbook \n',pd.DataFrame(orderbook,columns=('Price','Quantity','Side')))
+    sell_levels = np.flatnonzero(sell_left > 0)[::-1]
+    buy_levels = np.flatnonzero(buy_left > 0)[::-1]
+    market_left = [(0, max(market_buy - executed, 0)), (1, max(market_sell - executed, 0))]
+    market_left = [(side, qty) for side, qty in market_left if qty > 0]
+    residual_prices = np.concatenate([levels[sell_levels], levels[buy_levels], np.full(len(market_left), np.nan)])
+    residual_sides = np.concatenate([np.ones(len(sell_levels), dtype=np.int8), np.zeros(len(buy_levels), dtype=np.int8),
+                                     np.array([side for side, qty in market_left], dtype=np.int8)])
+    residual_qtys = np.concatenate([sell_left[sell_levels], buy_left[buy_levels],
+                                    np.array([qty for side, qty in market_left], dtype=buy.dtype)])
+    return price, executed, residual_prices, residual_sides, residual_qtys
 
 
-buylist,selllist  = listcreation()
-pricerender(buylist,selllist)
\ No newline at end of file
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'CallAuction.xlsx'
+    if os.path.splitext(path)[1].lower() in ('.xlsx', '.xls'):
+        sheet_name = sys.argv[2] if len(sys.argv) > 2 else 'Sheet2'
+        result = uncross(*read_orders(path, sheet_name))
+    else:
+        result = uncross_file(path)
+    best_price, max_amount, residual_prices, residual_sides, residual_qtys = result
+    print('The Best Price for Call Auction is', best_price, '\nThe Amount Traded Under that Price is', max_amount)
+    orderbook = pd.DataFrame({'Price': residual_prices, 'Quantity': residual_qtys,
+                              'Side': np.where(residual_sides == 0, 'Buy', 'Sell')})
+    print('After Auction, the unexcused orderbook \n', orderbook)
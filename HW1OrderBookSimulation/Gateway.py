@@ -0,0 +1,176 @@
+'''
+Asyncio order gateway in front of OrderBook. Clients connect over TCP or a Unix socket and speak a line protocol:
+    NEW <ref> <BUY|SELL> LIMIT <size> <price>      ->  ACK <ref> <order_id>   or   REJ <ref> <reason>
+    NEW <ref> <BUY|SELL> MARKET <size>
+    CANCEL <ref> <order_id>                        ->  ACK <ref> <order_id>   or   REJ <ref> <reason>
+    AMEND <ref> <order_id> <new_size>
+and receive  FILL <order_id> <BUY|SELL> <price> <size>  for every execution of their orders, incoming or resting.
+Messages from all connections go through one bounded queue to a single matching task, which takes them in
+micro-batches. When the queue is full the readers stop reading their sockets, so backpressure reaches the clients.
+Usage: python Gateway.py [port | unix socket path]
+'''
+
+import asyncio
+import sys
+
+from OrderBook import OrderBook, LimitOrder, MarketOrder, Side, TradeBuffer
+
+
+class Session(object):
+    """ Output side of one client connection """
+    def __init__(self, writer):
+        self.writer = writer
+        self.closed = False
+
+    def send(self, line):
+        if not self.closed and not self.writer.is_closing():
+            self.writer.write(line.encode() + b'\n')
+
+    async def drain(self):
+        if not self.closed and not self.writer.is_closing():
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                self.closed = True
+
+
+class Gateway(object):
+    """
+    Owns the book and the matching task. max_queue bounds the messages waiting to be matched, max_batch the
+    messages matched between two rounds of socket writes.
+    """
+    def __init__(self, book=None, max_queue=10000, max_batch=1000):
+        self.book = book if book is not None else OrderBook()
+        self.book.aggregate_fills = False
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.queue = None
+        self.owners = {}
+        self.touched_order_ids = set()
+        self.sessions = {}
+        self.server = None
+        self.matcher = None
+
+    async def start(self, host='127.0.0.1', port=8765, path=None):
+        self.queue = asyncio.Queue(self.max_queue)
+        self.matcher = asyncio.ensure_future(self.matching_loop())
+        if path is None:
+            self.server = await asyncio.start_server(self.handle_client, host, port)
+        else:
+            self.server = await asyncio.start_unix_server(self.handle_client, path)
+        return self.server
+
+    async def stop(self):
+        self.server.close()
+        for session in self.sessions:
+            session.closed = True
+            session.writer.close()
+        await asyncio.gather(*self.sessions.values(), return_exceptions=True)
+        await self.server.wait_closed()
+        self.matcher.cancel()
+
+    async def handle_client(self, reader, writer):
+        session = Session(writer)
+        self.sessions[session] = asyncio.current_task()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await self.queue.put((session, line.decode()))
+        except ConnectionError:
+            pass
+        finally:
+            session.closed = True
+            self.sessions.pop(session, None)
+            writer.close()
+
+    async def matching_loop(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            sessions = self.process_batch(batch)
+            await asyncio.gather(*(session.drain() for session in sessions))
+
+    def process_batch(self, batch):
+        """ Match a micro-batch, acknowledge every message and publish the fills; returns the sessions written to """
+        book = self.book
+        buffer = TradeBuffer(book.price_typecode)
+        book.trade_buffer = buffer
+        sessions = set()
+        try:
+            for session, line in batch:
+                session.send(self.handle_message(session, line))
+                sessions.add(session)
+        finally:
+            book.trade_buffer = None
+        trades = buffer.to_array(book.trade_price_scale())
+        filled = set()
+        for side, price, size, incoming_order_id, book_order_id in trades.tolist():
+            for order_id, order_side in ((incoming_order_id, side), (book_order_id, 1 - side)):
+                session = self.owners.get(order_id)
+                if session is not None:
+                    session.send('FILL {0} {1} {2} {3}'.format(order_id, Side(order_side).name, price, size))
+                    sessions.add(session)
+                    filled.add(order_id)
+        # forget the orders that are done, once all of their fills in the batch have been sent
+        for order_id in filled | self.touched_order_ids:
+            if order_id not in book.orders:
+                self.owners.pop(order_id, None)
+        self.touched_order_ids = set()
+        return sessions
+
+    def handle_message(self, session, line):
+        fields = line.split()
+        ref = fields[1] if len(fields) > 1 else '-'
+        try:
+            command = fields[0].upper()
+            if command == 'NEW':
+                side = Side[fields[2].upper()]
+                size = int(fields[4])
+                if size <= 0:
+                    return 'REJ {0} size must be positive'.format(ref)
+                if fields[3].upper() == 'LIMIT':
+                    order = LimitOrder(side, float(fields[5]), size)
+                elif fields[3].upper() == 'MARKET':
+                    order = MarketOrder(side, size)
+                else:
+                    return 'REJ {0} unknown order type {1}'.format(ref, fields[3])
+                self.book.process_order(order)
+                self.owners[order.order_id] = session
+                self.touched_order_ids.add(order.order_id)
+                return 'ACK {0} {1}'.format(ref, order.order_id)
+            if command in ('CANCEL', 'AMEND'):
+                order_id = int(fields[2])
+                if self.owners.get(order_id) is not session:
+                    return 'REJ {0} unknown order {1}'.format(ref, order_id)
+                if command == 'CANCEL':
+                    order = self.book.cancel_order(order_id)
+                else:
+                    order = self.book.amend_order(order_id, int(fields[3]))
+                if order is None:
+                    return 'REJ {0} order {1} is no longer in the book'.format(ref, order_id)
+                self.touched_order_ids.add(order_id)
+                return 'ACK {0} {1}'.format(ref, order_id)
+            return 'REJ {0} unknown command {1}'.format(ref, fields[0])
+        except (IndexError, KeyError, ValueError) as e:
+            return 'REJ {0} malformed message: {1}'.format(ref, e)
+
+
+async def serve(port_or_path):
+    gateway = Gateway()
+    if port_or_path.isdigit():
+        server = await gateway.start(port=int(port_or_path))
+    else:
+        server = await gateway.start(path=port_or_path)
+    print('Gateway listening on {0}'.format(port_or_path))
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    asyncio.run(serve(sys.argv[1] if len(sys.argv) > 1 else '8765'))
@@ -0,0 +1,290 @@
+'''
+Indicative auction price during the pre-open. IncrementalAuction keeps the buy and sell quantity of every price tick
+in Fenwick trees, so that after each new order or cancel the uncross price, matched volume and imbalance of
+CallAuction.uncross are found again in O(log P) for P ticks instead of from the whole order file.
+Demand D(p) (buys at p or above) falls and supply S(p) (sells at p or below) rises with p, so the matched volume
+min(D, S) peaks where D - S changes sign. That crossing is found by a binary descent of one Fenwick tree, and only the
+populated ticks on either side of it can be the auction price.
+Usage: python IncrementalAuction.py [number_of_orders]   benchmarks against re-running CallAuction.uncross
+'''
+
+import math
+import random
+import sys
+import time
+
+import numpy as np
+
+from CallAuction import uncross
+
+
+class FenwickTree(object):
+    """ Prefix sums over n slots with O(log n) point updates, prefix sums and prefix-bound search """
+    def __init__(self, n):
+        self.n = n
+        self.tree = [0] * (n + 1)
+        self.top_bit = 1 << (n.bit_length() - 1) if n else 0
+        self.total = 0
+
+    def add(self, i, delta):
+        self.total += delta
+        i += 1
+        tree, n = self.tree, self.n
+        while i <= n:
+            tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        """ Sum of slots 0..i; 0 for i < 0 """
+        i = min(i, self.n - 1) + 1
+        tree = self.tree
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def search(self, bound):
+        """ Largest k such that slots 0..k-1 sum to at most bound; slot values must be non-negative """
+        tree, n = self.tree, self.n
+        position = 0
+        step = self.top_bit
+        while step:
+            if position + step <= n and tree[position + step] <= bound:
+                position += step
+                bound -= tree[position]
+            step >>= 1
+        return position
+
+    def previous(self, i):
+        """ Last non-zero slot at or before i, or None, for a tree of counts """
+        count = self.prefix(i)
+        return self.search(count - 1) if count else None
+
+    def next(self, i):
+        """ First non-zero slot at or after i, or None, for a tree of counts """
+        count = self.prefix(i - 1)
+        return self.search(count) if count < self.total else None
+
+
+class IncrementalAuction(object):
+    """
+    Pre-open order collection on the price grid low, low + tick_size, ..., high.
+    add_order() and cancel_order() update price (NaN while nothing would trade), volume and imbalance (demand minus
+    supply at price) with the same tie-breaking rules as CallAuction.uncross, and publish them to the callbacks in
+    subscribers as callback(price, volume, imbalance). Orders with price None are market orders.
+    """
+    def __init__(self, tick_size, low, high, reference_price=None):
+        self.tick_size = tick_size
+        self.low = low
+        self.number_of_ticks = int(round((high - low) / tick_size)) + 1
+        self.reference_price = reference_price
+        self.buy_sizes = [0] * self.number_of_ticks
+        self.sell_sizes = [0] * self.number_of_ticks
+        self.buys = FenwickTree(self.number_of_ticks)
+        self.sells = FenwickTree(self.number_of_ticks)
+        # slot i holds the buys at tick i - 1 plus the sells at tick i, so its prefix sum up to p is what
+        # D(p) >= S(p) compares against the total buy quantity
+        self.crossing = FenwickTree(self.number_of_ticks + 1)
+        # one count per tick with buys, with sells, with either
+        self.buy_levels = FenwickTree(self.number_of_ticks)
+        self.sell_levels = FenwickTree(self.number_of_ticks)
+        self.levels = FenwickTree(self.number_of_ticks)
+        self.market_buy = 0
+        self.market_sell = 0
+        self.orders = {}
+        self.order_id = 0
+        self.subscribers = []
+        self.price = np.nan
+        self.volume = 0
+        self.imbalance = 0
+
+    def to_tick(self, price):
+        tick = int(round((price - self.low) / self.tick_size))
+        if not 0 <= tick < self.number_of_ticks or abs(self.low + tick * self.tick_size - price) > 1e-9 * self.tick_size:
+            raise ValueError('Price {0} is not on the auction price grid'.format(price))
+        return tick
+
+    def to_price(self, tick):
+        return round(self.low + tick * self.tick_size, 10)
+
+    def add_order(self, side, price, size):
+        """ Add a pre-open order (side BUY=0/SELL=1, price None for a market order); returns its order id """
+        if size <= 0:
+            raise ValueError('Order size must be positive')
+        tick = None if price is None else self.to_tick(price)
+        self.order_id += 1
+        self.orders[self.order_id] = (side, tick, size)
+        self.change(side, tick, size)
+        return self.order_id
+
+    def cancel_order(self, order_id):
+        """ Remove a pre-open order; returns (side, price, size), or None if the order is unknown """
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return None
+        side, tick, size = order
+        self.change(side, tick, -size)
+        return side, None if tick is None else self.to_price(tick), size
+
+    def change(self, side, tick, delta):
+        if tick is None:
+            if side == 0:
+                self.market_buy += delta
+            else:
+                self.market_sell += delta
+        else:
+            was_populated = self.buy_sizes[tick] + self.sell_sizes[tick] > 0
+            if side == 0:
+                sizes, levels = self.buy_sizes, self.buy_levels
+                self.buys.add(tick, delta)
+                self.crossing.add(tick + 1, delta)
+            else:
+                sizes, levels = self.sell_sizes, self.sell_levels
+                self.sells.add(tick, delta)
+                self.crossing.add(tick, delta)
+            had_orders = sizes[tick] > 0
+            sizes[tick] += delta
+            if had_orders != (sizes[tick] > 0):
+                levels.add(tick, -1 if had_orders else 1)
+            if was_populated != (self.buy_sizes[tick] + self.sell_sizes[tick] > 0):
+                self.levels.add(tick, -1 if was_populated else 1)
+        self.update()
+
+    def demand(self, tick):
+        return self.buys.total + self.market_buy - self.buys.prefix(tick - 1)
+
+    def supply(self, tick):
+        return self.sells.prefix(tick) + self.market_sell
+
+    def update(self):
+        """
+        Re-derive price, volume and imbalance. Volume min(D, S) is S up to the last tick where D >= S and D after it,
+        so the best ticks are the populated ones nearest the crossing on either side. Every tick from first to last
+        around such a tick has the same demand and supply, which is where the tie-breaking rules look.
+        """
+        bound = self.buys.total + self.market_buy - self.market_sell
+        # last tick where demand still covers supply, -1 if there is none
+        crossing = min(self.crossing.search(bound), self.number_of_ticks) - 1 if bound >= 0 else -1
+        groups = []
+        below = self.levels.previous(crossing) if crossing >= 0 else None
+        if below is not None:
+            # no buys in [first, below) and no sells in (first, below]
+            previous_buy = self.buy_levels.previous(below - 1)
+            previous_sell = self.sell_levels.previous(below)
+            first = max(0 if previous_buy is None else previous_buy + 1, 0 if previous_sell is None else previous_sell)
+            groups.append((below, first, below))
+        above = self.levels.next(crossing + 1)
+        if above is not None:
+            # no buys in [above, last) and no sells in (above, last]
+            next_buy = self.buy_levels.next(above)
+            next_sell = self.sell_levels.next(above + 1)
+            last = min(self.number_of_ticks - 1 if next_buy is None else next_buy,
+                       self.number_of_ticks - 1 if next_sell is None else next_sell - 1)
+            groups.append((above, above, last))
+        best, tied = None, []
+        for tick, first, last in groups:
+            demand, supply = self.demand(tick), self.supply(tick)
+            key = (min(demand, supply), -abs(demand - supply))
+            if best is None or key > best:
+                best, tied = key, [(demand - supply, first, last)]
+            elif key == best:
+                tied.append((demand - supply, first, last))
+        if best is None or best[0] <= 0:
+            self.price, self.volume, self.imbalance = np.nan, 0, 0
+        else:
+            if len(tied) == 1 and tied[0][0] != 0:
+                # market pressure: highest price on surplus demand, lowest on surplus supply
+                imbalance, first, last = tied[0]
+                tick = self.levels.previous(last) if imbalance > 0 else self.levels.next(first)
+            else:
+                # balanced, or a surplus of one side just below the crossing and of the other just above it
+                if self.reference_price is None:
+                    tick = max(self.levels.previous(last) for imbalance, first, last in tied)
+                else:
+                    # closest to the reference price, then the highest
+                    ticks = [tick for imbalance, first, last in tied for tick in self.nearest(first, last)]
+                    tick = min(ticks, key=lambda t: (abs(self.to_price(t) - self.reference_price), -t))
+            self.price = self.to_price(tick)
+            self.volume = best[0]
+            self.imbalance = self.demand(tick) - self.supply(tick)
+        for callback in self.subscribers:
+            callback(self.price, self.volume, self.imbalance)
+
+    def nearest(self, first, last):
+        """ The populated ticks in [first, last] just below and just above the reference price """
+        position = (self.reference_price - self.low) / self.tick_size
+        ticks = []
+        below = self.levels.previous(min(last, math.floor(position)))
+        if below is not None and below >= first:
+            ticks.append(below)
+        above = self.levels.next(max(first, math.ceil(position)))
+        if above is not None and above <= last:
+            ticks.append(above)
+        return ticks
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+
+def benchmark(number_of_orders=100000, tick_size=0.01, number_of_ticks=2001, checks=200, cancel_ratio=0.2):
+    """
+    Random pre-open flow with cancels. Times the incremental update of every event, then re-runs the batch uncross
+    over the live orders at checks evenly spaced events, verifying that both give the same result.
+    """
+    rng = random.Random(0)
+    low = 100.0 - tick_size * (number_of_ticks // 2)
+    auction = IncrementalAuction(tick_size, low, low + tick_size * (number_of_ticks - 1), reference_price=100.0)
+    # each event is a new order (side, price, size) or, as None, a cancel of a random live order
+    events = []
+    live = 0
+    for _ in range(number_of_orders):
+        if live and rng.random() < cancel_ratio:
+            events.append(None)
+            live -= 1
+        else:
+            side = rng.randint(0, 1)
+            ticks = int(rng.gauss(0, number_of_ticks / 10)) + (-20 if side == 0 else 20)
+            ticks = max(-(number_of_ticks // 2), min(number_of_ticks // 2, ticks))
+            price = None if rng.random() < 0.01 else round(100.0 + ticks * tick_size, 10)
+            events.append((side, price, rng.randint(1, 100)))
+            live += 1
+    check_every = max(1, len(events) // checks)
+    snapshots = []
+    ids = []
+    start = time.perf_counter()
+    elapsed_checks = 0.0
+    for k, event in enumerate(events):
+        if event is not None:
+            ids.append(auction.add_order(*event))
+        else:
+            j = rng.randrange(len(ids))
+            ids[j], ids[-1] = ids[-1], ids[j]
+            auction.cancel_order(ids.pop())
+        if k % check_every == 0:
+            check_start = time.perf_counter()
+            snapshots.append((k, [auction.orders[order_id] for order_id in ids],
+                              (auction.price, auction.volume, auction.imbalance)))
+            elapsed_checks += time.perf_counter() - check_start
+    incremental = time.perf_counter() - start - elapsed_checks
+    # only the uncross call is timed, not building its input arrays from the live orders
+    batch = 0.0
+    for k, orders, (price, volume, imbalance) in snapshots:
+        sides = np.array([side for side, tick, size in orders], dtype=np.int8)
+        prices = np.array([np.nan if tick is None else auction.to_price(tick) for side, tick, size in orders])
+        sizes = np.array([size for side, tick, size in orders], dtype=np.int64)
+        start = time.perf_counter()
+        batch_price, batch_volume, residual_prices, residual_sides, residual_qtys = uncross(prices, sides, sizes, 100.0)
+        batch += time.perf_counter() - start
+        assert batch_volume == volume and (batch_price == price or np.isnan(batch_price) and np.isnan(price)), k
+    batch /= len(snapshots)
+    print('{0} events: incremental {1:.2f} us/event, batch uncross {2:.2f} ms/event ({3} live orders at the end), '
+          'x{4:.0f}'.format(len(events), incremental / len(events) * 1e6, batch * 1e3, len(ids),
+                            batch / (incremental / len(events))))
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,465 @@
+'''
+Event-sourced persistence for OrderBook. Every order, cancel and amend the book accepts is appended to a binary
+journal of fixed-size records, written in batches with a configurable fsync policy. Records carry the order type
+(time in force, iceberg display size, stop price, trader id), so IOC, FOK, post-only, iceberg and stop orders replay
+as what they were. Compact snapshots of the book (resting orders in time priority, held stop orders and a level
+summary, saved as .npy files that can be memory-mapped) are taken periodically. After a crash the latest snapshot is
+loaded and only the tail of the journal written after it is replayed.
+Usage: python Journal.py [number_of_orders]   checks a restore round trip of typed orders, then benchmarks restore
+                                              from snapshot against full replay
+'''
+
+import heapq
+import json
+import os
+import random
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from OrderBook import OrderBook, LimitOrder, IcebergOrder, MarketOrder, StopOrder, Side, TimeInForce
+from TickOrderBook import TickOrderBook
+
+NEW_LIMIT = 0
+NEW_MARKET = 1
+CANCEL = 2
+AMEND = 3
+NEW_STOP = 4
+
+# trader_id of orders without one; journaled trader ids are non-negative integers
+NO_TRADER = -1
+
+# price is NaN for market and stop (market) orders, stop_price NaN and display_size 0 for the other types
+JOURNAL_DTYPE = np.dtype([('type', np.int8), ('side', np.int8), ('time_in_force', np.int8), ('price', np.float64),
+                          ('size', np.int64), ('order_id', np.int64), ('stop_price', np.float64),
+                          ('display_size', np.int64), ('trader_id', np.int64)])
+
+JOURNAL_FILE = 'journal.bin'
+SNAPSHOT_PREFIX = 'snapshot_'
+
+
+class Journal(object):
+    """
+    Append-only file of JOURNAL_DTYPE records. Records are buffered and written batch_size at a time.
+    fsync is 'batch' (fsync after every write), 'never' (leave it to the OS) or a number of seconds between fsyncs.
+    Events still in the buffer are lost on a crash, so batch_size=1 with fsync='batch' makes every event durable.
+    """
+    def __init__(self, path, batch_size=4096, fsync='batch'):
+        self.path = path
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.buffer = np.zeros(batch_size, dtype=JOURNAL_DTYPE)
+        self.buffered = 0
+        self.file = open(path, 'ab')
+        size = self.file.tell()
+        if size % JOURNAL_DTYPE.itemsize:
+            # drop a record torn by a crash in the middle of a write
+            self.file.truncate(size - size % JOURNAL_DTYPE.itemsize)
+            self.file.seek(0, os.SEEK_END)
+        self.number_of_events = self.file.tell() // JOURNAL_DTYPE.itemsize
+        self.last_fsync = time.monotonic()
+
+    def append(self, event_type, side, price, size, order_id, time_in_force=TimeInForce.GTC.value,
+               stop_price=np.nan, display_size=0, trader_id=NO_TRADER):
+        record = self.buffer[self.buffered]
+        record['type'] = event_type
+        record['side'] = side
+        record['time_in_force'] = time_in_force
+        record['price'] = price
+        record['size'] = size
+        record['order_id'] = order_id
+        record['stop_price'] = stop_price
+        record['display_size'] = display_size
+        record['trader_id'] = trader_id
+        self.buffered += 1
+        self.number_of_events += 1
+        if self.buffered == self.batch_size:
+            self.flush()
+
+    def append_batch(self, records):
+        self.flush()
+        self.write(records)
+
+    def write(self, records):
+        self.file.write(records.tobytes())
+        self.file.flush()
+        if self.fsync == 'batch' or (self.fsync != 'never' and time.monotonic() - self.last_fsync >= self.fsync):
+            os.fsync(self.file.fileno())
+            self.last_fsync = time.monotonic()
+
+    def flush(self):
+        if self.buffered:
+            self.write(self.buffer[:self.buffered])
+            self.buffered = 0
+
+    def close(self):
+        self.flush()
+        if self.fsync != 'never':
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+    @staticmethod
+    def read(path, start=0):
+        """ Memory-mapped journal records from event number start onwards """
+        number_of_events = os.path.getsize(path) // JOURNAL_DTYPE.itemsize
+        if number_of_events <= start:
+            return np.empty(0, dtype=JOURNAL_DTYPE)
+        return np.memmap(path, dtype=JOURNAL_DTYPE, mode='r', offset=start * JOURNAL_DTYPE.itemsize,
+                         shape=(number_of_events - start,))
+
+
+def order_fields(order):
+    """
+    Journal fields of a new order as (type, side, price, size, time_in_force, stop_price, display_size, trader_id),
+    taken before the book converts its prices or fills it
+    """
+    trader_id = order.trader_id
+    if trader_id is None:
+        trader_id = NO_TRADER
+    elif not isinstance(trader_id, (int, np.integer)) or trader_id < 0:
+        raise ValueError('Journaled trader ids must be non-negative integers, not {0!r}'.format(trader_id))
+    if isinstance(order, StopOrder):
+        price = np.nan if order.price is None else float(order.price)
+        return NEW_STOP, order.side.value, price, order.size, order.time_in_force.value, float(order.stop_price), 0, \
+            trader_id
+    if isinstance(order, MarketOrder):
+        return NEW_MARKET, order.side.value, np.nan, order.size, order.time_in_force.value, np.nan, 0, trader_id
+    return NEW_LIMIT, order.side.value, float(order.price), order.size, order.time_in_force.value, np.nan, \
+        order.display_size or 0, trader_id
+
+
+def order_from_fields(event_type, side, price, size, time_in_force, stop_price, display_size, trader_id):
+    """ The order journaled as order_fields """
+    side = Side(side)
+    time_in_force = TimeInForce(time_in_force)
+    trader_id = None if trader_id == NO_TRADER else trader_id
+    if event_type == NEW_STOP:
+        return StopOrder(side, stop_price, size, None if np.isnan(price) else price, None, None, time_in_force,
+                         trader_id)
+    if event_type == NEW_MARKET:
+        return MarketOrder(side, size, None, None, time_in_force, trader_id)
+    if display_size:
+        return IcebergOrder(side, price, size, display_size, None, None, time_in_force, trader_id)
+    return LimitOrder(side, price, size, None, None, time_in_force, trader_id)
+
+
+def apply_events(book, events):
+    """
+    Replay journal records into book: runs of plain (GTC, no trader id) limit and market orders go through
+    process_orders; typed orders, stops, cancels and amends one by one. The order ids of new orders are assigned
+    again by the book, in the same sequence as when they were journaled.
+    """
+    types = np.asarray(events['type'])
+    batched = ((types <= NEW_MARKET) & (np.asarray(events['time_in_force']) == TimeInForce.GTC.value) &
+               (np.asarray(events['display_size']) == 0) & (np.asarray(events['trader_id']) == NO_TRADER))
+    # boundaries of the runs of consecutive plain new orders / single other events
+    breaks = np.flatnonzero(np.diff(batched.astype(np.int8)) != 0) + 1
+    start = 0
+    for end in list(breaks) + [len(events)]:
+        if start == end:
+            continue
+        run = events[start:end]
+        if batched[start]:
+            prices = np.where(run['type'] == NEW_MARKET, np.nan, run['price'])
+            book.process_orders(run['side'], prices, run['size'])
+        else:
+            columns = ('type', 'side', 'price', 'size', 'time_in_force', 'stop_price', 'display_size', 'trader_id')
+            for fields, order_id in zip(zip(*(run[c].tolist() for c in columns)), run['order_id'].tolist()):
+                event_type, size = fields[0], fields[3]
+                if event_type == CANCEL:
+                    book.cancel_order(order_id)
+                elif event_type == AMEND:
+                    book.amend_order(order_id, size)
+                else:
+                    book.process_order(order_from_fields(*fields))
+        start = end
+
+
+class JournaledBook(object):
+    """
+    Wraps an OrderBook or TickOrderBook: process_order, process_orders, cancel_order and amend_order are journaled
+    once the book has applied them, so an order the book rejects (e.g. a price off the tick grid) never reaches the
+    journal and the journaled order id is the one the book assigned. Stop activations are not journaled: replaying
+    the stop orders and trades triggers them again. A snapshot is taken every snapshot_every events (if set) or on
+    request, and only the newest keep_snapshots snapshots are kept in the directory.
+    """
+    def __init__(self, book, directory, batch_size=4096, fsync='batch', snapshot_every=None, keep_snapshots=2):
+        os.makedirs(directory, exist_ok=True)
+        self.book = book
+        self.directory = directory
+        self.journal = Journal(os.path.join(directory, JOURNAL_FILE), batch_size, fsync)
+        self.snapshot_every = snapshot_every
+        self.keep_snapshots = keep_snapshots
+        self.last_snapshot = self.journal.number_of_events
+
+    def process_order(self, order):
+        event_type, side, price, size, time_in_force, stop_price, display_size, trader_id = order_fields(order)
+        self.book.process_order(order)
+        self.journal.append(event_type, side, price, size, order.order_id, time_in_force, stop_price, display_size,
+                            trader_id)
+        self.after_event()
+
+    def process_orders(self, sides, prices, sizes):
+        prices = np.asarray(prices, dtype=np.float64)
+        records = np.zeros(len(prices), dtype=JOURNAL_DTYPE)
+        records['type'] = np.where(np.isnan(prices), NEW_MARKET, NEW_LIMIT)
+        records['side'] = sides
+        records['price'] = prices
+        records['size'] = sizes
+        # consecutive unless stop orders are triggered within the batch
+        records['order_id'] = self.book.order_id + 1 + np.arange(len(prices))
+        records['stop_price'] = np.nan
+        records['trader_id'] = NO_TRADER
+        trades = self.book.process_orders(sides, prices, sizes)
+        self.journal.append_batch(records)
+        self.journal.number_of_events += len(records)
+        self.after_event()
+        return trades
+
+    def cancel_order(self, order_id):
+        order = self.book.cancel_order(order_id)
+        self.journal.append(CANCEL, 0, 0., 0, order_id)
+        self.after_event()
+        return order
+
+    def amend_order(self, order_id, new_size):
+        order = self.book.amend_order(order_id, new_size)
+        self.journal.append(AMEND, 0, 0., new_size, order_id)
+        self.after_event()
+        return order
+
+    def after_event(self):
+        if self.snapshot_every and self.journal.number_of_events - self.last_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        """ Flush the journal and write a snapshot of the book covering every event journaled so far """
+        self.journal.flush()
+        number_of_events = self.journal.number_of_events
+        path = os.path.join(self.directory, '{0}{1:015d}'.format(SNAPSHOT_PREFIX, number_of_events))
+        write_snapshot(self.book, path, number_of_events)
+        self.last_snapshot = number_of_events
+        for old in list_snapshots(self.directory)[:-self.keep_snapshots]:
+            shutil.rmtree(os.path.join(self.directory, old))
+        return path
+
+    def close(self):
+        self.journal.close()
+
+    @classmethod
+    def restore(cls, directory, book=None, **kwargs):
+        """
+        Latest snapshot in directory plus the journal tail after it. Without a snapshot the whole journal is
+        replayed into book (a new OrderBook if not given).
+        """
+        snapshots = list_snapshots(directory)
+        if snapshots:
+            book, number_of_events = read_snapshot(os.path.join(directory, snapshots[-1]))
+        else:
+            book, number_of_events = book if book is not None else OrderBook(), 0
+        apply_events(book, Journal.read(os.path.join(directory, JOURNAL_FILE), number_of_events))
+        return cls(book, directory, **kwargs)
+
+
+def list_snapshots(directory):
+    return sorted(name for name in os.listdir(directory)
+                  if name.startswith(SNAPSHOT_PREFIX) and not name.endswith('.tmp'))
+
+
+def write_snapshot(book, path, number_of_events):
+    """
+    Resting orders in time priority within each level as orders.npy, held stop orders as stops.npy, one row per
+    level as levels.npy and the book settings and last trade price (which the stops are checked against) as
+    meta.json, written to a temporary directory that is renamed into place once complete
+    """
+    order_dtype = np.dtype([('side', np.int8), ('market', np.bool_), ('price', book.price_typecode),
+                            ('size', np.int64), ('order_id', np.int64), ('timestamp', np.int64),
+                            ('time_in_force', np.int8), ('trader_id', np.int64), ('display_size', np.int64),
+                            ('hidden_size', np.int64)])
+    # stop prices are in book units, limit prices as given (NaN for stop market orders) until the stop triggers
+    stop_dtype = np.dtype([('side', np.int8), ('price', np.float64), ('stop_price', book.price_typecode),
+                           ('size', np.int64), ('order_id', np.int64), ('timestamp', np.int64),
+                           ('time_in_force', np.int8), ('trader_id', np.int64)])
+    level_dtype = np.dtype([('side', np.int8), ('price', book.price_typecode), ('size', np.int64),
+                            ('count', np.int64), ('hidden', np.int64)])
+    orders, stops, levels = [], [], []
+    for side, book_levels in ((Side.BUY, book.bids), (Side.SELL, book.offers)):
+        for price in list(book_levels.keys()):
+            level = book_levels[price]
+            levels.append((side.value, price, level.size, level.count, level.hidden))
+            for order in level:
+                orders.append((side.value, isinstance(order, MarketOrder), order.price, order.size, order.order_id,
+                               order.timestamp or 0, order.time_in_force.value,
+                               NO_TRADER if order.trader_id is None else order.trader_id,
+                               getattr(order, 'display_size', None) or 0, order.hidden_size))
+    for stop in book.stop_orders.values():
+        stops.append((stop.side.value, np.nan if stop.price is None else stop.price, stop.stop_price, stop.size,
+                      stop.order_id, stop.timestamp or 0, stop.time_in_force.value,
+                      NO_TRADER if stop.trader_id is None else stop.trader_id))
+    meta = {'book': type(book).__name__, 'tick_size': getattr(book, 'tick_size', None), 'order_id': book.order_id,
+            'number_of_events': number_of_events, 'last_trade_price': book.last_trade_price,
+            'self_trade_prevention': book.self_trade_prevention}
+    temporary = path + '.tmp'
+    os.makedirs(temporary, exist_ok=True)
+    np.save(os.path.join(temporary, 'orders.npy'), np.array(orders, dtype=order_dtype))
+    np.save(os.path.join(temporary, 'stops.npy'), np.array(stops, dtype=stop_dtype))
+    np.save(os.path.join(temporary, 'levels.npy'), np.array(levels, dtype=level_dtype))
+    with open(os.path.join(temporary, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(temporary, path)
+
+
+def read_snapshot(path):
+    """ Book rebuilt from a snapshot, and the number of journal events the snapshot covers """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    book = TickOrderBook(meta['tick_size']) if meta['book'] == 'TickOrderBook' else OrderBook()
+    orders = np.load(os.path.join(path, 'orders.npy'), mmap_mode='r')
+    buy, sell = Side.BUY, Side.SELL
+    columns = ('side', 'market', 'price', 'size', 'order_id', 'timestamp', 'time_in_force', 'trader_id',
+               'display_size', 'hidden_size')
+    for side, market, price, size, order_id, timestamp, time_in_force, trader_id, display_size, hidden_size in zip(
+            *(orders[c].tolist() for c in columns)):
+        side = buy if side == 0 else sell
+        time_in_force = TimeInForce(time_in_force)
+        trader_id = None if trader_id == NO_TRADER else trader_id
+        if market:
+            order = MarketOrder(side, size, timestamp, order_id, time_in_force, trader_id)
+        else:
+            order = LimitOrder(side, price, size, timestamp, order_id, time_in_force, trader_id, display_size or None)
+            if hidden_size:
+                order.hidden_size = hidden_size
+        order.price = price
+        book.add_to_book(order)
+    stops = np.load(os.path.join(path, 'stops.npy'), mmap_mode='r')
+    columns = ('side', 'price', 'stop_price', 'size', 'order_id', 'timestamp', 'time_in_force', 'trader_id')
+    for side, price, stop_price, size, order_id, timestamp, time_in_force, trader_id in zip(
+            *(stops[c].tolist() for c in columns)):
+        side = buy if side == 0 else sell
+        stop = StopOrder(side, stop_price, size, None if np.isnan(price) else price, timestamp, order_id,
+                         TimeInForce(time_in_force), None if trader_id == NO_TRADER else trader_id)
+        book.stop_orders[order_id] = stop
+        if side == buy:
+            heapq.heappush(book.buy_stops, (stop_price, order_id))
+        else:
+            heapq.heappush(book.sell_stops, (-stop_price, order_id))
+    book.set_stop_triggers()
+    book.last_trade_price = meta['last_trade_price']
+    book.self_trade_prevention = meta['self_trade_prevention']
+    book.order_id = meta['order_id']
+    return book, meta['number_of_events']
+
+
+def book_state(book):
+    """ Everything replay must reproduce: resting orders per level in time priority, held stops and the counters """
+    levels = [(side.value, price, [(o.order_id, o.size, o.hidden_size, o.trader_id) for o in book_levels[price]])
+              for side, book_levels in ((Side.BUY, book.bids), (Side.SELL, book.offers))
+              for price in sorted(book_levels)]
+    stops = sorted((s.order_id, s.side.value, s.stop_price, s.price, s.size, s.trader_id)
+                   for s in book.stop_orders.values())
+    return levels, stops, book.last_trade_price, book.order_id
+
+
+def check_round_trip(number_of_orders=20000, directory='journal_check', tick_size=0.01, seed=4):
+    """
+    Journal a flow of typed orders (IOC, FOK, post-only, iceberg, stop and stop-limit orders, with and without trader
+    ids, plain batches, cancels, amends and orders rejected for prices off the tick grid) on a TickOrderBook with a
+    snapshot half way, then check that restoring from the snapshot and replaying the whole journal both rebuild it
+    """
+    shutil.rmtree(directory, ignore_errors=True)
+    rng = random.Random(seed)
+    journaled = JournaledBook(TickOrderBook(tick_size), directory, fsync='never')
+    order_ids, rejected = [], 0
+    for i in range(number_of_orders):
+        if i == number_of_orders // 2:
+            journaled.snapshot()
+        side = Side.BUY if rng.random() < 0.5 else Side.SELL
+        sign = 1 if side == Side.BUY else -1
+        price = round(100.0 - sign * rng.randint(-5, 20) * tick_size, 2)
+        size = rng.randint(1, 10)
+        trader_id = rng.randrange(20)
+        u = rng.random()
+        if u < 0.05 and order_ids:
+            journaled.cancel_order(rng.choice(order_ids))
+            continue
+        elif u < 0.08 and order_ids:
+            journaled.amend_order(rng.choice(order_ids), rng.randint(0, 12))
+            continue
+        elif u < 0.1:
+            order = LimitOrder(side, price + tick_size / 3, size, None, None, TimeInForce.GTC, trader_id)
+        elif u < 0.15:
+            stop_price = round(100.0 + sign * rng.randint(1, 8) * tick_size, 2)
+            order = StopOrder(side, stop_price, size, price if rng.random() < 0.5 else None, None, None,
+                              TimeInForce.GTC, trader_id)
+        elif u < 0.2:
+            order = IcebergOrder(side, price, 3 * size, size, None, None, TimeInForce.GTC, trader_id)
+        elif u < 0.35:
+            order = LimitOrder(side, price, size, None, None, rng.choice(list(TimeInForce)), trader_id)
+        elif u < 0.4:
+            order = MarketOrder(side, size, None, None, TimeInForce.GTC, trader_id)
+        elif u < 0.41:
+            sides = [rng.randrange(2) for _ in range(10)]
+            journaled.process_orders(sides, [round(100.0 + (2 * s - 1) * rng.randint(1, 20) * tick_size, 2)
+                                             for s in sides], [rng.randint(1, 10) for _ in sides])
+            continue
+        else:
+            order = LimitOrder(side, price, size, None, None, TimeInForce.GTC, trader_id if u < 0.7 else None)
+        try:
+            journaled.process_order(order)
+        except ValueError:
+            rejected += 1
+            continue
+        order_ids.append(order.order_id)
+    journaled.close()
+    live = book_state(journaled.book)
+    restored = JournaledBook.restore(directory).book
+    replayed = TickOrderBook(tick_size)
+    apply_events(replayed, Journal.read(os.path.join(directory, JOURNAL_FILE)))
+    assert book_state(restored) == live, 'book restored from the snapshot differs from the journaled book'
+    assert book_state(replayed) == live, 'book replayed from the journal differs from the journaled book'
+    print('Round trip: {0} events, {1} rejected orders, {2} resting and {3} stop orders restored and replayed'.format(
+        journaled.journal.number_of_events, rejected, len(restored.orders), len(restored.stop_orders)))
+    shutil.rmtree(directory)
+
+
+def benchmark(number_of_orders=1000000, directory='journal_benchmark'):
+    """ Journal a cancel-heavy day, snapshot 90% of the way through, then compare full replay with restore """
+    shutil.rmtree(directory, ignore_errors=True)
+    rng = random.Random(0)
+    journaled = JournaledBook(OrderBook(), directory, fsync='never')
+    resting = []
+    start = time.perf_counter()
+    for i in range(number_of_orders):
+        if i == int(0.9 * number_of_orders):
+            journaled.snapshot()
+        if resting and rng.random() < 0.45:
+            j = rng.randrange(len(resting))
+            resting[j], resting[-1] = resting[-1], resting[j]
+            journaled.cancel_order(resting.pop())
+        else:
+            side = Side.BUY if rng.random() < 0.5 else Side.SELL
+            offset = rng.randint(-5, 200) * (-1 if side == Side.BUY else 1)
+            order = LimitOrder(side, round(100.0 + offset * 0.01, 2), rng.randint(1, 10))
+            journaled.process_order(order)
+            resting.append(order.order_id)
+    journaled.close()
+    print('Journaled {0} events in {1:.3f}s'.format(journaled.journal.number_of_events, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    replayed = OrderBook()
+    apply_events(replayed, Journal.read(os.path.join(directory, JOURNAL_FILE)))
+    replay_time = time.perf_counter() - start
+    start = time.perf_counter()
+    restored = JournaledBook.restore(directory).book
+    restore_time = time.perf_counter() - start
+    assert all(np.array_equal(a, b, equal_nan=True) for a, b in zip(restored.depth(10), replayed.depth(10)))
+    print('Full replay: {0:.3f}s, snapshot + tail: {1:.3f}s, {2} resting orders'.format(
+        replay_time, restore_time, len(restored.orders)))
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    check_round_trip()
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,99 @@
+'''
+Load generator for Gateway.py. Opens a number of concurrent client connections, each keeping up to a window of
+orders in flight, sends random limit and market orders (and cancels of its resting orders), and reports the
+throughput in orders/sec and the ack latency percentiles measured from send to ACK/REJ.
+Usage: python LoadGenerator.py [--orders N] [--clients C] [--window W] [--port P | --path SOCKET]
+Without --port or --path a gateway is started in-process on a free local port.
+'''
+
+import argparse
+import asyncio
+import random
+import time
+
+from Gateway import Gateway
+from Latency import LatencyHistogram
+
+
+async def run_client(client, number_of_orders, window, open_connection, histogram, cancel_ratio=0.3):
+    reader, writer = await open_connection()
+    rng = random.Random(client)
+    in_flight = asyncio.Semaphore(window)
+    sent = {}
+    resting = []
+    done = asyncio.Event()
+    acks = 0
+
+    async def read_replies():
+        nonlocal acks
+        while acks < number_of_orders:
+            line = await reader.readline()
+            if not line:
+                break
+            fields = line.decode().split()
+            if fields[0] in ('ACK', 'REJ'):
+                histogram.record(time.perf_counter_ns() - sent.pop(fields[1]))
+                if fields[0] == 'ACK' and fields[1].startswith('n'):
+                    resting.append(fields[2])
+                acks += 1
+                in_flight.release()
+        done.set()
+
+    replies = asyncio.ensure_future(read_replies())
+    for i in range(number_of_orders):
+        await in_flight.acquire()
+        if resting and rng.random() < cancel_ratio:
+            ref = 'c{0}'.format(i)
+            message = 'CANCEL {0} {1}'.format(ref, resting.pop(rng.randrange(len(resting))))
+        else:
+            ref = 'n{0}'.format(i)
+            side = 'BUY' if rng.random() < 0.5 else 'SELL'
+            if rng.random() < 0.1:
+                message = 'NEW {0} {1} MARKET {2}'.format(ref, side, rng.randint(1, 10))
+            else:
+                offset = rng.randint(-3, 20) * (-1 if side == 'BUY' else 1)
+                message = 'NEW {0} {1} LIMIT {2} {3}'.format(ref, side, rng.randint(1, 10), 100 + offset * 0.25)
+        sent[ref] = time.perf_counter_ns()
+        writer.write(message.encode() + b'\n')
+        if i % 64 == 63:
+            await writer.drain()
+    await writer.drain()
+    await done.wait()
+    await replies
+    writer.close()
+
+
+async def main(number_of_orders, number_of_clients, window, port=None, path=None):
+    gateway = None
+    if port is None and path is None:
+        gateway = Gateway()
+        server = await gateway.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+    if path is not None:
+        open_connection = lambda: asyncio.open_unix_connection(path)
+    else:
+        open_connection = lambda: asyncio.open_connection('127.0.0.1', port)
+    histogram = LatencyHistogram()
+    per_client = number_of_orders // number_of_clients
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(c, per_client, window, open_connection, histogram)
+                           for c in range(number_of_clients)))
+    elapsed = time.perf_counter() - start
+    if gateway is not None:
+        await gateway.stop()
+    stats = histogram.to_dict()
+    print('{0} clients, {1} messages in {2:.3f}s: {3:.0f} orders/sec'.format(
+        number_of_clients, stats['count'], elapsed, stats['count'] / elapsed))
+    print('ack latency: p50 {0:.3f} ms, p99 {1:.3f} ms, max {2:.3f} ms'.format(
+        stats['p50_ns'] / 1e6, stats['p99_ns'] / 1e6, stats['max_ns'] / 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load generator for Gateway.py')
+    parser.add_argument('--orders', type=int, default=200000)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--window', type=int, default=256)
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--path')
+    args = parser.parse_args()
+    asyncio.run(main(args.orders, args.clients, args.window, args.port, args.path))
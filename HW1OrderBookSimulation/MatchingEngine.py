@@ -0,0 +1,321 @@
+'''
+Exchange-level matching engine. Owns one TickOrderBook per instrument of ZT_OrderBook/Api.instruments and routes
+orders to them by symbol. Symbols are sharded across worker processes: each shard owns its books and its own order id
+space, receives micro-batches of orders on a command queue and streams trades and top-of-book updates back to the
+engine through a shared-memory ring buffer, so matching throughput scales with the number of cores. A batch that its
+book refuses (a price off the tick grid, or beyond the tick window) is rejected with a REJECT event and its reason on
+an error queue, and the shard carries on. A shard that fails otherwise sends its traceback on the error queue and
+stops; the engine raises it from the next submit() or from stop().
+'''
+
+import multiprocessing
+import os
+import queue
+import sys
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from OrderBook import Side, TRADE_DTYPE
+from TickOrderBook import TickOrderBook, get_instruments
+
+TRADE = 0
+BOOK = 1
+REJECT = 2
+
+# batch is the number submit() returned for the batch the event comes from
+EVENT_DTYPE = np.dtype([('kind', np.int8), ('symbol', np.int16), ('side', np.int8), ('price', np.float64),
+                        ('size', np.int64), ('incoming_order_id', np.int64), ('book_order_id', np.int64),
+                        ('batch', np.int64)])
+
+# order ids are shard << SHARD_ID_BITS | book << BOOK_ID_BITS | sequence number within the book
+SHARD_ID_BITS = 48
+BOOK_ID_BITS = 32
+
+
+class RingBuffer(object):
+    """
+    Single-producer single-consumer ring of fixed-size records in shared memory. The first 16 bytes hold the
+    number of records written and read so far; the producer only advances the first and the consumer only the
+    second, so no lock is needed. A full ring makes the producer wait for the consumer.
+    """
+    header_bytes = 16
+
+    def __init__(self, dtype, capacity, name=None):
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None,
+                                              size=self.header_bytes + capacity * self.dtype.itemsize)
+        self.counters = np.ndarray(2, dtype=np.int64, buffer=self.shm.buf)
+        self.records = np.ndarray(capacity, dtype=self.dtype, buffer=self.shm.buf, offset=self.header_bytes)
+        if name is None:
+            self.counters[:] = 0
+
+    def __getstate__(self):
+        return self.dtype, self.capacity, self.shm.name
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __len__(self):
+        return int(self.counters[0] - self.counters[1])
+
+    def write(self, records):
+        done = 0
+        while done < len(records):
+            written = int(self.counters[0])
+            free = self.capacity - (written - int(self.counters[1]))
+            if free == 0:
+                time.sleep(0)
+                continue
+            n = min(free, len(records) - done, self.capacity - written % self.capacity)
+            start = written % self.capacity
+            self.records[start:start + n] = records[done:done + n]
+            self.counters[0] = written + n
+            done += n
+
+    def read(self):
+        """ Copy of all records written and not yet read """
+        written, read = int(self.counters[0]), int(self.counters[1])
+        start, end = read % self.capacity, written % self.capacity
+        if written == read:
+            return np.empty(0, dtype=self.dtype)
+        if start < end:
+            records = self.records[start:end].copy()
+        else:
+            records = np.concatenate((self.records[start:], self.records[:end]))
+        self.counters[1] = written
+        return records
+
+    def close(self):
+        del self.counters, self.records
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def run_shard(shard, symbol_indices, tick_sizes, commands, ring, errors):
+    """
+    Worker process: owns the books of its symbols and matches the batches sent on its command queue. A batch that
+    its book refuses with a ValueError is rejected: the trades made before the refusal, a REJECT event whose size
+    is the number of orders not processed to the end and the top of book go on the ring, and (shard, batch, reason)
+    on errors. Any other exception stops the shard, after putting (shard, None, traceback) on errors.
+    """
+    try:
+        books = {}
+        for book_number, (symbol_index, tick_size) in enumerate(zip(symbol_indices, tick_sizes)):
+            book = TickOrderBook(tick_size)
+            book.order_id = (shard << SHARD_ID_BITS) | (book_number << BOOK_ID_BITS)
+            books[symbol_index] = book
+        while True:
+            command = commands.get()
+            if command is None:
+                break
+            batch, symbol_index, sides, prices, sizes = command
+            book = books[symbol_index]
+            rejected = 0
+            try:
+                trades = book.process_orders(sides, prices, sizes)
+            except ValueError as error:
+                # refused before any order (off the grid), or part way, keeping the trades made until then
+                trades = getattr(error, 'trades', np.empty(0, dtype=TRADE_DTYPE))
+                rejected = len(sizes) - getattr(error, 'processed', 0)
+                errors.put((shard, batch, str(error)))
+            n = len(trades) + (rejected > 0)
+            events = np.zeros(n + 2, dtype=EVENT_DTYPE)
+            events['symbol'] = symbol_index
+            events['batch'] = batch
+            events['kind'][:len(trades)] = TRADE
+            for field in ('side', 'price', 'size', 'incoming_order_id', 'book_order_id'):
+                events[field][:len(trades)] = trades[field]
+            if rejected:
+                events[len(trades)]['kind'] = REJECT
+                events[len(trades)]['price'] = np.nan
+                events[len(trades)]['size'] = rejected
+            for i, (side, levels) in enumerate([(Side.BUY, book.bids), (Side.SELL, book.offers)]):
+                event = events[n + i]
+                event['kind'] = BOOK
+                event['side'] = side.value
+                tick = levels.best()
+                if tick is None:
+                    event['price'] = np.nan
+                else:
+                    event['price'] = book.to_price(tick)
+                    event['size'] = levels[tick].size
+            ring.write(events)
+    except Exception:
+        errors.put((shard, None, traceback.format_exc()))
+    finally:
+        ring.close()
+
+
+class MatchingEngine(object):
+    """
+    One TickOrderBook per instrument, sharded over worker processes.
+    submit() routes a batch of orders for one symbol to the shard owning it and returns the batch's number; poll()
+    returns the EVENT_DTYPE trade (kind TRADE), rejection (kind REJECT) and top-of-book (kind BOOK, one per side
+    after every batch) events streamed back so far. The reason of a rejected batch is in rejections, keyed by batch
+    number, once poll() or stop() has received it. A failed shard is reported as a RuntimeError, with the shard's
+    traceback, by the next submit() and by stop().
+    """
+    def __init__(self, instruments=None, number_of_shards=None, ring_capacity=1 << 16):
+        if instruments is None:
+            instruments = get_instruments()
+        if number_of_shards is None:
+            number_of_shards = os.cpu_count() or 1
+        self.symbols = sorted(instruments)
+        self.symbol_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.number_of_shards = min(number_of_shards, len(self.symbols))
+        self.shard_of = [i % self.number_of_shards for i in range(len(self.symbols))]
+        self.tick_sizes = [instruments[symbol]['ticksize'] for symbol in self.symbols]
+        self.ring_capacity = ring_capacity
+        self.commands = []
+        self.rings = []
+        self.workers = []
+        self.errors = None
+        self.failure = None
+        self.rejections = {}
+        self.batches = 0
+
+    def start(self):
+        self.errors = multiprocessing.Queue()
+        self.rejections = {}
+        self.batches = 0
+        for shard in range(self.number_of_shards):
+            symbol_indices = [i for i in range(len(self.symbols)) if self.shard_of[i] == shard]
+            commands = multiprocessing.Queue()
+            ring = RingBuffer(EVENT_DTYPE, self.ring_capacity)
+            worker = multiprocessing.Process(target=run_shard, daemon=True,
+                                             args=(shard, symbol_indices, [self.tick_sizes[i] for i in symbol_indices],
+                                                   commands, ring, self.errors))
+            worker.start()
+            self.commands.append(commands)
+            self.rings.append(ring)
+            self.workers.append(worker)
+
+    def submit(self, symbol, sides, prices, sizes):
+        """
+        Route a batch of orders (arrays as for OrderBook.process_orders) to the book of symbol; returns the batch
+        number found in the batch's events
+        """
+        self.check()
+        i = self.symbol_index[symbol]
+        batch = self.batches
+        self.batches += 1
+        self.commands[self.shard_of[i]].put((batch, i, np.asarray(sides, dtype=np.int8),
+                                             np.asarray(prices, dtype=np.float64), np.asarray(sizes, dtype=np.int64)))
+        return batch
+
+    def submit_order(self, symbol, side, price, size):
+        """ Route a single order; price None for a market order """
+        return self.submit(symbol, [side.value], [np.nan if price is None else price], [size])
+
+    def collect_errors(self):
+        """ Move the rejection reasons and shard failures received on the error queue to rejections and failure """
+        while self.errors is not None:
+            try:
+                shard, batch, message = self.errors.get_nowait()
+            except queue.Empty:
+                return
+            if batch is not None:
+                self.rejections[batch] = message
+            elif self.failure is None:
+                self.failure = 'Shard {0} failed:\n{1}'.format(shard, message)
+
+    def get_failure(self):
+        """ Description of the first failed shard, None while all shards are running or have stopped cleanly """
+        self.collect_errors()
+        if self.failure is None:
+            for shard, worker in enumerate(self.workers):
+                if worker.exitcode:
+                    self.failure = 'Shard {0} exited with code {1}'.format(shard, worker.exitcode)
+                    break
+        return self.failure
+
+    def check(self):
+        """ Raise RuntimeError if a shard has failed """
+        failure = self.get_failure()
+        if failure is not None:
+            raise RuntimeError(failure)
+
+    def poll(self):
+        self.collect_errors()
+        events = [ring.read() for ring in self.rings]
+        return np.concatenate(events) if events else np.empty(0, dtype=EVENT_DTYPE)
+
+    def stop(self):
+        """
+        Finish the queued batches, stop the shards and return the events not yet polled; raises RuntimeError, once
+        the shards are stopped and their rings released, if a shard has failed
+        """
+        events = []
+        for commands in self.commands:
+            commands.put(None)
+        while any(worker.is_alive() for worker in self.workers):
+            events.append(self.poll())
+            time.sleep(0.001)
+        events.append(self.poll())
+        for worker, ring in zip(self.workers, self.rings):
+            worker.join()
+            ring.close()
+            ring.unlink()
+        failure = self.get_failure()
+        self.commands, self.rings, self.workers, self.errors, self.failure = [], [], [], None, None
+        if failure is not None:
+            raise RuntimeError(failure)
+        return np.concatenate(events)
+
+
+def benchmark(number_of_orders=1000000, batch_size=1000, number_of_shards=None):
+    """ Random flow spread over all instruments, reporting engine throughput in orders/sec """
+    engine = MatchingEngine(number_of_shards=number_of_shards)
+    rng = np.random.default_rng(0)
+    batches = []
+    for b in range(number_of_orders // batch_size):
+        symbol = engine.symbols[b % len(engine.symbols)]
+        tick_size = engine.tick_sizes[b % len(engine.symbols)]
+        sides = rng.integers(0, 2, batch_size)
+        prices = 100.0 + rng.integers(-50, 51, batch_size) * tick_size
+        prices[rng.random(batch_size) < 0.05] = np.nan
+        batches.append((symbol, sides, prices, rng.integers(1, 11, batch_size)))
+    engine.start()
+    start = time.perf_counter()
+    number_of_trades = 0
+    for batch in batches:
+        engine.submit(*batch)
+        number_of_trades += np.count_nonzero(engine.poll()['kind'] == TRADE)
+    number_of_trades += np.count_nonzero(engine.stop()['kind'] == TRADE)
+    elapsed = time.perf_counter() - start
+    print('{0} shards: {1} orders, {2} trades in {3:.3f}s, {4:.0f} orders/sec'.format(
+        engine.number_of_shards, len(batches) * batch_size, number_of_trades, elapsed,
+        len(batches) * batch_size / elapsed))
+
+
+def check_rejections():
+    """
+    A batch refused by its book, whole (a price off the tick grid) or part way through (a price beyond the tick
+    window), is rejected with its REJECT event and reason while the shard keeps serving its other symbols
+    """
+    engine = MatchingEngine(number_of_shards=2)
+    symbol, other = [s for i, s in enumerate(engine.symbols) if engine.shard_of[i] == 0][:2]
+    tick_size = engine.tick_sizes[engine.symbol_index[symbol]]
+    engine.start()
+    off_grid = engine.submit(symbol, [0, 1], [100.0, 100.0 + tick_size / 3], [1, 1])
+    part_way = engine.submit(symbol, [1, 0, 1, 0], [100.0, 100.0, 100.0 + (3 << 20) * tick_size, 100.0], [2, 1, 1, 1])
+    later = [engine.submit(s, [0, 1], [100.0, 100.0], [5, 5]) for s in (symbol, other)]
+    events = engine.stop()
+    rejects = events[events['kind'] == REJECT]
+    assert rejects['batch'].tolist() == [off_grid, part_way] and rejects['size'].tolist() == [2, 2], rejects
+    assert sorted(engine.rejections) == [off_grid, part_way], engine.rejections
+    trades = events[events['kind'] == TRADE]
+    assert np.count_nonzero(trades['batch'] == part_way) == 1 and set(trades['batch']) == {part_way, *later}, trades
+    print('Rejections: {0} batches rejected, later batches on the same shard traded'.format(len(rejects)))
+
+
+if __name__ == '__main__':
+    check_rejections()
+    for shards in sorted({1, os.cpu_count() or 1}):
+        benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000, number_of_shards=shards)
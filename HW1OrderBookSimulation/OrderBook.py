@@ -10,108 +10,697 @@ order book.
 '''
 
 import enum
+import heapq
+import itertools
+import os
 import queue
 import time
-from collections import defaultdict
+from array import array
+
+import numpy as np
+
+from Latency import LatencyRecorder
 
 class Side(enum.Enum):
     BUY = 0
     SELL = 1
 
 
+class TimeInForce(enum.Enum):
+    GTC = 0         # rest until filled or cancelled
+    IOC = 1         # fill what is available now, cancel the rest
+    FOK = 2         # fill completely now or not at all
+    POST_ONLY = 3   # rest only: cancelled if it would trade on entry
+
+
+# enum attribute lookups are slow, so the order processing paths compare against these module-level aliases
+BUY, SELL = Side.BUY, Side.SELL
+GTC, IOC, FOK, POST_ONLY = TimeInForce.GTC, TimeInForce.IOC, TimeInForce.FOK, TimeInForce.POST_ONLY
+INFINITY = float('inf')
+
+
 def get_timestamp():
     """ Microsecond timestamp """
-    return int(1e6 * time.time())
+    return time.time_ns() // 1000
+
+
+TRADE_DTYPE = np.dtype([('side', np.int8), ('price', np.float64), ('size', np.int64),
+                        ('incoming_order_id', np.int64), ('book_order_id', np.int64)])
+
+
+class TradeBuffer(object):
+    """
+    Columnar trade output used by OrderBook.process_orders instead of Trade objects on a queue.Queue:
+    one growable typed array per field, turned into a TRADE_DTYPE structured array once the batch is done.
+    """
+    __slots__ = ('side', 'price', 'size', 'incoming_order_id', 'book_order_id')
+
+    def __init__(self, price_typecode='d'):
+        self.side = array('b')
+        self.price = array(price_typecode)
+        self.size = array('q')
+        self.incoming_order_id = array('q')
+        self.book_order_id = array('q')
+
+    def __len__(self):
+        return len(self.size)
+
+    def append(self, side, price, size, incoming_order_id, book_order_id):
+        self.side.append(side.value)
+        self.price.append(price)
+        self.size.append(size)
+        self.incoming_order_id.append(incoming_order_id)
+        self.book_order_id.append(book_order_id)
+
+    def to_array(self, price_scale=None):
+        """ Structured array of the buffered trades, book prices multiplied by price_scale (tick size) if given """
+        trades = np.empty(len(self), dtype=TRADE_DTYPE)
+        trades['side'] = np.frombuffer(self.side, dtype=np.int8)
+        prices = np.frombuffer(self.price, dtype=np.float64 if self.price.typecode == 'd' else np.int64)
+        trades['price'] = prices if price_scale is None else prices * price_scale
+        trades['size'] = np.frombuffer(self.size, dtype=np.int64)
+        trades['incoming_order_id'] = np.frombuffer(self.incoming_order_id, dtype=np.int64)
+        trades['book_order_id'] = np.frombuffer(self.book_order_id, dtype=np.int64)
+        return trades
+
+
+class PriceLevel(object):
+    """
+    FIFO of the orders resting at one price, kept as a doubly-linked list threaded through the orders themselves
+    (order.prev_order / order.next_order), so appending, popping the front and unlinking any order are O(1).
+    The total resting size, the hidden size of iceberg orders and the number of orders are maintained
+    incrementally; whoever changes the size of a resting order must adjust level.size by the same amount.
+    """
+    __slots__ = ('price', 'head', 'tail', 'count', 'size', 'hidden')
+
+    def __init__(self, price):
+        self.price = price
+        self.head = None
+        self.tail = None
+        self.count = 0
+        self.size = 0
+        self.hidden = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        order = self.head
+        while order is not None:
+            yield order
+            order = order.next_order
+
+    def append(self, order):
+        order.prev_order = self.tail
+        order.next_order = None
+        if self.tail is None:
+            self.head = order
+        else:
+            self.tail.next_order = order
+        self.tail = order
+        self.count += 1
+        self.size += order.size
+        self.hidden += order.hidden_size
+
+    def remove(self, order):
+        if order.prev_order is None:
+            self.head = order.next_order
+        else:
+            order.prev_order.next_order = order.next_order
+        if order.next_order is None:
+            self.tail = order.prev_order
+        else:
+            order.next_order.prev_order = order.prev_order
+        order.prev_order = None
+        order.next_order = None
+        self.count -= 1
+        self.size -= order.size
+        self.hidden -= order.hidden_size
+
+
+class PriceLevelIndex(object):
+    """
+    Best-price index over one side of the book.
+    Prices are kept in a heap (negated for bids) with lazy deletion: a level popped from the book's dict stays
+    in the heap until it surfaces at the top. best() is O(1) amortised, adding a level is O(log n).
+    """
+    def __init__(self, levels, descending):
+        self.levels = levels
+        self.sign = -1 if descending else 1
+        self.heap = []
+        self.in_heap = set()
+
+    def add(self, price):
+        if price not in self.in_heap:
+            self.in_heap.add(price)
+            heapq.heappush(self.heap, self.sign * price)
+
+    def discard(self, price):
+        """ Called after a level has been removed from the book. Rebuilds the heap once stale entries dominate. """
+        if len(self.heap) > 2 * len(self.levels) + 64:
+            self.heap = [self.sign * p for p in self.levels]
+            heapq.heapify(self.heap)
+            self.in_heap = set(self.levels)
+
+    def best(self):
+        heap = self.heap
+        while heap:
+            price = self.sign * heap[0]
+            if price in self.levels:
+                return price
+            heapq.heappop(heap)
+            self.in_heap.discard(price)
+        return None
+
+    def walk(self):
+        """ Live prices, best first, by a best-first walk of the heap: O(log n) per price plus stale entries met """
+        heap, levels, sign = self.heap, self.levels, self.sign
+        frontier = [(heap[0], 0)] if heap else []
+        while frontier:
+            key, i = heapq.heappop(frontier)
+            if sign * key in levels:
+                yield sign * key
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+
+    def top(self, n):
+        """ Up to n live prices, best first: O(n log n) plus stale entries met """
+        return list(itertools.islice(self.walk(), n))
 
 
 class OrderBook(object):
+    price_typecode = 'd'
+
     def __init__(self):
         """
-        Orders stored as two default dicts of {price:[orders at price]}
-        Orders sent to OrderBook through OrderBook.unprocessed_orders queue
+        Orders stored as two dicts of {price:PriceLevel}, each indexed by a PriceLevelIndex for best price
+        Resting orders are also indexed by id in OrderBook.orders for cancel/amend
+        Level changes are published as (side, price, size, count) to the callbacks in OrderBook.subscribers
+        With aggregate_fills set, a level swept entirely by an incoming order produces one trade instead of one per order
+        With latency set to a LatencyRecorder (ORDERBOOK_LATENCY=1, or enable_latency()) process_order is timed
+        Stop orders wait in their own trigger-price heaps (buy_stops, sell_stops) until a trade prints at or through
+        their stop price. Orders with the same trader_id never trade with each other: self_trade_prevention is
+        'cancel_resting', 'cancel_incoming' or 'cancel_both'
+        Orders sent to OrderBook through OrderBook.unprocessed_orders queue, or in bulk through process_orders
         """
         self.bid_prices = []
         self.bid_sizes = []
         self.offer_prices = []
         self.offer_sizes = []
-        self.bids = defaultdict(list)
-        self.offers = defaultdict(list)
+        self.bids = {}
+        self.offers = {}
+        self.bid_index = PriceLevelIndex(self.bids, descending=True)
+        self.offer_index = PriceLevelIndex(self.offers, descending=False)
+        self.orders = {}
         self.unprocessed_orders = queue.Queue()
         self.trades = queue.Queue()
+        self.trade_buffer = None
+        self.aggregate_fills = False
+        self.subscribers = []
+        self.depth_buffers = None
+        self.latency = LatencyRecorder() if os.environ.get('ORDERBOOK_LATENCY', '0') not in ('', '0') else None
+        self.swept_levels = 0
+        self.stop_orders = {}
+        self.buy_stops = []
+        self.sell_stops = []
+        self.buy_stop_trigger = float('inf')
+        self.sell_stop_trigger = float('-inf')
+        self.last_trade_price = None
+        self.triggering = False
+        self.self_trade_prevention = 'cancel_resting'
         self.order_id = 0
 
+    def enable_latency(self, recorder=None):
+        """ Start timing process_order, into recorder or a new LatencyRecorder; returns the recorder """
+        self.latency = recorder if recorder is not None else LatencyRecorder()
+        return self.latency
+
+    def disable_latency(self):
+        """ Stop timing process_order; returns the recorder that was in use """
+        latency, self.latency = self.latency, None
+        return latency
+
     def new_order_id(self):
         self.order_id += 1
         return self.order_id
 
     @property
     def max_bid(self):
-        if self.bids:
-            return max(self.bids.keys())
-        else:
+        price = self.bid_index.best()
+        if price is None:
             return 0.
+        return price
+
     @property
     def min_offer(self):
-        if self.offers:
-            return min(self.offers.keys())
-        else:
+        price = self.offer_index.best()
+        if price is None:
             return float('inf')
+        return price
+
+    def add_to_book(self, order):
+        """ Rest an order at the back of its price level, opening and indexing the level if needed."""
+        if order.side == BUY:
+            levels, index = self.bids, self.bid_index
+        else:
+            levels, index = self.offers, self.offer_index
+        level = levels.get(order.price)
+        if level is None:
+            level = levels[order.price] = PriceLevel(order.price)
+            index.add(order.price)
+        level.append(order)
+        self.orders[order.order_id] = order
+        if self.subscribers:
+            self.publish_level(order.side, level)
+
+    def remove_from_book(self, order):
+        """ Unlink a resting order from its price level, closing the level if it becomes empty."""
+        if order.side == BUY:
+            levels, index = self.bids, self.bid_index
+        else:
+            levels, index = self.offers, self.offer_index
+        level = levels[order.price]
+        level.remove(order)
+        del self.orders[order.order_id]
+        if len(level) == 0:
+            levels.pop(order.price)
+            index.discard(order.price)
+        if self.subscribers:
+            self.publish_level(order.side, level)
+
+    def cancel_order(self, order_id):
+        """ Remove a resting or stop order. Returns the cancelled order, or None if it is no longer in the book."""
+        order = self.orders.get(order_id)
+        if order is None:
+            # a cancelled stop order stays in its trigger heap until it surfaces or the heaps are rebuilt
+            order = self.stop_orders.pop(order_id, None)
+            if order is not None and len(self.buy_stops) + len(self.sell_stops) > 2 * len(self.stop_orders) + 64:
+                self.buy_stops = [entry for entry in self.buy_stops if entry[1] in self.stop_orders]
+                self.sell_stops = [entry for entry in self.sell_stops if entry[1] in self.stop_orders]
+                heapq.heapify(self.buy_stops)
+                heapq.heapify(self.sell_stops)
+                self.set_stop_triggers()
+            return order
+        self.remove_from_book(order)
+        return order
+
+    def amend_order(self, order_id, new_size):
+        """
+        Change the size of a resting order. Reducing the size keeps time priority, increasing it sends the order to
+        the back of its price level and a size of zero cancels it. Returns the order, or None if it is not in the book.
+        """
+        order = self.orders.get(order_id)
+        if order is None:
+            return None
+        if new_size <= 0:
+            self.remove_from_book(order)
+            order.size = 0
+        elif new_size <= order.size:
+            levels = self.bids if order.side == BUY else self.offers
+            level = levels[order.price]
+            level.size -= order.size - new_size
+            order.size = new_size
+            if self.subscribers:
+                self.publish_level(order.side, level)
+        else:
+            self.remove_from_book(order)
+            order.size = new_size
+            order.timestamp = get_timestamp()
+            self.add_to_book(order)
+        return order
 
     def process_order(self, incoming_order):
         """ Main processing function. If incoming_order matches delegate to process_match."""
+        latency = self.latency
+        if latency is not None:
+            size, swept_levels = incoming_order.size, self.swept_levels
+            start = time.perf_counter_ns()
         incoming_order.timestamp = get_timestamp()
         incoming_order.order_id = self.new_order_id()
-        if incoming_order.side == Side.BUY:
+        if incoming_order.special:
+            self.process_special_order(incoming_order)
+        elif incoming_order.side == BUY:
             if incoming_order.price >= self.min_offer and self.offers:
                 self.process_match(incoming_order)
             else:
-                self.bids[incoming_order.price].append(incoming_order)
+                self.add_to_book(incoming_order)
         else:
             if incoming_order.price <= self.max_bid and self.bids:
                 self.process_match(incoming_order)
             else:
-                self.offers[incoming_order.price].append(incoming_order)
+                self.add_to_book(incoming_order)
+        if latency is not None:
+            elapsed = time.perf_counter_ns() - start
+            if self.swept_levels != swept_levels:
+                latency.record('sweep', elapsed)
+            elif incoming_order.size != size:
+                latency.record('match', elapsed)
+            else:
+                latency.record('rest', elapsed)
+
+    def process_special_order(self, incoming_order):
+        """ process_order for stop orders, iceberg orders and the IOC, FOK and post-only times in force """
+        if isinstance(incoming_order, StopOrder):
+            stop_price = incoming_order.stop_price
+            self.stop_orders[incoming_order.order_id] = incoming_order
+            # set_stop_triggers(), reduced to the pushed stop becoming the top of its heap
+            if incoming_order.side == BUY:
+                heapq.heappush(self.buy_stops, (stop_price, incoming_order.order_id))
+                if stop_price < self.buy_stop_trigger:
+                    self.buy_stop_trigger = stop_price
+            else:
+                heapq.heappush(self.sell_stops, (-stop_price, incoming_order.order_id))
+                if stop_price > self.sell_stop_trigger:
+                    self.sell_stop_trigger = stop_price
+            if self.stops_reached():
+                self.trigger_stops()
+            return
+        time_in_force = incoming_order.time_in_force
+        # whether the order would trade on entry
+        if incoming_order.side == BUY:
+            best = self.offer_index.best()
+            crosses = best is not None and incoming_order.price >= best
+        else:
+            best = self.bid_index.best()
+            crosses = best is not None and incoming_order.price <= best
+        if crosses:
+            if time_in_force is POST_ONLY:
+                return
+            if time_in_force is FOK and not self.can_fill(incoming_order):
+                return
+            self.process_match(incoming_order, rest=False, trigger=False)
+        if incoming_order.size > 0 and (time_in_force is GTC or time_in_force is POST_ONLY):
+            if incoming_order.display_size is not None:
+                incoming_order.hidden_size = max(0, incoming_order.size - incoming_order.display_size)
+                incoming_order.size -= incoming_order.hidden_size
+            self.add_to_book(incoming_order)
+        # as after process_match resting a remainder itself, the stops reached by the trades only enter now, against
+        # a book that holds the remainder
+        if crosses and self.stops_reached():
+            self.trigger_stops()
+
+    def can_fill(self, order):
+        """
+        Whether order can be filled completely on entry. Sums the aggregated visible and hidden size of the levels at
+        acceptable prices, best first: O(levels). Orders of the same trader are skipped, which costs a walk through
+        the orders of those levels. If self-trade prevention would cancel the incoming order, the match stops at the
+        first of them: only the visible size queued ahead of it can be reached, since the next tranche of an iceberg
+        order is shown at the back of the level, behind it. The walk over the levels is only started when the best
+        level is not enough.
+        """
+        buying = order.side == BUY
+        if buying:
+            levels, index = self.offers, self.offer_index
+        else:
+            levels, index = self.bids, self.bid_index
+        needed = order.size
+        trader_id = order.trader_id
+        prices = None
+        price = index.best()
+        while price is not None:
+            if order.price < price if buying else order.price > price:
+                return False
+            level = levels[price]
+            if trader_id is None:
+                needed -= level.size + level.hidden
+            else:
+                visible = hidden = 0
+                book_order = level.head
+                while book_order is not None:
+                    if book_order.trader_id != trader_id:
+                        visible += book_order.size
+                        hidden += book_order.hidden_size
+                        if visible >= needed:
+                            return True
+                    elif self.self_trade_prevention != 'cancel_resting':
+                        return False
+                    book_order = book_order.next_order
+                needed -= visible + hidden
+            if needed <= 0:
+                return True
+            if prices is None:
+                prices = index.walk()
+                next(prices)
+            price = next(prices, None)
+        return False
+
+    def set_stop_triggers(self):
+        """ Cache the stop prices at the top of the trigger heaps, +inf/-inf when empty, for process_match """
+        self.buy_stop_trigger = self.buy_stops[0][0] if self.buy_stops else float('inf')
+        self.sell_stop_trigger = -self.sell_stops[0][0] if self.sell_stops else float('-inf')
+
+    def stops_reached(self):
+        """ Whether the last trade price has reached the top of a trigger heap that holds stops: O(1) """
+        last = self.last_trade_price
+        return last is not None and ((self.buy_stops and last >= self.buy_stop_trigger) or
+                                     (self.sell_stops and last <= self.sell_stop_trigger))
+
+    def trigger_stops(self):
+        """
+        Enter the stop orders reached by the last trade price as market or limit orders, until no more are reached.
+        Orders entered this way can trade and trigger further stops, which are picked up by the same loop.
+        """
+        if self.triggering:
+            return
+        self.triggering = True
+        try:
+            stop_orders = self.stop_orders
+            # stops_reached(), inlined: only called once a trade has printed, so last_trade_price is set
+            while True:
+                last = self.last_trade_price
+                if self.buy_stops and last >= self.buy_stop_trigger:
+                    heap = self.buy_stops
+                elif self.sell_stops and last <= self.sell_stop_trigger:
+                    heap = self.sell_stops
+                else:
+                    break
+                # cancelled stops are only dropped from the heap here
+                stop = stop_orders.pop(heapq.heappop(heap)[1], None)
+                self.set_stop_triggers()
+                if stop is not None:
+                    self.process_order(stop.activate())
+        finally:
+            self.triggering = False
 
-    def process_match(self, incoming_order):
-        """ Match an incoming order against orders on the other side of the book, in price-time priority."""
-        levels = self.bids if incoming_order.side == Side.SELL else self.offers
-        prices = sorted(levels.keys(), reverse=(incoming_order.side == Side.SELL))
+    def replenish(self, order, level):
+        """ Show the next tranche of an iceberg order whose visible size has been filled, at the back of its level """
+        tranche = min(order.display_size, order.hidden_size)
+        order.hidden_size -= tranche
+        order.size = tranche
+        order.timestamp = get_timestamp()
+        level.append(order)
+
+    def process_match(self, incoming_order, rest=True, trigger=True):
+        """
+        Match an incoming order against orders on the other side of the book, in price-time priority.
+        The unfilled remainder is added to the book unless rest is False. Stops reached by the trades are then
+        triggered unless trigger is False, for a caller that rests the remainder itself and triggers them afterwards.
+        """
+        if incoming_order.side == SELL:
+            levels, index = self.bids, self.bid_index
+        else:
+            levels, index = self.offers, self.offer_index
+        buying = incoming_order.side == BUY
 
         def price_doesnt_match(book_price):
-            if incoming_order.side == Side.BUY:
+            if buying:
                 return incoming_order.price < book_price
             else:
                 return incoming_order.price > book_price
 
-        for (i, price) in enumerate(prices):
-            if (incoming_order.size == 0) or (price_doesnt_match(price)):
+        trader_id = incoming_order.trader_id
+        stp = trader_id is not None
+        # sweeping a level cancels the incoming trader's own orders in it, which is only right for 'cancel_resting'
+        stp_blocks_sweep = stp and self.self_trade_prevention != 'cancel_resting'
+        traded_price = None
+        while incoming_order.size > 0:
+            price = index.best()
+            if price is None or price_doesnt_match(price):
                 break
-            orders_at_level = levels[price]
-            for (j, book_order) in enumerate(orders_at_level):
-                if incoming_order.size == 0:
-                    break
-                trade = self.execute_match(incoming_order, book_order)
-                incoming_order.size = max(0, incoming_order.size - trade.size)
-                book_order.size = max(0, book_order.size - trade.size)
-                self.trades.put(trade)
-            levels[price] = [o for o in orders_at_level if o.size > 0]
-            if len(levels[price]) == 0:
+            level = levels[price]
+            if incoming_order.size >= level.size and not level.hidden and not stp_blocks_sweep:
+                # the whole level is consumed: take it out of the book in one go
+                if self.sweep_level(incoming_order, level):
+                    traded_price = price
+                self.swept_levels += 1
+                levels.pop(price)
+                index.discard(price)
+                if self.subscribers:
+                    self.publish_level(SELL if incoming_order.side == BUY else BUY, level)
+                continue
+            while incoming_order.size > 0 and level.head is not None:
+                book_order = level.head
+                if stp and book_order.trader_id == trader_id:
+                    if self.self_trade_prevention != 'cancel_incoming':
+                        level.remove(book_order)
+                        del self.orders[book_order.order_id]
+                    if self.self_trade_prevention != 'cancel_resting':
+                        incoming_order.size = 0
+                    continue
+                if self.trade_buffer is None:
+                    trade = self.execute_match(incoming_order, book_order)
+                    trade_size = trade.size
+                    self.trades.put(trade)
+                else:
+                    trade_size = min(incoming_order.size, book_order.size)
+                    self.trade_buffer.append(incoming_order.side, book_order.price, trade_size,
+                                             incoming_order.order_id, book_order.order_id)
+                incoming_order.size = max(0, incoming_order.size - trade_size)
+                book_order.size = max(0, book_order.size - trade_size)
+                level.size -= trade_size
+                traded_price = price
+                if book_order.size == 0:
+                    level.remove(book_order)
+                    if book_order.hidden_size:
+                        self.replenish(book_order, level)
+                    else:
+                        del self.orders[book_order.order_id]
+            if len(level) == 0:
                 levels.pop(price)
+                index.discard(price)
+            if self.subscribers:
+                self.publish_level(SELL if incoming_order.side == BUY else BUY, level)
 
         # If the incoming order has not been completely matched, add the remainder to the order book
-        if incoming_order.size > 0:
-            same_side = self.bids if incoming_order.side == Side.BUY else self.offers
-            same_side[incoming_order.price].append(incoming_order)
+        if rest and incoming_order.size > 0:
+            self.add_to_book(incoming_order)
+        # a trade with the remainder of a market order resting at +inf prints no price for the stops
+        if traded_price is not None and -INFINITY < traded_price < INFINITY:
+            self.last_trade_price = traded_price
+            # stops_reached(), inlined
+            if trigger and ((self.buy_stops and traded_price >= self.buy_stop_trigger) or
+                            (self.sell_stops and traded_price <= self.sell_stop_trigger)):
+                self.trigger_stops()
+
+    def sweep_level(self, incoming_order, level):
+        """
+        Fill incoming_order against every order of a level whose total size it covers, emitting one trade per
+        resting order or, with aggregate_fills, a single trade for the level with book_order_id 0. Resting orders of
+        the incoming order's trader are cancelled instead of filled. The level is left empty; the caller removes it
+        from the book. Returns the size filled.
+        """
+        orders = self.orders
+        buffer = self.trade_buffer
+        aggregate_fills = self.aggregate_fills
+        trader_id = incoming_order.trader_id
+        filled = level.size
+        book_order = level.head
+        while book_order is not None:
+            if trader_id is not None and book_order.trader_id == trader_id:
+                filled -= book_order.size
+            elif not aggregate_fills and book_order.size > 0:
+                if buffer is None:
+                    self.trades.put(self.execute_match(incoming_order, book_order))
+                else:
+                    buffer.append(incoming_order.side, book_order.price, book_order.size, incoming_order.order_id,
+                                  book_order.order_id)
+            del orders[book_order.order_id]
+            next_order = book_order.next_order
+            book_order.size = 0
+            book_order.prev_order = None
+            book_order.next_order = None
+            book_order = next_order
+        if aggregate_fills and filled > 0:
+            if buffer is None:
+                self.trades.put(Trade(incoming_order.side, self.to_price(level.price), filled,
+                                      incoming_order.order_id, 0))
+            else:
+                buffer.append(incoming_order.side, level.price, filled, incoming_order.order_id, 0)
+        incoming_order.size -= filled
+        level.head = None
+        level.tail = None
+        level.count = 0
+        level.size = 0
+        return filled
+
+    def process_orders(self, sides, prices, sizes):
+        """
+        Process a batch of orders given as arrays of side (Side values, BUY=0/SELL=1), price (NaN for a market order)
+        and size, bypassing the unprocessed_orders and trades queues. Orders get consecutive ids starting at
+        order_id + 1. Returns the trades of the whole batch as a TRADE_DTYPE structured array.
+        A ValueError raised by an order part way through the batch (e.g. a price beyond a TickOrderBook's tick window)
+        leaves the orders before it processed; the error carries their trades as error.trades and their number as
+        error.processed.
+        """
+        sides = np.asarray(sides, dtype=np.int8)
+        prices = np.asarray(prices, dtype=np.float64)
+        sizes = np.asarray(sizes, dtype=np.int64)
+        is_market = np.isnan(prices)
+        book_prices = self.batch_prices(sides, prices, is_market)
+        buffer = TradeBuffer(self.price_typecode)
+        self.trade_buffer = buffer
+        buy, sell = Side.BUY, Side.SELL
+        processed = 0
+        try:
+            for side, price, size, market in zip(sides.tolist(), book_prices, sizes.tolist(), is_market.tolist()):
+                side = buy if side == 0 else sell
+                order = MarketOrder(side, size) if market else PlainLimitOrder(side, price, size)
+                order.price = price
+                # prices are already in book units, so skip any per-order conversion done by a subclass
+                OrderBook.process_order(self, order)
+                processed += 1
+        except ValueError as error:
+            error.trades = buffer.to_array(self.trade_price_scale())
+            error.processed = processed
+            raise
+        finally:
+            self.trade_buffer = None
+        return buffer.to_array(self.trade_price_scale())
+
+    def batch_prices(self, sides, prices, is_market):
+        """ Book prices of a batch as a list, market orders at +inf (buy) or 0 (sell) like MarketOrder """
+        return np.where(is_market, np.where(sides == Side.BUY.value, float('inf'), 0.), prices).tolist()
+
+    def trade_price_scale(self):
+        """ Factor converting book prices of buffered trades to output prices """
+        return None
 
     def execute_match(self, incoming_order, book_order):
         trade_size = min(incoming_order.size, book_order.size)
         return Trade(incoming_order.side, book_order.price, trade_size, incoming_order.order_id, book_order.order_id)
 
+    def to_price(self, price):
+        """ Output price of a book price """
+        return price
+
+    def subscribe(self, callback):
+        """ Call callback(side, price, size, count) on every level-2 change; size 0 means the level was removed """
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def publish_level(self, side, level):
+        price = self.to_price(level.price)
+        for callback in self.subscribers:
+            callback(side, price, level.size, level.count)
+
+    def depth(self, n):
+        """
+        Top n levels per side as (prices, sizes, counts) arrays of shape (2, n), row 0 bids and row 1 offers, best
+        first. Missing levels have price NaN and size/count 0. The arrays are preallocated and reused by the next
+        call, so copy them to keep a snapshot.
+        """
+        if self.depth_buffers is None or self.depth_buffers[0].shape[1] != n:
+            self.depth_buffers = (np.empty((2, n)), np.empty((2, n), dtype=np.int64), np.empty((2, n), dtype=np.int64))
+        prices, sizes, counts = self.depth_buffers
+        prices.fill(np.nan)
+        sizes.fill(0)
+        counts.fill(0)
+        for row, (levels, index) in enumerate([(self.bids, self.bid_index), (self.offers, self.offer_index)]):
+            for i, price in enumerate(index.top(n)):
+                level = levels[price]
+                prices[row, i] = self.to_price(price)
+                sizes[row, i] = level.size
+                counts[row, i] = level.count
+        return prices, sizes, counts
+
     def book_summary(self):
         self.bid_prices = sorted(self.bids.keys(), reverse=True)
         self.offer_prices = sorted(self.offers.keys())
-        self.bid_sizes = [sum(o.size for o in self.bids[p]) for p in self.bid_prices]
-        self.offer_sizes = [sum(o.size for o in self.offers[p]) for p in self.offer_prices]
+        self.bid_sizes = [self.bids[p].size for p in self.bid_prices]
+        self.offer_sizes = [self.offers[p].size for p in self.offer_prices]
 
     def show_book(self):
         self.book_summary()
@@ -128,22 +717,87 @@ class OrderBook(object):
         print()
 
 
-class LimitOrder(object):
+class PlainLimitOrder(object):
+    """
+    GTC limit order without trader id or display size, as made by LimitOrder. It holds only the seven slots it uses,
+    and shares the order-type attributes of TypedLimitOrder as class attributes, so that the millions of orders
+    resting in a book stay small
+    """
+    __slots__ = ('side', 'size', 'price', 'timestamp', 'order_id', 'prev_order', 'next_order')
+    time_in_force = TimeInForce.GTC
+    trader_id = None
+    display_size = None
+    hidden_size = 0
+    special = False
+
     def __init__(self,side,price,size,timestamp=None,order_id=None):
         self.side = side
         self.size = size
         self.price = price
         self.timestamp = timestamp
         self.order_id = order_id
+        self.prev_order = None
+        self.next_order = None
+    def __repr__(self):
+        return '{0} {1} units at {2}'.format(self.side, self.size, self.price)
+
+class TypedLimitOrder(object):
+    """ Limit order with a time in force, trader id or display size, as made by LimitOrder and IcebergOrder """
+    __slots__ = ('side', 'size', 'price', 'timestamp', 'order_id', 'prev_order', 'next_order', 'time_in_force',
+                 'trader_id', 'special', 'display_size', 'hidden_size')
+
+    def __init__(self,side,price,size,timestamp=None,order_id=None,time_in_force=TimeInForce.GTC,trader_id=None,
+                 display_size=None):
+        self.side = side
+        self.size = size
+        self.price = price
+        self.timestamp = timestamp
+        self.order_id = order_id
+        self.prev_order = None
+        self.next_order = None
+        self.time_in_force = time_in_force
+        self.trader_id = trader_id
+        self.display_size = display_size
+        self.hidden_size = 0
+        # whether process_order hands the order to process_special_order, decided once here
+        self.special = time_in_force is not GTC or display_size is not None
     def __repr__(self):
+        if self.display_size is not None:
+            return '{0} {1}+{2} hidden units at {3}'.format(self.side, self.size, self.hidden_size, self.price)
         return '{0} {1} units at {2}'.format(self.side, self.size, self.price)
 
+def LimitOrder(side,price,size,timestamp=None,order_id=None,time_in_force=TimeInForce.GTC,trader_id=None,
+               display_size=None):
+    """ A PlainLimitOrder, or a TypedLimitOrder if any of time_in_force, trader_id and display_size is set """
+    if time_in_force is GTC and trader_id is None and display_size is None:
+        return PlainLimitOrder(side, price, size, timestamp, order_id)
+    return TypedLimitOrder(side, price, size, timestamp, order_id, time_in_force, trader_id, display_size)
+
+def IcebergOrder(side,price,size,display_size,timestamp=None,order_id=None,time_in_force=TimeInForce.GTC,
+                 trader_id=None):
+    """
+    Limit order showing at most display_size units at a time. While resting, size is the visible tranche and
+    hidden_size the reserve; each time the tranche is filled the next one is shown at the back of the level.
+    Built as a TypedLimitOrder with display_size set, so that all typed resting orders share one class and the
+    attribute lookups in the match loop stay specialised.
+    """
+    return TypedLimitOrder(side, price, size, timestamp, order_id, time_in_force, trader_id, display_size)
+
 class MarketOrder(object):
-    def __init__(self,side,size,timestamp=None,order_id=None):
+    __slots__ = ('side', 'size', 'price', 'timestamp', 'order_id', 'prev_order', 'next_order', 'time_in_force',
+                 'trader_id', 'special')
+    hidden_size = 0
+
+    def __init__(self,side,size,timestamp=None,order_id=None,time_in_force=TimeInForce.GTC,trader_id=None):
         self.side = side
         self.size = size
         self.timestamp = timestamp
         self.order_id = order_id
+        self.prev_order = None
+        self.next_order = None
+        self.time_in_force = time_in_force
+        self.trader_id = trader_id
+        self.special = time_in_force is not GTC
         if side == Side.BUY:
             self.price = float('inf')
         else:
@@ -151,7 +805,38 @@ class MarketOrder(object):
     def __repr__(self):
         return '{0} {1} units at {2}'.format(self.side, self.size, 'MarketPrice')
 
+class StopOrder(object):
+    """
+    Stop order (price None) or stop-limit order. Held in the book's stop index until a trade prints at or above
+    stop_price (buy) or at or below it (sell), then entered as a market or limit order with a new order id.
+    """
+    __slots__ = ('side', 'size', 'price', 'stop_price', 'timestamp', 'order_id', 'time_in_force', 'trader_id',
+                 'special')
+
+    def __init__(self, side, stop_price, size, price=None, timestamp=None, order_id=None,
+                 time_in_force=TimeInForce.GTC, trader_id=None):
+        self.side = side
+        self.size = size
+        self.price = price
+        self.stop_price = stop_price
+        self.timestamp = timestamp
+        self.order_id = order_id
+        self.time_in_force = time_in_force
+        self.trader_id = trader_id
+        self.special = True
+
+    def activate(self):
+        if self.price is None:
+            return MarketOrder(self.side, self.size, None, None, self.time_in_force, self.trader_id)
+        return LimitOrder(self.side, self.price, self.size, None, None, self.time_in_force, self.trader_id)
+
+    def __repr__(self):
+        return '{0} {1} units at {2} on stop {3}'.format(self.side, self.size, self.price or 'MarketPrice',
+                                                         self.stop_price)
+
 class Trade(object):
+    __slots__ = ('side', 'price', 'size', 'incoming_order_id', 'book_order_id')
+
     def __init__(self, incoming_side, incoming_price, trade_size, incoming_order_id, book_order_id):
         self.side = incoming_side
         self.price = incoming_price
@@ -202,7 +887,7 @@ if __name__ == '__main__':
     SideS=Side(int(Sides))
     Quant = int(input('How many stocks you want to trade?'))
     if Type == 'Limit':
-        price =input('Cool, whats the price?')
+        price = float(input('Cool, whats the price?'))
         offer_order = LimitOrder(SideS, price, Quant)
     elif Type == 'Market':
         offer_order = MarketOrder(SideS, Quant)
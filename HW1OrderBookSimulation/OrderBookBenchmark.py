@@ -0,0 +1,350 @@
+'''
+Benchmark for OrderBook. Replays a stream of mixed limit and market orders against books that start 10, 1,000 and
+100,000 price levels deep on each side and reports the throughput of process_order, then replays a cancel-heavy
+flow (90% cancels of random resting orders, 10% new passive orders) against the same depths. Both the float-price
+OrderBook and the integer-tick TickOrderBook are measured, order by order through process_order and in one batch
+through process_orders. Another table times large market orders sweeping 20 levels of 5 orders each, with one trade
+per resting order and with fills aggregated per level. The last one replays the first flow again with IOC, FOK,
+post-only, iceberg and stop orders mixed in and self-trade prevention on, next to the same flow of plain orders,
+as best-of-5 lockstep replays, and reports the typed/plain throughput ratio (budget: at least 0.9). Being best-of
+per segment, that ratio leaves out the slow runs of either flow, so the table also gives the ratio of the median
+whole-run times of the two flows. Before timing
+anything, the order-type paths are checked against cases that used to break them.
+Usage: python OrderBookBenchmark.py [number_of_orders] [depth ...]
+'''
+
+import gc
+import random
+import sys
+import time
+
+import numpy as np
+
+from OrderBook import OrderBook, LimitOrder, IcebergOrder, MarketOrder, StopOrder, Side, TimeInForce
+from TickOrderBook import TickOrderBook
+
+MID = 100.0
+TICK = 0.01
+BOOKS = [('float', OrderBook), ('tick', lambda: TickOrderBook(TICK))]
+# orders of the plain/typed comparison, which replays both flows several times
+TYPED_ORDERS = 100000
+
+
+def price_at(ticks):
+    return round(MID + ticks * TICK, 2)
+
+
+def build_book(depth, book_factory=OrderBook, seed=0):
+    """ Book with one resting order on each of depth levels per side """
+    rng = random.Random(seed)
+    ob = book_factory()
+    for k in range(1, depth + 1):
+        ob.process_order(LimitOrder(Side.BUY, price_at(-k), rng.randint(5, 50)))
+        ob.process_order(LimitOrder(Side.SELL, price_at(k), rng.randint(5, 50)))
+    return ob
+
+
+def generate_orders(number_of_orders, depth, seed=1):
+    """
+    70% passive limit orders near the top of the book, 20% aggressive limit orders crossing a few ticks and
+    10% market orders, all with small sizes so that the book keeps its depth during the replay
+    """
+    rng = random.Random(seed)
+    near = min(depth, 50)
+    orders = []
+    for _ in range(number_of_orders):
+        side = Side.BUY if rng.random() < 0.5 else Side.SELL
+        sign = 1 if side == Side.BUY else -1
+        size = rng.randint(1, 10)
+        u = rng.random()
+        if u < 0.7:
+            orders.append((side, price_at(-sign * rng.randint(1, near)), size))
+        elif u < 0.9:
+            orders.append((side, price_at(sign * rng.randint(0, 5)), size))
+        else:
+            orders.append((side, None, size))
+    return orders
+
+
+def replay(ob, orders):
+    start = time.perf_counter()
+    for side, price, size in orders:
+        if price is None:
+            ob.process_order(MarketOrder(side, size))
+        else:
+            ob.process_order(LimitOrder(side, price, size))
+    return time.perf_counter() - start
+
+
+def typed_orders(orders, mix, seed=3, number_of_traders=100, stop_share=0.02):
+    """
+    (order class, constructor arguments) for each order of generate_orders. With mix set, each order keeps its side,
+    price and size and takes a type: stop_share of all orders are held as stop (market orders) or stop-limit orders
+    a few ticks away, entering the same order when triggered, and of the others passive orders are 10% post-only and
+    5% icebergs showing half their size, aggressive limit orders 20% IOC and 10% FOK. Every order carries one of
+    number_of_traders trader ids so that self-trade prevention is checked on every match. The typed flow therefore
+    differs from the plain one by the order types alone, not by more volume or more aggressive orders. A triggered
+    stop is processed twice, once held and once entered, so it costs about two plain orders
+    """
+    rng = random.Random(seed)
+    gtc = TimeInForce.GTC
+    typed = []
+    for side, price, size in orders:
+        sign = 1 if side == Side.BUY else -1
+        if not mix:
+            if price is None:
+                typed.append((MarketOrder, (side, size)))
+            else:
+                typed.append((LimitOrder, (side, price, size)))
+            continue
+        trader_id = rng.randrange(number_of_traders)
+        u = rng.random()
+        if rng.random() < stop_share:
+            stop_price = price_at(sign * rng.randint(1, 10))
+            typed.append((StopOrder, (side, stop_price, size, price, None, None, gtc, trader_id)))
+        elif price is None:
+            typed.append((MarketOrder, (side, size, None, None, gtc, trader_id)))
+        elif sign * (price - MID) < 0:
+            if u < 0.1:
+                typed.append((LimitOrder, (side, price, size, None, None, TimeInForce.POST_ONLY, trader_id)))
+            elif u < 0.15:
+                typed.append((IcebergOrder, (side, price, size, (size + 1) // 2, None, None, gtc, trader_id)))
+            else:
+                typed.append((LimitOrder, (side, price, size, None, None, gtc, trader_id)))
+        else:
+            time_in_force = TimeInForce.IOC if u < 0.2 else TimeInForce.FOK if u < 0.3 else gtc
+            typed.append((LimitOrder, (side, price, size, None, None, time_in_force, trader_id)))
+    return typed
+
+
+def replay_typed(ob, orders):
+    start = time.perf_counter()
+    for order_class, arguments in orders:
+        ob.process_order(order_class(*arguments))
+    return time.perf_counter() - start
+
+
+def compare_flows(orders, depth, book_factory=OrderBook, repeats=5, segment=1000):
+    """
+    Best-of-repeats seconds of the plain and typed flows of orders, each replayed on its own book. The flows are
+    replayed in lockstep, segment orders of one then the same segment of the other, and the best time of each
+    segment is kept, so that both see the same machine load and the ratio is reproducible on a noisy machine.
+    """
+    flows = [typed_orders(orders, False), typed_orders(orders, True)]
+    best = [[float('inf')] * ((len(orders) + segment - 1) // segment) for _ in flows]
+    for _ in range(repeats):
+        books = [build_book(depth, book_factory) for _ in flows]
+        gc.collect()
+        gc.disable()
+        try:
+            for s, i in enumerate(range(0, len(orders), segment)):
+                for flow, ob, times in zip(flows, books, best):
+                    times[s] = min(times[s], replay_typed(ob, flow[i:i + segment]))
+        finally:
+            gc.enable()
+    return sum(best[0]), sum(best[1])
+
+
+def compare_whole_flows(orders, depth, book_factory=OrderBook, repeats=5):
+    """
+    Median seconds of whole replays of the plain and typed flows of orders, each on a new book, the two flows taking
+    turns to go first. Without compare_flows' best-of per segment, this is the ratio a whole replay sees
+    """
+    flows = [typed_orders(orders, False), typed_orders(orders, True)]
+    times = [[], []]
+    for r in range(repeats):
+        for f in ((0, 1) if r % 2 == 0 else (1, 0)):
+            ob = build_book(depth, book_factory)
+            gc.collect()
+            times[f].append(replay_typed(ob, flows[f]))
+    return float(np.median(times[0])), float(np.median(times[1]))
+
+
+def replay_batch(ob, orders):
+    sides = np.array([side.value for side, price, size in orders], dtype=np.int8)
+    prices = np.array([np.nan if price is None else price for side, price, size in orders])
+    sizes = np.array([size for side, price, size in orders], dtype=np.int64)
+    start = time.perf_counter()
+    ob.process_orders(sides, prices, sizes)
+    return time.perf_counter() - start
+
+
+def replay_cancels(ob, number_of_messages, depth, seed=2):
+    rng = random.Random(seed)
+    near = min(depth, 50)
+    resting = list(ob.orders)
+    start = time.perf_counter()
+    for _ in range(number_of_messages):
+        if resting and rng.random() < 0.9:
+            i = rng.randrange(len(resting))
+            resting[i], resting[-1] = resting[-1], resting[i]
+            ob.cancel_order(resting.pop())
+        else:
+            side = Side.BUY if rng.random() < 0.5 else Side.SELL
+            sign = 1 if side == Side.BUY else -1
+            order = LimitOrder(side, price_at(-sign * rng.randint(1, near)), rng.randint(1, 10))
+            ob.process_order(order)
+            if order.order_id in ob.orders:
+                resting.append(order.order_id)
+    return time.perf_counter() - start
+
+
+def replay_sweeps(ob, number_of_orders, levels_swept=20, orders_per_level=5):
+    """ Rounds of levels_swept * orders_per_level resting offers followed by one market buy that takes them all """
+    rounds = number_of_orders // (levels_swept * orders_per_level + 1)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for k in range(1, levels_swept + 1):
+            price = price_at(k)
+            for _ in range(orders_per_level):
+                ob.process_order(LimitOrder(Side.SELL, price, 10))
+        ob.process_order(MarketOrder(Side.BUY, 10 * levels_swept * orders_per_level))
+        while not ob.trades.empty():
+            ob.trades.get()
+    return time.perf_counter() - start, rounds
+
+
+def check_market_remainder_stops():
+    """
+    A market buy against an empty offer side rests at +inf, and a sell trading with it prints at +inf. That trade must
+    neither trigger stops nor pop an empty trigger heap (it used to raise IndexError), in either book, with no stops
+    held, with stops held on both sides and with a stop-market order whose remainder is the one resting at +inf
+    """
+    for name, book_factory in BOOKS:
+        ob = book_factory()
+        ob.process_order(MarketOrder(Side.BUY, 5))
+        ob.process_order(LimitOrder(Side.SELL, MID, 2))
+        assert ob.last_trade_price is None, name
+        ob.process_order(StopOrder(Side.BUY, MID + TICK, 1))
+        ob.process_order(StopOrder(Side.SELL, MID - TICK, 1))
+        ob.process_order(LimitOrder(Side.SELL, MID, 2))
+        assert len(ob.stop_orders) == 2, name
+        ob = book_factory()
+        ob.process_order(LimitOrder(Side.SELL, MID + TICK, 1))
+        ob.process_order(StopOrder(Side.BUY, MID, 3))
+        ob.process_order(LimitOrder(Side.BUY, MID + TICK, 1))
+        ob.process_order(LimitOrder(Side.SELL, MID, 2))
+        assert not ob.stop_orders and ob.last_trade_price is not None, name
+    print('Market order remainders: no stops triggered at +inf')
+
+
+def check_fill_or_kill(number_of_orders=2000, seed=5):
+    """
+    FOK orders fill completely or not at all under every self-trade prevention mode, in either book. In particular
+    when the trader's own order rests behind another trader's iceberg order: the iceberg's next tranche is shown
+    behind the own order, out of reach of an incoming order that self-trade prevention cancels at the own order
+    """
+    gtc, fok = TimeInForce.GTC, TimeInForce.FOK
+    for name, book_factory in BOOKS:
+        for self_trade_prevention in ('cancel_resting', 'cancel_incoming', 'cancel_both'):
+            ob = book_factory()
+            ob.self_trade_prevention = self_trade_prevention
+            ob.process_order(IcebergOrder(Side.SELL, MID, 10, 2, None, None, gtc, 2))
+            ob.process_order(LimitOrder(Side.SELL, MID, 5, None, None, gtc, 1))
+            order = LimitOrder(Side.BUY, MID, 6, None, None, fok, 1)
+            ob.process_order(order)
+            filled = sum(trade.size for trade in ob.trades.queue if trade.incoming_order_id == order.order_id)
+            assert filled == (6 if self_trade_prevention == 'cancel_resting' else 0), (name, self_trade_prevention)
+
+            rng = random.Random(seed)
+            ob = book_factory()
+            ob.self_trade_prevention = self_trade_prevention
+            for _ in range(number_of_orders):
+                side = Side.BUY if rng.random() < 0.5 else Side.SELL
+                price, size = price_at(rng.randint(-3, 3)), rng.randint(1, 10)
+                trader_id, u = rng.randrange(3), rng.random()
+                if u < 0.2:
+                    order = IcebergOrder(side, price, 3 * size, size, None, None, gtc, trader_id)
+                else:
+                    order = LimitOrder(side, price, size, None, None, fok if u < 0.5 else gtc, trader_id)
+                ob.process_order(order)
+                filled = 0
+                while not ob.trades.empty():
+                    trade = ob.trades.get()
+                    if trade.incoming_order_id == order.order_id:
+                        filled += trade.size
+                assert order.time_in_force is gtc or filled in (0, size), (name, self_trade_prevention, order)
+    print('Fill or kill: no partial fills under any self-trade prevention mode')
+
+
+def check_uncrossed(number_of_flows=100, number_of_orders=300, seed=6):
+    """
+    The best bid stays below the best offer after every order of random flows of GTC iceberg, stop, stop-limit,
+    market and limit orders, each on a new book, in either book. Stops reached by an iceberg order's trades used to
+    enter before its remainder rested, which then rested through the book they had left. That needs a thin book, so
+    the flows are short
+    """
+    rng = random.Random(seed)
+    for name, book_factory in BOOKS:
+        for i in range(number_of_flows * number_of_orders):
+            if i % number_of_orders == 0:
+                ob = book_factory()
+            side = Side.BUY if rng.random() < 0.5 else Side.SELL
+            sign = 1 if side == Side.BUY else -1
+            price, size, u = price_at(rng.randint(-4, 4)), rng.randint(1, 10), rng.random()
+            if u < 0.25:
+                order = IcebergOrder(side, price, 3 * size, size)
+            elif u < 0.45:
+                order = StopOrder(side, price_at(sign * rng.randint(0, 3)), size, price if rng.random() < 0.5 else None)
+            elif u < 0.5:
+                order = MarketOrder(side, size)
+            else:
+                order = LimitOrder(side, price, size)
+            ob.process_order(order)
+            assert not (ob.bids and ob.offers) or ob.bid_index.best() < ob.offer_index.best(), (name, order)
+    print('Iceberg and stop orders: the book never crossed')
+
+
+def main(number_of_orders=1000000, depths=(10, 1000, 100000)):
+    print('{0:>6} {1:>6} {2:>8} {3:>10} {4:>10} {5:>12} {6:>12} {7:>12}'.format(
+        'Book', 'Mode', 'Depth', 'Orders', 'Seconds', 'Orders/sec', 'Bid levels', 'Ask levels'))
+    for depth in depths:
+        orders = generate_orders(number_of_orders, depth)
+        for name, book_factory in BOOKS:
+            for mode, replay_orders in [('single', replay), ('batch', replay_batch)]:
+                ob = build_book(depth, book_factory)
+                elapsed = replay_orders(ob, orders)
+                print('{0:>6} {1:>6} {2:>8} {3:>10} {4:>10.3f} {5:>12.0f} {6:>12} {7:>12}'.format(
+                    name, mode, depth, number_of_orders, elapsed, number_of_orders / elapsed,
+                    len(ob.bids), len(ob.offers)))
+    print()
+    print('{0:>6} {1:>8} {2:>10} {3:>10} {4:>12}'.format('Book', 'Depth', 'Messages', 'Seconds', 'Msgs/sec'))
+    for depth in depths:
+        for name, book_factory in BOOKS:
+            ob = build_book(depth, book_factory)
+            elapsed = replay_cancels(ob, number_of_orders, depth)
+            print('{0:>6} {1:>8} {2:>10} {3:>10.3f} {4:>12.0f}'.format(
+                name, depth, number_of_orders, elapsed, number_of_orders / elapsed))
+    print()
+    print('{0:>6} {1:>10} {2:>10} {3:>10} {4:>12}'.format('Book', 'Fills', 'Sweeps', 'Seconds', 'Sweeps/sec'))
+    for name, book_factory in BOOKS:
+        for aggregate_fills in (False, True):
+            ob = book_factory()
+            ob.aggregate_fills = aggregate_fills
+            elapsed, rounds = replay_sweeps(ob, number_of_orders)
+            print('{0:>6} {1:>10} {2:>10} {3:>10.3f} {4:>12.0f}'.format(
+                name, 'per level' if aggregate_fills else 'per order', rounds, elapsed, rounds / elapsed))
+    print()
+    print('{0:>6} {1:>8} {2:>10} {3:>12} {4:>12} {5:>8} {6:>12}'.format('Book', 'Depth', 'Orders', 'Plain/sec',
+                                                                       'Typed/sec', 'Ratio', 'Whole runs'))
+    for depth in depths:
+        orders = generate_orders(min(number_of_orders, TYPED_ORDERS), depth)
+        for name, book_factory in BOOKS:
+            plain, typed = compare_flows(orders, depth, book_factory)
+            whole_plain, whole_typed = compare_whole_flows(orders, depth, book_factory)
+            print('{0:>6} {1:>8} {2:>10} {3:>12.0f} {4:>12.0f} {5:>8.3f} {6:>12.3f}'.format(
+                name, depth, len(orders), len(orders) / plain, len(orders) / typed, plain / typed,
+                whole_plain / whole_typed))
+
+
+if __name__ == '__main__':
+    check_market_remainder_stops()
+    check_fill_or_kill()
+    check_uncrossed()
+    args = [int(a) for a in sys.argv[1:]]
+    if len(args) > 1:
+        main(args[0], args[1:])
+    elif args:
+        main(args[0])
+    else:
+        main()
@@ -0,0 +1,84 @@
+'''
+Memory benchmark for OrderBook. Rests a large number of non-crossing limit orders (5M by default) in a book and
+reports the growth in resident set size, once with the __slots__ order records of OrderBook.py and once with an
+equivalent plain class carrying a per-instance __dict__ (the previous layout). The orders are plain GTC orders, which
+LimitOrder builds as seven-slot PlainLimitOrder records. Each variant runs in a fresh interpreter so the two
+measurements do not share an allocator.
+Usage: python OrderMemoryBenchmark.py [number_of_orders]
+'''
+
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from OrderBook import OrderBook, LimitOrder, Side, TimeInForce
+
+
+class DictLimitOrder(object):
+    """
+    LimitOrder as it was before __slots__: same attributes, stored in an instance __dict__. The attributes the book
+    has read since the order types were added are class-level defaults of a plain GTC order, so that the instances
+    keep the old layout.
+    """
+    special = False
+    time_in_force = TimeInForce.GTC
+    trader_id = None
+    display_size = None
+    hidden_size = 0
+
+    def __init__(self, side, price, size, timestamp=None, order_id=None):
+        self.side = side
+        self.size = size
+        self.price = price
+        self.timestamp = timestamp
+        self.order_id = order_id
+        self.prev_order = None
+        self.next_order = None
+
+
+def resident_bytes():
+    """ Current resident set size, falling back to the peak when /proc is not available """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure(variant, number_of_orders, levels_per_side=5000):
+    order_class = DictLimitOrder if variant == 'dict' else LimitOrder
+    bid_prices = [round(100.0 - (k + 1) * 0.01, 2) for k in range(levels_per_side)]
+    offer_prices = [round(100.0 + (k + 1) * 0.01, 2) for k in range(levels_per_side)]
+    ob = OrderBook()
+    before = resident_bytes()
+    start = time.perf_counter()
+    for i in range(number_of_orders):
+        if i % 2 == 0:
+            ob.process_order(order_class(Side.BUY, bid_prices[(i // 2) % levels_per_side], 10))
+        else:
+            ob.process_order(order_class(Side.SELL, offer_prices[(i // 2) % levels_per_side], 10))
+    elapsed = time.perf_counter() - start
+    after = resident_bytes()
+    return len(ob.orders), after - before, elapsed
+
+
+def main(number_of_orders=5000000):
+    print('{0:>8} {1:>10} {2:>12} {3:>14} {4:>10}'.format('Layout', 'Orders', 'RSS (MB)', 'Bytes/order', 'Seconds'))
+    for variant in ('dict', 'slots'):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--variant', variant, str(number_of_orders)],
+                             check=True, capture_output=True, text=True).stdout.split()
+        resting, grown, elapsed = int(out[0]), int(out[1]), float(out[2])
+        print('{0:>8} {1:>10} {2:>12.1f} {3:>14.1f} {4:>10.2f}'.format(
+            variant, resting, grown / 2 ** 20, grown / resting, elapsed))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--variant':
+        print(*measure(sys.argv[2], int(sys.argv[3])))
+    elif len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,210 @@
+'''
+Historical replay of a ZT_OrderBook/Api day. Consecutive depth snapshots are diffed per price level, side by side and
+vectorised over the whole day, into a stream of events
+    (BOOK, timestamp, side, price, size, count)     level-2 change of a level; size 0 means the level went away
+    (TRADE, timestamp, side, price, size, count)    trades of a snapshot, side being the aggressor
+in timestamp order; within a snapshot trades come first, then removed levels, then new or changed ones. The stream
+is a generator pipeline (snapshot_events -> paced -> ReplayEngine.run) feeding callbacks such as strategies,
+analytics or a BookMirror that keeps an OrderBook equal to the snapshots, as fast as possible or at a speed
+multiple of the recorded time.
+Usage: python Replay.py instrument yyyy mm dd [speed]   e.g. python Replay.py ZT 2018 06 13
+'''
+
+import os
+import sys
+import time
+
+import numpy as np
+
+from OrderBook import LimitOrder, OrderBook, Side
+from TickOrderBook import get_instruments
+
+TRADE = 0
+BOOK = 1
+
+SIDES = (Side.BUY, Side.SELL)
+
+
+def get_api(root=None):
+    """ A ZT_OrderBook Api reading root (by default the TickData_ZT tree next to Api.py) """
+    get_instruments()
+    from Api import Api
+    if root is None:
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ZT_OrderBook', 'TickData_ZT')
+    return Api(root)
+
+
+def diff_side(ticks, prices, sizes, counts):
+    """
+    Level changes between consecutive snapshots of one side, given (T, depth) arrays with NaN ticks for missing
+    levels. Returns (rows, is_removal, prices, sizes, counts) of the events, rows being the later snapshot.
+    """
+    previous, current = ticks[:-1], ticks[1:]
+    # same[t, j, k]: level j of snapshot t has the price of level k of snapshot t + 1
+    same = previous[:, :, None] == current[:, None, :]
+    removed = ~same.any(axis=2) & ~np.isnan(previous) & (sizes[:-1] > 0)
+    matched = same.any(axis=1)
+    j = same.argmax(axis=1)
+    previous_sizes = np.take_along_axis(sizes[:-1], j, axis=1)
+    previous_counts = np.take_along_axis(counts[:-1], j, axis=1)
+    changed = ~np.isnan(current) & (~matched | (previous_sizes != sizes[1:]) | (previous_counts != counts[1:]))
+    changed &= matched | (sizes[1:] > 0)
+    removed_rows, removed_levels = np.nonzero(removed)
+    changed_rows, changed_levels = np.nonzero(changed)
+    return (np.concatenate([removed_rows, changed_rows]) + 1,
+            np.concatenate([np.ones(len(removed_rows), dtype=bool), np.zeros(len(changed_rows), dtype=bool)]),
+            np.concatenate([prices[:-1][removed_rows, removed_levels], prices[1:][changed_rows, changed_levels]]),
+            np.concatenate([np.zeros(len(removed_rows), dtype=sizes.dtype), sizes[1:][changed_rows, changed_levels]]),
+            np.concatenate([np.zeros(len(removed_rows), dtype=counts.dtype),
+                            counts[1:][changed_rows, changed_levels]]))
+
+
+def get_depth(api, row_start, row_end, depth_max):
+    """ Tick indices, prices, sizes and counts of snapshots row_start to row_end - 1, each of shape (T, 2, depth_max) """
+    prices, sizes, counts = [api.get_block(api.get_book_columns(field, depth_max), row_start, row_end)
+                             .reshape(-1, 2, depth_max) for field in ['price', 'qty', 'count']]
+    return api.get_tick_indices(prices), prices, sizes, counts
+
+
+def snapshot_events(api, timestamp_start=None, timestamp_end=None, depth_max=10, chunk_size=50000):
+    """
+    Events of the snapshots of a loaded Api from timestamp_start to timestamp_end, chunk_size snapshots at a time.
+    The first snapshot comes out as one BOOK event per level.
+    """
+    row_start, row_end = api.get_rows(timestamp_start, timestamp_end)
+    timestamps = api.get_column('timestamp')
+    trade_columns = ['trade_price_' + str(api.append_number)]
+    for side in ['buy', 'sell']:
+        trade_columns += ['trade_qty_' + side + '_' + str(api.append_number),
+                          'trade_count_' + side + '_' + str(api.append_number)]
+    for first in range(row_start, row_end, chunk_size):
+        last = min(first + chunk_size, row_end)
+        # local row r of the depth arrays is snapshot first - 1 + r: the chunk is diffed against the snapshot before
+        # it, or against an empty book for the opening snapshot
+        if first > row_start:
+            depth = get_depth(api, first - 1, last, depth_max)
+        else:
+            depth = [np.concatenate([np.zeros_like(a[:1]) if a.dtype.kind != 'f' else np.full(a[:1].shape, np.nan), a])
+                     for a in get_depth(api, first, last, depth_max)]
+        ticks, prices, sizes, counts = depth
+        rows, kinds, sides, event_prices, event_sizes, event_counts = [], [], [], [], [], []
+        for side in range(2):
+            side_rows, is_removal, side_prices, side_sizes, side_counts = diff_side(
+                ticks[:, side], prices[:, side], sizes[:, side], counts[:, side])
+            rows.append(side_rows)
+            kinds.append(np.where(is_removal, 1, 2))
+            sides.append(np.full(len(side_rows), side))
+            event_prices.append(side_prices)
+            event_sizes.append(side_sizes)
+            event_counts.append(side_counts)
+        trades = api.get_block(trade_columns, first, last)
+        for side in range(2):
+            traded = np.nonzero(trades[:, 1 + 2 * side] > 0)[0]
+            rows.append(traded + 1)
+            kinds.append(np.zeros(len(traded), dtype=np.int64))
+            sides.append(np.full(len(traded), side))
+            event_prices.append(trades[traded, 0])
+            event_sizes.append(trades[traded, 1 + 2 * side])
+            event_counts.append(trades[traded, 2 + 2 * side])
+        # by snapshot, then trades, removed levels and changed levels
+        rows, kinds = np.concatenate(rows), np.concatenate(kinds)
+        order = np.lexsort((kinds, rows))
+        chunk_timestamps = timestamps[first:last].tolist()
+        event_timestamps = [chunk_timestamps[row - 1] for row in rows[order].tolist()]
+        event_kinds = np.where(kinds[order] == 0, TRADE, BOOK).tolist()
+        columns = [np.concatenate(values)[order].tolist() for values in (sides, event_prices)]
+        columns += [np.concatenate(values)[order].astype(np.int64).tolist() for values in (event_sizes, event_counts)]
+        yield from zip(event_kinds, event_timestamps, *columns)
+
+
+def paced(events, speed=None):
+    """ Pass events through, delayed so that they come out at speed times the recorded rate (None: no delay) """
+    if not speed:
+        yield from events
+        return
+    start_time = None
+    start_timestamp = None
+    previous_timestamp = None
+    for event in events:
+        timestamp = event[1]
+        if timestamp != previous_timestamp:
+            previous_timestamp = timestamp
+            if start_time is None:
+                start_time, start_timestamp = time.perf_counter(), timestamp
+            else:
+                delay = start_time + (timestamp - start_timestamp) / 1e9 / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        yield event
+
+
+class BookMirror(object):
+    """
+    Subscriber keeping an OrderBook equal to the replayed depth: one resting order per visible price level, sized
+    to the level (so level counts are not reproduced). Orders go straight into the book, without matching.
+    """
+    def __init__(self, book=None):
+        self.book = book if book is not None else OrderBook()
+        self.order_ids = {}
+
+    def __call__(self, kind, timestamp, side, price, size, count):
+        if kind != BOOK:
+            return
+        key = (side, price)
+        order_id = self.order_ids.get(key)
+        if size <= 0:
+            if order_id is not None:
+                self.book.cancel_order(order_id)
+                del self.order_ids[key]
+        elif order_id is None:
+            order = LimitOrder(SIDES[side], price, size, timestamp, self.book.new_order_id())
+            self.book.add_to_book(order)
+            self.order_ids[key] = order.order_id
+        else:
+            self.book.amend_order(order_id, size)
+
+
+class ReplayEngine(object):
+    """ Replays a loaded Api day to the callbacks in subscribers, called as callback(*event) """
+    def __init__(self, api, depth_max=10):
+        self.api = api
+        self.depth_max = depth_max
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def events(self, timestamp_start=None, timestamp_end=None, speed=None):
+        return paced(snapshot_events(self.api, timestamp_start, timestamp_end, self.depth_max), speed)
+
+    def run(self, timestamp_start=None, timestamp_end=None, speed=None):
+        """ Replay to the subscribers; returns the number of events, the elapsed seconds and the events per second """
+        subscribers = self.subscribers
+        number_of_events = 0
+        start = time.perf_counter()
+        for event in self.events(timestamp_start, timestamp_end, speed):
+            number_of_events += 1
+            for callback in subscribers:
+                callback(*event)
+        elapsed = time.perf_counter() - start
+        return {'events': number_of_events,
+                'seconds': elapsed,
+                'events_per_second': number_of_events / elapsed if elapsed > 0 else 0.0}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5:
+        print(__doc__)
+        sys.exit(1)
+    api = get_api()
+    api.load(*sys.argv[1:5])
+    engine = ReplayEngine(api)
+    mirror = BookMirror()
+    engine.subscribe(mirror)
+    stats = engine.run(speed=float(sys.argv[5]) if len(sys.argv) > 5 else None)
+    print('{0} events in {1:.2f}s: {2:.0f} events/sec'.format(stats['events'], stats['seconds'],
+                                                              stats['events_per_second']))
+    mirror.book.show_book()
@@ -0,0 +1,291 @@
+'''
+Integer-tick mode for OrderBook. Prices are converted to integer tick indices once, when an order enters the book,
+using the instrument tick sizes of ZT_OrderBook/Api.instruments. Each side keeps its price levels in a dense window
+of ticks around the mid, with a NumPy occupancy array so that best-price scans and depth snapshots are array
+operations. Prices are converted back to floats only at the output edge (trades and book summaries).
+'''
+
+import os
+import sys
+
+import numpy as np
+
+from OrderBook import OrderBook, MarketOrder, Side, StopOrder, Trade
+
+
+def get_instruments():
+    """ Instrument table (name and tick size per symbol) of ZT_OrderBook/Api.py """
+    api_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ZT_OrderBook')
+    if api_dir not in sys.path:
+        sys.path.append(api_dir)
+    from Api import Api
+    return Api.get_instruments()
+
+
+class TickLadder(object):
+    """
+    One side of an integer-tick book. Acts both as the {tick:PriceLevel} mapping and as the best-price index of the
+    side: levels[tick - base] holds the PriceLevel at tick and occupied[tick - base] flags it. The best tick is cached
+    and re-found with a vectorised scan when its level empties. The window grows (at least doubling) when a price
+    falls outside it, up to max_width ticks.
+    """
+    def __init__(self, descending, width=4096, max_width=1 << 22):
+        self.descending = descending
+        self.width = width
+        self.max_width = max_width
+        self.base = None
+        self.levels = [None] * width
+        self.occupied = np.zeros(width, dtype=bool)
+        self.number_of_levels = 0
+        self.best_tick = None
+
+    def __len__(self):
+        return self.number_of_levels
+
+    def __bool__(self):
+        return self.number_of_levels > 0
+
+    def __contains__(self, tick):
+        return self.get(tick) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, tick):
+        level = self.get(tick)
+        if level is None:
+            raise KeyError(tick)
+        return level
+
+    def get(self, tick, default=None):
+        if self.base is None:
+            return default
+        i = tick - self.base
+        if 0 <= i < self.width:
+            level = self.levels[i]
+            if level is not None:
+                return level
+        return default
+
+    def __setitem__(self, tick, level):
+        i = self.slot(tick)
+        if self.levels[i] is None:
+            self.number_of_levels += 1
+        self.levels[i] = level
+        self.occupied[i] = True
+        if self.best_tick is None or (tick > self.best_tick if self.descending else tick < self.best_tick):
+            self.best_tick = tick
+
+    def pop(self, tick):
+        i = tick - self.base
+        level = self.levels[i]
+        self.levels[i] = None
+        self.occupied[i] = False
+        self.number_of_levels -= 1
+        if tick == self.best_tick:
+            self.best_tick = self.scan_from(i)
+        return level
+
+    def add(self, tick):
+        """ PriceLevelIndex interface: the level was indexed when it was stored """
+        pass
+
+    def discard(self, tick):
+        """ PriceLevelIndex interface: the level was unindexed when it was popped """
+        pass
+
+    def best(self):
+        return self.best_tick
+
+    def walk(self):
+        """ Occupied ticks, best first, scanning outward from the best level in chunks of doubling size """
+        if self.best_tick is None:
+            return
+        chunk = 64
+        i = self.best_tick - self.base
+        while 0 <= i < self.width:
+            if self.descending:
+                low = max(0, i + 1 - chunk)
+                slots = np.flatnonzero(self.occupied[low:i + 1])[::-1] + low
+                i = low - 1
+            else:
+                high = min(self.width, i + chunk)
+                slots = np.flatnonzero(self.occupied[i:high]) + i
+                i = high
+            for slot in slots.tolist():
+                yield self.base + slot
+            chunk *= 2
+
+    def keys(self):
+        """ Occupied ticks, best first """
+        return self.top()
+
+    def values(self):
+        return [self.levels[i] for i in self.top_slots()]
+
+    def items(self):
+        return [(self.base + i, self.levels[i]) for i in self.top_slots()]
+
+    def top_slots(self, n=None):
+        """ Window slots of the n best levels, best first; scans outward from the best level in chunks """
+        if n is None or self.number_of_levels <= n:
+            slots = np.flatnonzero(self.occupied)
+            return slots[::-1] if self.descending else slots
+        found = []
+        number_found = 0
+        chunk = max(64, 4 * n)
+        i = self.best_tick - self.base
+        while number_found < n:
+            if self.descending:
+                low = max(0, i + 1 - chunk)
+                slots = np.flatnonzero(self.occupied[low:i + 1])[::-1] + low
+                i = low - 1
+            else:
+                high = min(self.width, i + chunk)
+                slots = np.flatnonzero(self.occupied[i:high]) + i
+                i = high
+            found.append(slots)
+            number_found += len(slots)
+        return np.concatenate(found)[:n]
+
+    def top(self, n=None):
+        """ Ticks of the n best levels (all levels if n is None), best first, as an int64 array """
+        if self.base is None:
+            return np.empty(0, dtype=np.int64)
+        return self.top_slots(n).astype(np.int64) + self.base
+
+    def scan_from(self, i):
+        """ Best occupied tick strictly behind slot i, or None """
+        if self.number_of_levels == 0:
+            return None
+        behind = self.occupied[:i][::-1] if self.descending else self.occupied[i + 1:]
+        if len(behind) == 0:
+            return None
+        j = int(behind.argmax())
+        if not behind[j]:
+            return None
+        return self.base + i - 1 - j if self.descending else self.base + i + 1 + j
+
+    def slot(self, tick):
+        """ Window position of tick, re-centring or growing the window when tick falls outside it """
+        if self.base is None or (self.number_of_levels == 0 and not 0 <= tick - self.base < self.width):
+            self.base = tick - self.width // 2
+        i = tick - self.base
+        if 0 <= i < self.width:
+            return i
+        occupied = np.flatnonzero(self.occupied)
+        low = min(tick, self.base + int(occupied[0]))
+        high = max(tick, self.base + int(occupied[-1])) + 1
+        width = max(2 * self.width, 2 * (high - low))
+        if width > self.max_width:
+            raise ValueError('Price is {0} ticks away from the book, beyond the tick window'.format(high - low))
+        base = low - (width - (high - low)) // 2
+        levels = [None] * width
+        levels[self.base - base:self.base - base + self.width] = self.levels
+        occupied_slots = np.zeros(width, dtype=bool)
+        occupied_slots[self.base - base:self.base - base + self.width] = self.occupied
+        self.base, self.width, self.levels, self.occupied = base, width, levels, occupied_slots
+        return tick - base
+
+
+class TickOrderBook(OrderBook):
+    """
+    OrderBook keyed by integer tick index instead of float price. Incoming order prices (floats, or strings typed in
+    interactively) are converted to ticks once in process_order, and must lie on the tick grid. Trades and book
+    summaries report float prices. Unlike OrderBook, the unfilled part of a market order does not rest in the book.
+    """
+    price_typecode = 'q'
+    market_buy_tick = 1 << 62
+    market_sell_tick = -(1 << 62)
+
+    def __init__(self, tick_size, width=4096):
+        super().__init__()
+        self.tick_size = tick_size
+        self.bids = self.bid_index = TickLadder(descending=True, width=width)
+        self.offers = self.offer_index = TickLadder(descending=False, width=width)
+
+    @classmethod
+    def for_instrument(cls, instrument, width=4096):
+        """ Book on the tick grid of an instrument from ZT_OrderBook/Api.instruments, e.g. 'ZT' or 'ES' """
+        return cls(get_instruments()[instrument]['ticksize'], width)
+
+    def to_ticks(self, price):
+        price = float(price)
+        ticks = round(price / self.tick_size)
+        if abs(ticks * self.tick_size - price) > 1e-9 * max(1.0, abs(price)):
+            raise ValueError('Price {0} is not a multiple of the tick size {1}'.format(price, self.tick_size))
+        return ticks
+
+    def to_price(self, ticks):
+        return ticks * self.tick_size
+
+    def batch_prices(self, sides, prices, is_market):
+        """ Vectorised to_ticks for process_orders, market orders at the market tick sentinels """
+        ticks = np.rint(prices / self.tick_size)
+        off_grid = ~is_market & (np.abs(ticks * self.tick_size - prices) > 1e-9 * np.maximum(1.0, np.abs(prices)))
+        if off_grid.any():
+            price = prices[np.argmax(off_grid)]
+            raise ValueError('Price {0} is not a multiple of the tick size {1}'.format(price, self.tick_size))
+        market_ticks = np.where(sides == Side.BUY.value, self.market_buy_tick, self.market_sell_tick)
+        return np.where(is_market, market_ticks, np.where(is_market, 0, ticks).astype(np.int64)).tolist()
+
+    def trade_price_scale(self):
+        return self.tick_size
+
+    @property
+    def max_bid(self):
+        tick = self.bids.best_tick
+        return 0. if tick is None else tick
+
+    @property
+    def min_offer(self):
+        tick = self.offers.best_tick
+        return float('inf') if tick is None else tick
+
+    def process_order(self, incoming_order):
+        if isinstance(incoming_order, MarketOrder):
+            incoming_order.price = self.market_buy_tick if incoming_order.side == Side.BUY else self.market_sell_tick
+        elif isinstance(incoming_order, StopOrder):
+            # the limit price stays a float (checked here) until the stop triggers and enters a new order
+            incoming_order.stop_price = self.to_ticks(incoming_order.stop_price)
+            if incoming_order.price is not None:
+                self.to_ticks(incoming_order.price)
+        else:
+            incoming_order.price = self.to_ticks(incoming_order.price)
+        super().process_order(incoming_order)
+
+    def add_to_book(self, order):
+        if isinstance(order, MarketOrder):
+            return
+        super().add_to_book(order)
+
+    def execute_match(self, incoming_order, book_order):
+        trade_size = min(incoming_order.size, book_order.size)
+        return Trade(incoming_order.side, self.to_price(book_order.price), trade_size, incoming_order.order_id,
+                     book_order.order_id)
+
+    def book_summary(self):
+        bid_ticks = self.bids.top()
+        offer_ticks = self.offers.top()
+        self.bid_prices = (bid_ticks * self.tick_size).tolist()
+        self.offer_prices = (offer_ticks * self.tick_size).tolist()
+        self.bid_sizes = [self.bids[t].size for t in bid_ticks.tolist()]
+        self.offer_sizes = [self.offers[t].size for t in offer_ticks.tolist()]
+
+    def depth(self, n):
+        """ OrderBook.depth with each side's ticks located by a vectorised ladder scan """
+        if self.depth_buffers is None or self.depth_buffers[0].shape[1] != n:
+            self.depth_buffers = (np.empty((2, n)), np.empty((2, n), dtype=np.int64), np.empty((2, n), dtype=np.int64))
+        prices, sizes, counts = self.depth_buffers
+        prices.fill(np.nan)
+        sizes.fill(0)
+        counts.fill(0)
+        for row, ladder in enumerate([self.bids, self.offers]):
+            ticks = ladder.top(n)
+            m = len(ticks)
+            prices[row, :m] = ticks * self.tick_size
+            levels = ladder.levels
+            for i, slot in enumerate((ticks - ladder.base).tolist()):
+                sizes[row, i] = levels[slot].size
+                counts[row, i] = levels[slot].count
+        return prices, sizes, counts
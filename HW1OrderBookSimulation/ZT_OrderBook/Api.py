@@ -1,6 +1,10 @@
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import DateTimeUtils
+from DayCache import DayCache
+from TickStore import (ColumnStore, convert_frame, get_append_number, get_current_store_directory, get_store_directory,
+                       is_converted)
 
 
 class Api:
@@ -11,7 +15,7 @@ class Api:
                    'ZF': {'name': 'Tsy 5y', 'ticksize': 1.0 / 128.0},
                    'ZN': {'name': 'Tsy 10y', 'ticksize': 1.0 / 64.0},
                    'ZB': {'name': 'Tsy 30y', 'ticksize': 1.0 / 32.0}}
-    instrument = None
+    cache = DayCache.from_environment()
 
     # region Static methods
 
@@ -36,64 +40,255 @@ class Api:
         return instrument in Api.get_instrument_names()
 
     @staticmethod
-    def get_filename(instrument, year, month, day):
-        Api.instrument = instrument
-        return 'TickData_ZT/' + instrument + '/' + year + '/' + month + '/' + day + '/foreground.h5'
+    def get_filename(instrument, year, month, day, root='TickData_ZT'):
+        return root + '/' + instrument + '/' + year + '/' + month + '/' + day + '/foreground.h5'
+
+    @staticmethod
+    def configure_cache(max_bytes=None, disk=None):
+        if max_bytes is not None:
+            Api.cache.resize(max_bytes)
+        if disk is not None:
+            Api.cache.disk = disk
+        return Api.cache.get_stats()
+
+    @staticmethod
+    def get_cache_stats():
+        return Api.cache.get_stats()
 
     # endregion
 
-    # region Constructor and load_h5
-    def __init__(self):
+    # region Constructor, load and load_h5
+    def __init__(self, root='TickData_ZT'):
+        # the loaded day's instrument and column suffix belong to the instance, so several days can be open at once
+        #
+        self.root = root
+        self.instrument = None
         self.df = ''
+        self.store = None
         self.append_number = None
+        self.positions = {}
+
+    def load(self, instrument, year, month, day):
+        # memory-map the day's columnar copy when TickStore.py has converted it from the current h5 file; a copy
+        # left stale by a newer h5 file is converted again first, and a copy without its h5 file is used as it is
+        #
+        directory = get_current_store_directory(Api.get_filename(instrument, year, month, day, self.root))
+        if directory is not None:
+            self.load_store(directory, instrument)
+        else:
+            self.load_h5(instrument, year, month, day)
+
+    def load_store(self, directory, instrument=None):
+        store = ColumnStore(directory)
+        self.instrument = instrument
+        self.append_number = store.append_number
+        self.store = store
+        self.df = ''
+        self.positions = {}
 
     def load_h5(self, instrument, year, month, day):
-        # get the filename and read into a dataframe
+        # the decoded day comes from the process-wide cache if it is there
         #
-        filename = Api.get_filename(instrument, year, month, day)
-        df1 = pd.read_hdf(filename, 'main')
-        columns = df1.columns
+        key = (self.root, instrument, year, month, day)
+        df = Api.cache.get(key)
+        if df is None:
+            filename = Api.get_filename(instrument, year, month, day, self.root)
+            directory = get_store_directory(filename)
+            if Api.cache.disk and is_converted(filename):
+                # the disk cache already holds the day, converted from the current h5 file
+                #
+                df = ColumnStore(directory).to_frame()
+            else:
+                # get the filename and read into a dataframe; the disk cache converts it only when its copy of the
+                # day is missing or stale
+                #
+                df1 = pd.read_hdf(filename, 'main')
+                if Api.cache.disk:
+                    convert_frame(df1, directory, filename)
+
+                # set the dataframe index to the timestamp
+                df = df1.set_index("timestamp", drop=False)
+            Api.cache.put(key, df)
+            df = DayCache.share(df)
 
         # make sure that all columns have the same append number
         # store that append number
         #
-        for column_name in columns:
-            if column_name == 'timestamp': continue
-            number = column_name[column_name.rfind('_') + 1:]
-            if self.append_number is None:
-                self.append_number = number
-            elif self.append_number != number:
-                raise Exception("Not all columns have the same end number")
-
-        # set the dataframe index to the timestamp
-        self.df = df1.set_index("timestamp", drop=False)
+        self.append_number = get_append_number(df.columns)
+        self.instrument = instrument
+        self.df = df
+        self.store = None
+        self.positions = {}
 
     # endregion
 
     def get_columns(self):
+        if self.store is not None:
+            return self.store.columns
         return self.df.columns
 
+    def get_column(self, column):
+        if self.store is not None:
+            return self.store[column]
+        return self.df[column].to_numpy()
+
+    def get_row(self, timestamp):
+        if self.store is not None:
+            return self.store.row(timestamp)
+        return self.df.index.get_loc(timestamp)
+
     def get_timestamps(self):
-        return self.df['timestamp'].tolist()
+        return self.get_column('timestamp').tolist()
 
     def get_order_book(self, timestamp, depth_max=10):
         sides = ['bid', 'ask']
         order_book = {}
+        row = self.get_row(timestamp)
         for s in sides:
             for d in range(depth_max):
                 column = 'book_price_' + s + '_' + str(d) + '_' + str(self.append_number)
-                price = self.df.loc[timestamp, column]
+                price = self.get_column(column)[row]
                 column = 'book_qty_' + s + '_' + str(d) + '_' + str(self.append_number)
-                qty = self.df.loc[timestamp, column]
+                qty = self.get_column(column)[row]
                 column = 'book_count_' + s + '_' + str(d) + '_' + str(self.append_number)
-                count = self.df.loc[timestamp, column]
+                count = self.get_column(column)[row]
                 order_book[s + '_' + str(d)] = (price, qty, count)
-        order_book['instrument'] = Api.instrument
+        order_book['instrument'] = self.instrument
         order_book['depth_max'] = depth_max
         order_book['timestamp'] = timestamp
         order_book['datetime'] = DateTimeUtils.convert_timestamp_to_dtstring(timestamp)
         return order_book
 
+    # region Vectorised access
+
+    def get_rows(self, timestamp_start=None, timestamp_end=None):
+        # [row_start, row_end) of the snapshots from timestamp_start to timestamp_end inclusive, as df.loc slices
+        row_start = 0 if timestamp_start is None else self.get_row(timestamp_start)
+        row_end = len(self.get_column('timestamp')) if timestamp_end is None else self.get_row(timestamp_end) + 1
+        return row_start, row_end
+
+    def get_block(self, columns, row_start, row_end):
+        # (rows, len(columns)) array of the given columns, one slice per column
+        columns = tuple(columns)
+        if self.store is not None:
+            arrays = [self.store[column] for column in columns]
+            block = np.empty((row_end - row_start, len(columns)), dtype=np.result_type(*arrays))
+            for j, array in enumerate(arrays):
+                block[:, j] = array[row_start:row_end]
+            return block
+        positions = self.positions.get(columns)
+        if positions is None:
+            positions = self.df.columns.get_indexer(columns)
+            if (positions < 0).any():
+                raise KeyError([column for column, p in zip(columns, positions) if p < 0])
+            self.positions[columns] = positions
+        return self.df.iloc[row_start:row_end, positions].to_numpy()
+
+    def get_book_columns(self, field, depth_max=10):
+        return ['book_' + field + '_' + s + '_' + str(d) + '_' + str(self.append_number)
+                for s in ['bid', 'ask'] for d in range(depth_max)]
+
+    def get_order_book_tensor(self, timestamp_start=None, timestamp_end=None, depth_max=10):
+        # prices, qtys and counts of the snapshots from timestamp_start to timestamp_end (default the whole day),
+        # each of shape (T, 2, depth_max) with side 0 bid and 1 ask, level 0 the best
+        #
+        row_start, row_end = self.get_rows(timestamp_start, timestamp_end)
+        return tuple(self.get_block(self.get_book_columns(field, depth_max), row_start, row_end)
+                     .reshape(row_end - row_start, 2, depth_max) for field in ['price', 'qty', 'count'])
+
+    def get_order_book_balance_series(self, timestamp_start=None, timestamp_end=None, depth_max=10):
+        # get_order_book_balance of every snapshot
+        row_start, row_end = self.get_rows(timestamp_start, timestamp_end)
+        qtys = self.get_block(self.get_book_columns('qty', depth_max), row_start, row_end).reshape(-1, 2, depth_max)
+        return qtys[:, 1, :].sum(axis=1, dtype=np.float64) - qtys[:, 0, :].sum(axis=1, dtype=np.float64)
+
+    def get_weighted_order_book_balance_series(self, timestamp_start=None, timestamp_end=None, depth_max=10):
+        # order_book['weighted_balance'] of every snapshot: mid plus the size-weighted mean distance from the mid
+        row_start, row_end = self.get_rows(timestamp_start, timestamp_end)
+        prices = self.get_block(self.get_book_columns('price', depth_max), row_start, row_end).reshape(-1, 2, depth_max)
+        qtys = self.get_block(self.get_book_columns('qty', depth_max), row_start, row_end).reshape(-1, 2, depth_max)
+        mid_prices = (prices[:, 0, 0] + prices[:, 1, 0]) / 2.0
+        weighted_order_book_balance = ((prices - mid_prices[:, None, None]) * qtys).sum(axis=(1, 2))
+        sizes = qtys.sum(axis=(1, 2), dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return mid_prices + weighted_order_book_balance / sizes
+
+    # endregion
+
+    # region Flow series
+
+    def get_tick_indices(self, prices):
+        # prices as multiples of the instrument tick size, so that they compare exactly; NaN where there is no price
+        return np.rint(np.asarray(prices, dtype=np.float64) / Api.get_instrument_ticksize(self.instrument))
+
+    def get_limit_flow_series(self, timestamp_start=None, timestamp_end=None, depth_max=10, trades_at='start',
+                              chunk_size=65536):
+        # get_limit_flows of every pair of consecutive snapshots from timestamp_start to timestamp_end, aligned on the
+        # levels of the earlier book: ticks (T - 1, 2, depth_max) holds the tick index of each level of the earlier
+        # book, and flows the size at that price in the later book minus the size in the earlier one, plus the traded
+        # size at the trade price, or NaN where the later book has no such price. trades_at takes the trades of the
+        # earlier snapshot ('start', as get_limit_flows) or of the later one ('end').
+        #
+        if trades_at not in ('start', 'end'):
+            raise ValueError("trades_at must be 'start' or 'end'")
+        row_start, row_end = self.get_rows(timestamp_start, timestamp_end)
+        ticks = self.get_tick_indices(self.get_block(self.get_book_columns('price', depth_max), row_start, row_end))
+        qtys = self.get_block(self.get_book_columns('qty', depth_max), row_start, row_end).astype(np.float64)
+        columns = ['trade_price_' + str(self.append_number),
+                   'trade_qty_buy_' + str(self.append_number),
+                   'trade_qty_sell_' + str(self.append_number)]
+        if trades_at == 'start':
+            trades = self.get_block(columns, row_start, max(row_end - 1, row_start))
+        else:
+            trades = self.get_block(columns, min(row_start + 1, row_end), row_end)
+        trade_ticks = self.get_tick_indices(trades[:, 0])
+        traded = trades[:, 1].astype(np.float64) + trades[:, 2]
+
+        start_ticks, end_ticks = ticks[:-1], ticks[1:]
+        flows = np.full(start_ticks.shape, np.nan)
+        for i in range(0, len(start_ticks), chunk_size):
+            rows = slice(i, i + chunk_size)
+            # same[t, j, k]: level j of the earlier book has the price of level k of the later book
+            same = start_ticks[rows, :, None] == end_ticks[rows, None, :]
+            matched = same.any(axis=2)
+            end_sizes = (same * qtys[1:][rows, None, :]).sum(axis=2)
+            flow = end_sizes - qtys[:-1][rows]
+            flow += np.where(start_ticks[rows] == trade_ticks[rows, None], traded[rows, None], 0.0)
+            flows[rows] = np.where(matched, flow, np.nan)
+        shape = (len(start_ticks), 2, depth_max)
+        return start_ticks.reshape(shape), flows.reshape(shape)
+
+    def get_limit_flow_grid(self, timestamp_start=None, timestamp_end=None, depth_max=10, trades_at='start'):
+        # get_limit_flow_series on a dense tick grid: grid[t, k] is the flow at tick index first_tick + k between
+        # snapshots t and t + 1, NaN where there is none
+        #
+        ticks, flows = self.get_limit_flow_series(timestamp_start, timestamp_end, depth_max, trades_at)
+        ticks, flows = ticks.reshape(len(ticks), -1), flows.reshape(len(flows), -1)
+        present = ~np.isnan(flows)
+        if not present.any():
+            return 0, np.full((len(flows), 0), np.nan)
+        first_tick = int(ticks[present].min())
+        grid = np.full((len(flows), int(ticks[present].max()) - first_tick + 1), np.nan)
+        rows = np.nonzero(present)[0]
+        grid[rows, ticks[present].astype(np.int64) - first_tick] = flows[present]
+        return first_tick, grid
+
+    def get_order_flow_imbalance_series(self, timestamp_start=None, timestamp_end=None, depth_max=1):
+        # order flow imbalance (Cont, Kukanov and Stoikov) at each of the first depth_max levels for every pair of
+        # consecutive snapshots, shape (T - 1, depth_max); bid size added at a higher or equal bid, removed at a
+        # lower or equal one, and the opposite on the ask side
+        #
+        row_start, row_end = self.get_rows(timestamp_start, timestamp_end)
+        ticks = self.get_tick_indices(self.get_block(self.get_book_columns('price', depth_max), row_start, row_end))
+        qtys = self.get_block(self.get_book_columns('qty', depth_max), row_start, row_end).astype(np.float64)
+        ticks, qtys = ticks.reshape(-1, 2, depth_max), qtys.reshape(-1, 2, depth_max)
+        bid, previous_bid = ticks[1:, 0], ticks[:-1, 0]
+        ask, previous_ask = ticks[1:, 1], ticks[:-1, 1]
+        return (np.where(bid >= previous_bid, qtys[1:, 0], 0.0) - np.where(bid <= previous_bid, qtys[:-1, 0], 0.0)
+                - np.where(ask <= previous_ask, qtys[1:, 1], 0.0) + np.where(ask >= previous_ask, qtys[:-1, 1], 0.0))
+
+    # endregion
+
     def get_order_book_balance(self, order_book):
         order_book_balance = 0.0
         for d in range(order_book['depth_max']):
@@ -115,14 +310,15 @@ class Api:
     def get_trades(self, timestamp):
         trade_types = ['buy', 'sell']
         trades = {}
+        row = self.get_row(timestamp)
         column = 'trade_price_' + str(self.append_number)
-        price = self.df.loc[timestamp, column]
+        price = self.get_column(column)[row]
         trades['price'] = price
         for tt in trade_types:
             column = 'trade_qty_' + tt + '_' + str(self.append_number)
-            qty = self.df.loc[timestamp, column]
+            qty = self.get_column(column)[row]
             column = 'trade_count_' + tt + '_' + str(self.append_number)
-            count = self.df.loc[timestamp, column]
+            count = self.get_column(column)[row]
             trades[tt] = (qty, count)
         return trades
 
@@ -186,7 +382,7 @@ class Api:
         fig, ax = plt.subplots(nrows=1, ncols=1)
         ax.set_facecolor((0.0, 0.0, 0.0))
 
-        tick_size = Api.instruments[Api.instrument]['ticksize']
+        tick_size = Api.instruments[order_book['instrument']]['ticksize']
         prices = [min(bid_prices) - tick_size]
         prices += bid_prices
         prices.append(max(bid_prices))
@@ -211,8 +407,7 @@ class Api:
         plt.xlabel('price')
         plt.ylabel('size')
         plt.legend(fancybox=True)
-        plt.xlim(min(bid_prices) - 2 * Api.instruments[Api.instrument]['ticksize'],
-                 max(ask_prices) + 2 * Api.instruments[Api.instrument]['ticksize'])
+        plt.xlim(min(bid_prices) - 2 * tick_size, max(ask_prices) + 2 * tick_size)
         plt.ylim(0, 1.40 * max(max(bid_sizes), max(ask_sizes)))
 
         mid = (max(bid_prices + min(ask_prices))) / 2.0
@@ -0,0 +1,234 @@
+'''
+Bar and feature aggregation over tick data. Each day's snapshots are cut into time bars (fixed interval), tick bars
+(every n trades) or volume bars (every n contracts traded) and reduced per bar to OHLCV, VWAP, buy and sell volume,
+book balance and weighted balance (as Api.get_order_book_balance / get_weighted_order_book_balance, mean and last)
+and bid/ask spread statistics. Days are processed one at a time (bars never span two days), so memory is bounded
+by one day, and BarWriter appends each day's bars to a columnar file: Parquet (needs pyarrow) for a .parquet path,
+else a TickStore column store directory that TickStore.ColumnStore can open.
+Usage: python Bars.py output [time|tick|volume] [size] [start yyyy-mm-dd] [end yyyy-mm-dd] [root]
+    size is seconds for time bars (default 60), trades for tick bars and contracts for volume bars
+'''
+
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+from Dataset import TickDataset
+from TickStore import FORMAT_VERSION, META_FILENAME
+
+BAR_KINDS = ('time', 'tick', 'volume')
+
+
+def get_day_arrays(get_column, depth_max=10):
+    # the arrays bars are made from; get_column(name) returns a column by its name without the _N suffix
+    #
+    day = {'timestamp': np.asarray(get_column('timestamp'), dtype=np.int64),
+           'trade_price': np.asarray(get_column('trade_price'), dtype=np.float64)}
+    for side in ['buy', 'sell']:
+        day['trade_qty_' + side] = np.nan_to_num(np.asarray(get_column('trade_qty_' + side), dtype=np.float64))
+    for field in ['price', 'qty']:
+        day['book_' + field] = np.stack([np.stack([np.asarray(get_column('book_' + field + '_' + s + '_' + str(d)),
+                                                              dtype=np.float64) for d in range(depth_max)], axis=1)
+                                         for s in ['bid', 'ask']], axis=1)
+    return day
+
+
+def get_day_arrays_from_frame(df, depth_max=10):
+    # a day from TickDataset.iter_days
+    return get_day_arrays(lambda name: df[name].to_numpy(), depth_max)
+
+
+def get_day_arrays_from_api(api, depth_max=10):
+    # the day loaded in an Api
+    suffix = '_' + str(api.append_number)
+    return get_day_arrays(lambda name: api.get_column(name if name == 'timestamp' else name + suffix), depth_max)
+
+
+def get_bar_ids(day, kind='time', size=60):
+    # bar number of every snapshot, non-decreasing. Time bars are size seconds long, aligned on multiples of size
+    # from midnight UTC; tick and volume bars close on the trade that reaches size trades or contracts, and a trade
+    # belongs entirely to the bar it starts in
+    #
+    if kind == 'time':
+        return day['timestamp'] // int(size * 1e9)
+    traded = day['trade_qty_buy'] + day['trade_qty_sell']
+    if kind == 'tick':
+        traded = (traded > 0).astype(np.float64)
+    elif kind != 'volume':
+        raise ValueError('Bar kind must be one of {0}'.format(BAR_KINDS))
+    return ((np.cumsum(traded) - traded) // size).astype(np.int64)
+
+
+def first_in_group(values, starts, valid):
+    # first valid value of each group of consecutive rows beginning at starts, NaN for none
+    positions = np.where(valid, np.arange(len(values)), len(values))
+    first = np.minimum.reduceat(positions, starts)
+    return np.where(first < len(values), values[np.minimum(first, len(values) - 1)], np.nan)
+
+
+def last_in_group(values, starts, valid):
+    positions = np.where(valid, np.arange(len(values)), -1)
+    last = np.maximum.reduceat(positions, starts)
+    return np.where(last >= 0, values[np.maximum(last, 0)], np.nan)
+
+
+def aggregate_bars(day, bar_ids, kind='time', size=60):
+    # one row per bar with at least one snapshot, in time order
+    #
+    n = len(bar_ids)
+    if n == 0:
+        return None
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(bar_ids)) + 1])
+    snapshots = np.diff(np.concatenate([starts, [n]]))
+
+    price = day['trade_price']
+    buy, sell = day['trade_qty_buy'], day['trade_qty_sell']
+    volume = buy + sell
+    traded = (volume > 0) & np.isfinite(price)
+    traded_price = np.where(traded, price, 0.0)
+    bars = {'timestamp': bar_ids[starts] * int(size * 1e9) if kind == 'time' else day['timestamp'][starts],
+            'first_timestamp': day['timestamp'][starts],
+            'last_timestamp': day['timestamp'][starts + snapshots - 1],
+            'snapshots': snapshots,
+            'open': first_in_group(price, starts, traded),
+            'high': np.where(np.logical_or.reduceat(traded, starts),
+                             np.maximum.reduceat(np.where(traded, price, -np.inf), starts), np.nan),
+            'low': np.where(np.logical_or.reduceat(traded, starts),
+                            np.minimum.reduceat(np.where(traded, price, np.inf), starts), np.nan),
+            'close': last_in_group(price, starts, traded),
+            'volume': np.add.reduceat(np.where(traded, volume, 0.0), starts),
+            'buy_volume': np.add.reduceat(np.where(traded, buy, 0.0), starts),
+            'sell_volume': np.add.reduceat(np.where(traded, sell, 0.0), starts),
+            'trades': np.add.reduceat(traded.astype(np.int64), starts)}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bars['vwap'] = np.add.reduceat(traded_price * np.where(traded, volume, 0.0), starts) / bars['volume']
+
+        # book features per snapshot, then mean and last per bar
+        prices, qtys = day['book_price'], np.nan_to_num(day['book_qty'])
+        balance = qtys[:, 1, :].sum(axis=1) - qtys[:, 0, :].sum(axis=1)
+        mid_prices = (prices[:, 0, 0] + prices[:, 1, 0]) / 2.0
+        weighted_balance = mid_prices + (np.nan_to_num((prices - mid_prices[:, None, None]) * qtys).sum(axis=(1, 2))
+                                         / qtys.sum(axis=(1, 2)))
+        spread = prices[:, 1, 0] - prices[:, 0, 0]
+        for name, values in [('balance', balance), ('weighted_balance', weighted_balance), ('spread', spread)]:
+            valid = np.isfinite(values)
+            count = np.add.reduceat(valid.astype(np.int64), starts)
+            bars[name + '_mean'] = np.add.reduceat(np.where(valid, values, 0.0), starts) / count
+            bars[name + '_last'] = last_in_group(values, starts, valid)
+        valid = np.isfinite(spread)
+        has_spread = np.logical_or.reduceat(valid, starts)
+        bars['spread_min'] = np.where(has_spread, np.minimum.reduceat(np.where(valid, spread, np.inf), starts), np.nan)
+        bars['spread_max'] = np.where(has_spread, np.maximum.reduceat(np.where(valid, spread, -np.inf), starts), np.nan)
+    bars['mid_last'] = last_in_group(mid_prices, starts, np.isfinite(mid_prices))
+    return bars
+
+
+def get_bars(day, kind='time', size=60):
+    return aggregate_bars(day, get_bar_ids(day, kind, size), kind, size)
+
+
+def iter_bars(days, kind='time', size=60, depth_max=10):
+    # bars of every (instrument, date, frame) from TickDataset.iter_days, with instrument and date columns
+    #
+    for instrument, date, df in days:
+        bars = get_bars(get_day_arrays_from_frame(df, depth_max), kind, size)
+        if bars is None:
+            continue
+        rows = len(bars['timestamp'])
+        bars = dict([('instrument', np.full(rows, instrument, dtype='U8')),
+                     ('date', np.full(rows, np.datetime64(date, 'D')))] + list(bars.items()))
+        yield bars
+
+
+class BarWriter:
+    # appends dicts of equal-length column arrays to path: a Parquet file (one row group per write) if path ends in
+    # .parquet, else a TickStore column store directory, written as raw column files and turned into .npy by close()
+    #
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.endswith(('.parquet', '.pq'))
+        self.writer = None
+        self.columns = None
+        self.rows = 0
+        self.last_timestamp = None
+        self.sorted_timestamps = True
+        if not self.parquet:
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, bars):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pydict(bars)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table)
+        else:
+            if self.columns is None:
+                self.columns = [(name, np.asarray(values).dtype) for name, values in bars.items()]
+            for i, (name, dtype) in enumerate(self.columns):
+                with open(os.path.join(self.path, '{0:04d}.bin'.format(i)), 'ab') as f:
+                    np.ascontiguousarray(bars[name], dtype=dtype).tofile(f)
+            timestamps = np.asarray(bars['timestamp'])
+            if len(timestamps):
+                if self.last_timestamp is not None and timestamps[0] <= self.last_timestamp:
+                    self.sorted_timestamps = False
+                self.sorted_timestamps &= bool((np.diff(timestamps) > 0).all())
+                self.last_timestamp = timestamps[-1]
+        self.rows += len(bars['timestamp'])
+
+    def close(self):
+        if self.parquet:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            return
+        columns = []
+        for i, (name, dtype) in enumerate(self.columns or []):
+            raw = os.path.join(self.path, '{0:04d}.bin'.format(i))
+            filename = '{0:04d}.npy'.format(i)
+            values = np.memmap(raw, dtype=dtype, mode='r') if self.rows else np.zeros(0, dtype=dtype)
+            np.save(os.path.join(self.path, filename), values)
+            del values
+            os.remove(raw)
+            columns.append({'name': name, 'file': filename, 'dtype': dtype.str})
+        meta = {'format': FORMAT_VERSION,
+                'rows': self.rows,
+                'columns': columns,
+                'append_number': None,
+                'sorted_timestamps': self.sorted_timestamps,
+                'source': None,
+                'source_mtime': None}
+        with open(os.path.join(self.path, META_FILENAME), 'w') as f:
+            json.dump(meta, f, indent=1)
+        self.columns = None
+
+
+def write_bars(path, days, kind='time', size=60, depth_max=10):
+    # bars of days (as from TickDataset.iter_days) written to path; returns the number of bars
+    with BarWriter(path) as writer:
+        for bars in iter_bars(days, kind, size, depth_max):
+            writer.write(bars)
+        return writer.rows
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    kind = sys.argv[2] if len(sys.argv) > 2 else 'time'
+    size = float(sys.argv[3]) if len(sys.argv) > 3 else 60
+    start = sys.argv[4] if len(sys.argv) > 4 else None
+    end = sys.argv[5] if len(sys.argv) > 5 else None
+    dataset = TickDataset(sys.argv[6] if len(sys.argv) > 6 else 'TickData_ZT')
+    print(write_bars(sys.argv[1], dataset.iter_days(start=start, end=end), kind, size), 'bars written to', sys.argv[1])
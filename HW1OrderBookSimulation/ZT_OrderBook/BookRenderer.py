@@ -0,0 +1,200 @@
+'''
+Order book rendering for whole sessions. BookRenderer draws the same picture as Api.plot_order_book, but builds its
+figure once, on a headless Agg canvas, and from one snapshot to the next only moves the step lines, mid line, title
+and label, taken from the depth tensor read once for the session. The axes keep their limits while the book fits
+in them, so the background (axes, ticks, legend) is drawn once per rescale and each frame only blits the moving
+artists over it. Frames are written every stride-th snapshot, at any depth, as PNG files or piped raw to ffmpeg
+for a video; animate() gives a non-blocking FuncAnimation for interactive use.
+Usage: python BookRenderer.py instrument yyyy mm dd output_dir|output.mp4 [stride] [depth] [fps]
+'''
+
+import os
+import subprocess
+import sys
+import time
+
+import matplotlib
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
+
+from Api import Api
+from DateTimeUtils import convert_timestamps_to_dtstrings
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+
+class BookRenderer:
+    def __init__(self, api, timestamp_start=None, timestamp_end=None, depth_max=10, figsize=(8, 5), dpi=100,
+                 figure=None):
+        # the session's depth, balances and labels are read once, in vectorised form
+        #
+        self.api = api
+        self.depth_max = depth_max
+        self.tick_size = Api.get_instrument_ticksize(api.instrument)
+        row_start, row_end = api.get_rows(timestamp_start, timestamp_end)
+        self.timestamps = api.get_column('timestamp')[row_start:row_end]
+        self.prices, self.sizes, self.counts = api.get_order_book_tensor(timestamp_start, timestamp_end, depth_max)
+        self.balances = api.get_order_book_balance_series(timestamp_start, timestamp_end, depth_max)
+        self.weighted_balances = api.get_weighted_order_book_balance_series(timestamp_start, timestamp_end, depth_max)
+        self.dt_strings = convert_timestamps_to_dtstrings(self.timestamps)
+
+        # one figure, headless unless a pyplot figure is given for animate(); the moving artists are animated so
+        # that drawing the figure leaves them out of the background
+        #
+        if figure is None:
+            figure = Figure(figsize=figsize, dpi=dpi)
+            FigureCanvasAgg(figure)
+        self.figure = figure
+        self.canvas = figure.canvas
+        self.ax = self.figure.add_subplot(1, 1, 1)
+        self.ax.set_facecolor((0.0, 0.0, 0.0))
+        self.ax.set_xlabel('price')
+        self.ax.set_ylabel('size')
+        self.bid_line, = self.ax.step([], [], label='bid', color='b', animated=True)
+        self.ask_line, = self.ax.step([], [], label='ask', color='r', animated=True)
+        self.mid_line, = self.ax.plot([], [], linewidth=1, color='w', animated=True)
+        self.ax.legend(fancybox=True, loc='upper left')
+        self.title = self.ax.set_title(' ', animated=True)
+        self.label = self.ax.text(0, 0, '', horizontalalignment='center', fontsize=9, multialignment='center',
+                                  bbox=dict(boxstyle="round", facecolor='#D8D8D8', ec="0.5", pad=0.5, alpha=1.0),
+                                  fontweight='bold', animated=True)
+        self.artists = (self.bid_line, self.ask_line, self.mid_line, self.title, self.label)
+        self.background = None
+        self.stale_background = True
+        self.rescales = 0
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def get_frames(self, stride=1):
+        return range(0, len(self), stride)
+
+    def set_limits(self, price_low, price_high, top):
+        # keep the limits while the book fits with a margin and its largest level uses at least a third of the
+        # height; otherwise widen to twice the book around its middle, which makes the background stale
+        #
+        tick_size = self.tick_size
+        x_low, x_high = self.ax.get_xlim()
+        y_high = self.ax.get_ylim()[1]
+        if (self.rescales and x_low <= price_low - 2 * tick_size and price_high + 2 * tick_size <= x_high
+                and 1.40 * top <= y_high <= 3 * 1.40 * top):
+            return
+        width = price_high - price_low + 4 * tick_size
+        middle = (price_low + price_high) / 2.0
+        self.ax.set_xlim(middle - width, middle + width)
+        self.ax.set_ylim(0, 2 * 1.40 * top if top > 0 else 1)
+        self.stale_background = True
+        self.rescales += 1
+
+    def update(self, i):
+        # move the artists to snapshot i (relative to the session start); returns the artists
+        #
+        tick_size = self.tick_size
+        bid_prices, bid_sizes = self.prices[i, 0, ::-1], self.sizes[i, 0, ::-1]
+        ask_prices, ask_sizes = self.prices[i, 1], self.sizes[i, 1]
+        bid_valid, ask_valid = ~np.isnan(bid_prices), ~np.isnan(ask_prices)
+        bid_prices, bid_sizes = bid_prices[bid_valid], bid_sizes[bid_valid]
+        ask_prices, ask_sizes = ask_prices[ask_valid], ask_sizes[ask_valid]
+        self.title.set_text(f"OrderBook : {self.api.instrument} : {self.dt_strings[i]}")
+
+        # the same step outlines as Api.plot_order_book; an empty side is cleared rather than left at an earlier
+        # snapshot
+        #
+        if len(bid_prices):
+            self.bid_line.set_data(np.concatenate([[bid_prices.min() - tick_size], bid_prices, [bid_prices.max()]]),
+                                   np.concatenate([[0], bid_sizes, [0]]))
+        else:
+            self.bid_line.set_data([], [])
+        if len(ask_prices):
+            self.ask_line.set_data(np.concatenate([[ask_prices.min()], ask_prices + tick_size,
+                                                   [ask_prices.max() + tick_size] * 2]),
+                                   np.concatenate([[0], ask_sizes, [ask_sizes[-1], 0]]))
+        else:
+            self.ask_line.set_data([], [])
+
+        # the mid and its label need both sides
+        #
+        if len(bid_prices) and len(ask_prices):
+            top = max(bid_sizes.max(), ask_sizes.max())
+            mid = (bid_prices.max() + ask_prices.min()) / 2.0
+            self.mid_line.set_data([mid, mid], [0, 1.20 * top])
+            self.label.set_position((mid, 1.20 * top))
+            self.label.set_text(f"Mid={mid}\nBalance={self.balances[i]}\n"
+                                f"Weighted Balance={self.weighted_balances[i]:.6f}")
+            self.set_limits(bid_prices.min(), ask_prices.max(), top)
+        else:
+            self.mid_line.set_data([], [])
+            self.label.set_text('')
+            prices, sizes = (bid_prices, bid_sizes) if len(bid_prices) else (ask_prices, ask_sizes)
+            if len(prices):
+                self.set_limits(prices.min(), prices.max() + tick_size, sizes.max())
+        return self.artists
+
+    def draw(self, i):
+        # snapshot i blitted into the canvas; returns the canvas' RGBA buffer of shape (height, width, 4)
+        #
+        self.update(i)
+        if self.stale_background:
+            self.canvas.draw()
+            self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+            self.stale_background = False
+        self.canvas.restore_region(self.background)
+        for artist in self.artists:
+            self.figure.draw_artist(artist)
+        return np.asarray(self.canvas.buffer_rgba())
+
+    def render_pngs(self, directory, stride=1, compress_level=1):
+        # every stride-th snapshot as directory/frame_<n>.png; returns the number of frames and frames per second
+        #
+        os.makedirs(directory, exist_ok=True)
+        frames = self.get_frames(stride)
+        start = time.perf_counter()
+        for n, i in enumerate(frames):
+            Image.fromarray(self.draw(i)).save(os.path.join(directory, 'frame_{0:06d}.png'.format(n)),
+                                               compress_level=compress_level)
+        elapsed = time.perf_counter() - start
+        return len(frames), len(frames) / elapsed if elapsed > 0 else 0.0
+
+    def render_video(self, filename, stride=1, fps=30):
+        # every stride-th snapshot as a video, raw frames piped to ffmpeg (animation.ffmpeg_path, must be installed)
+        #
+        width, height = self.canvas.get_width_height()
+        command = [matplotlib.rcParams['animation.ffmpeg_path'], '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', '{0}x{1}'.format(width, height), '-r', str(fps),
+                   '-i', '-', '-pix_fmt', 'yuv420p', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', filename]
+        frames = self.get_frames(stride)
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        try:
+            for i in frames:
+                process.stdin.write(self.draw(i).tobytes())
+        finally:
+            process.stdin.close()
+            if process.wait() != 0:
+                raise RuntimeError('ffmpeg failed writing {0}'.format(filename))
+        elapsed = time.perf_counter() - start
+        return len(frames), len(frames) / elapsed if elapsed > 0 else 0.0
+
+    def animate(self, stride=1, interval=50):
+        # non-blocking, blitted animation, for a renderer made with figure=plt.figure() (e.g. in a notebook); keep a
+        # reference to the result
+        #
+        from matplotlib.animation import FuncAnimation
+        return FuncAnimation(self.figure, self.update, frames=self.get_frames(stride), interval=interval, blit=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 6:
+        print(__doc__)
+        sys.exit(1)
+    api = Api()
+    api.load(*sys.argv[1:5])
+    renderer = BookRenderer(api, depth_max=int(sys.argv[7]) if len(sys.argv) > 7 else 10)
+    stride = int(sys.argv[6]) if len(sys.argv) > 6 else 1
+    if sys.argv[5].endswith(VIDEO_EXTENSIONS):
+        frames, fps = renderer.render_video(sys.argv[5], stride, int(sys.argv[8]) if len(sys.argv) > 8 else 30)
+    else:
+        frames, fps = renderer.render_pngs(sys.argv[5], stride)
+    print('{0} frames at {1:.1f} frames/sec'.format(frames, fps))
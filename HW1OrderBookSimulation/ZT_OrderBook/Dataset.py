@@ -0,0 +1,141 @@
+'''
+Multi-day, multi-instrument access to the tick data tree <root>/<instrument>/<yyyy>/<mm>/<dd>/foreground.h5.
+TickDataset finds every day on disk, and loads a date range of one or more instruments with a process pool, either
+as a lazy iterator of per-day frames or as one concatenated frame. Column suffixes (_N) are checked per file and
+removed, so days with different suffixes line up. Days converted by TickStore.py are read from their column store.
+Usage: python Dataset.py [root]   lists the instruments and days found under root (default TickData_ZT)
+'''
+
+import collections
+import concurrent.futures
+import datetime
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from Api import Api
+from TickStore import ColumnStore, get_append_number, get_current_store_directory
+
+
+def to_date(value):
+    if value is None or isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def strip_append_number(column_name):
+    if column_name == 'timestamp':
+        return column_name
+    return column_name[:column_name.rfind('_')]
+
+
+def load_day(filename, columns=None):
+    # one day as a frame with the _N suffix removed from the column names; columns selects (unsuffixed) columns,
+    # and from a column store (used as Api.load uses it, so only when current for the h5 file) only those are read
+    #
+    directory = get_current_store_directory(filename)
+    if directory is not None:
+        store = ColumnStore(directory)
+        names = store.columns
+    else:
+        store = None
+        df = pd.read_hdf(filename, 'main')
+        names = list(df.columns)
+    try:
+        append_number = get_append_number(names)
+    except Exception as e:
+        raise Exception('{0}: {1}'.format(filename, e)) from e
+    if columns is not None:
+        by_name = {strip_append_number(name): name for name in names}
+        missing = [column for column in columns if column not in by_name]
+        if missing:
+            raise KeyError('{0}: no columns {1}'.format(filename, missing))
+        names = [by_name[column] for column in columns]
+    if store is not None:
+        df = pd.DataFrame({name: store[name] for name in names})
+    elif columns is not None:
+        df = df[names]
+    df.columns = [strip_append_number(name) for name in df.columns]
+    df.attrs['append_number'] = append_number
+    return df
+
+
+class TickDataset:
+    def __init__(self, root='TickData_ZT'):
+        self.root = root
+        self.days = self.discover()
+
+    def discover(self):
+        # {instrument: sorted list of dates with a foreground.h5}
+        #
+        days = {}
+        for instrument in sorted(os.listdir(self.root)):
+            if not os.path.isdir(os.path.join(self.root, instrument)):
+                continue
+            found = []
+            for directory, subdirectories, filenames in os.walk(os.path.join(self.root, instrument)):
+                parts = os.path.relpath(directory, os.path.join(self.root, instrument)).split(os.sep)
+                if 'foreground.h5' in filenames and len(parts) == 3 and all(part.isdigit() for part in parts):
+                    found.append(datetime.date(int(parts[0]), int(parts[1]), int(parts[2])))
+            if found:
+                days[instrument] = sorted(found)
+        return days
+
+    def get_instruments(self):
+        return list(self.days.keys())
+
+    def get_days(self, instrument, start=None, end=None):
+        # days of instrument from start to end inclusive, as dates or 'yyyy-mm-dd' strings
+        start, end = to_date(start), to_date(end)
+        return [day for day in self.days.get(instrument, [])
+                if (start is None or day >= start) and (end is None or day <= end)]
+
+    def get_filename(self, instrument, day):
+        return Api.get_filename(instrument, '%04d' % day.year, '%02d' % day.month, '%02d' % day.day, self.root)
+
+    def iter_days(self, instruments=None, start=None, end=None, columns=None, processes=None):
+        # (instrument, date, frame) for every day in the range, in instrument then date order. Days are read by a
+        # pool of processes (os.cpu_count() by default, none if processes is 1), at most two per process ahead of
+        # the consumer
+        #
+        instruments = self.get_instruments() if instruments is None else instruments
+        keys = [(instrument, day) for instrument in instruments for day in self.get_days(instrument, start, end)]
+        if processes == 1 or len(keys) <= 1:
+            for instrument, day in keys:
+                yield instrument, day, load_day(self.get_filename(instrument, day), columns)
+            return
+        processes = processes or os.cpu_count() or 1
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+            window = 2 * processes
+            pending = collections.deque()
+            for instrument, day in keys:
+                pending.append((instrument, day, executor.submit(load_day, self.get_filename(instrument, day), columns)))
+                if len(pending) >= window:
+                    instrument, day, future = pending.popleft()
+                    yield instrument, day, future.result()
+            while pending:
+                instrument, day, future = pending.popleft()
+                yield instrument, day, future.result()
+
+    def load_frame(self, instruments=None, start=None, end=None, columns=None, processes=None):
+        # the days of iter_days in one frame, with a categorical instrument column
+        #
+        frames = []
+        for instrument, day, df in self.iter_days(instruments, start, end, columns, processes):
+            codes = np.full(len(df), self.get_instruments().index(instrument), dtype=np.int8)
+            df.insert(0, 'instrument', pd.Categorical.from_codes(codes, categories=self.get_instruments()))
+            frames.append(df)
+        if not frames:
+            return pd.DataFrame()
+        df = pd.concat(frames, ignore_index=True)
+        df.attrs = {}
+        return df
+
+
+if __name__ == '__main__':
+    dataset = TickDataset(sys.argv[1] if len(sys.argv) > 1 else 'TickData_ZT')
+    for instrument in dataset.get_instruments():
+        days = dataset.get_days(instrument)
+        print(instrument, len(days), 'days from', days[0], 'to', days[-1])
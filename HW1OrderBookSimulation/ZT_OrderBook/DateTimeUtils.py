@@ -1,6 +1,10 @@
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from enum import Enum
 
+import numpy as np
+import pandas as pd
+
 
 class Units(Enum):
     Millisecs = 1
@@ -28,6 +32,63 @@ def convert_timestamp_to_dtstring(timestamp, timestamp_units=Units.Nanosecs):
         return datetime.fromtimestamp(timestamp / 1.0e9)
 
 
+# region Array versions
+# whole int64 arrays of timestamps at once, exact to the nanosecond. Like the scalar functions they work in local time
+# unless local=False, in which case datetimes and strings are UTC.
+
+UNIT_NANOSECONDS = {Units.Millisecs: 1000000, Units.Microsecs: 1000, Units.Nanosecs: 1}
+OFFSET_STEP = 900
+
+
+def get_local_offsets(seconds, wall_clock=False):
+    # local UTC offset in seconds at each of an array of epoch seconds, or of local wall-clock seconds with
+    # wall_clock=True (resolved like datetime.timestamp(): ambiguous times as the first occurrence). Offsets only
+    # change on quarter-hour boundaries, so they are looked up once per quarter hour present
+    #
+    buckets, inverse = np.unique(seconds // OFFSET_STEP, return_inverse=True)
+    offsets = np.empty(len(buckets), dtype=np.int64)
+    epoch = datetime(1970, 1, 1)
+    for i, bucket in enumerate(buckets.tolist()):
+        start = bucket * OFFSET_STEP
+        if wall_clock:
+            offsets[i] = start - int((epoch + timedelta(seconds=start)).timestamp())
+        else:
+            offsets[i] = time.localtime(start).tm_gmtoff
+    return offsets[inverse.reshape(seconds.shape)]
+
+
+def convert_timestamps_to_datetime64(timestamps, timestamp_units=Units.Nanosecs, local=True):
+    nanoseconds = np.asarray(timestamps, dtype=np.int64) * UNIT_NANOSECONDS[timestamp_units]
+    if local:
+        nanoseconds = nanoseconds + get_local_offsets(nanoseconds // 1000000000) * 1000000000
+    return nanoseconds.view('datetime64[ns]')
+
+
+def convert_datetime64_to_timestamps(datetimes, result_units=Units.Nanosecs, local=True):
+    # integer timestamps, floored to whole milli or microseconds for those units
+    nanoseconds = np.asarray(datetimes, dtype='datetime64[ns]').view(np.int64)
+    if local:
+        nanoseconds = nanoseconds - get_local_offsets(nanoseconds // 1000000000, wall_clock=True) * 1000000000
+    return nanoseconds // UNIT_NANOSECONDS[result_units]
+
+
+def convert_timestamps_to_dtstrings(timestamps, dt_format=None, timestamp_units=Units.Nanosecs, local=True):
+    # ISO 8601 strings with nanoseconds by default, else strftime with dt_format (where %f is microseconds)
+    datetimes = convert_timestamps_to_datetime64(timestamps, timestamp_units, local)
+    if dt_format is None:
+        return np.datetime_as_string(datetimes, unit='ns')
+    return np.asarray(pd.DatetimeIndex(datetimes.ravel()).strftime(dt_format)).reshape(datetimes.shape)
+
+
+def convert_dtstrings_to_timestamps(dt_strings, dt_format, result_units=Units.Nanosecs, local=True):
+    # parse with one fixed format; %f takes up to nine digits, so nanoseconds are kept
+    dt_strings = np.asarray(dt_strings)
+    datetimes = pd.to_datetime(dt_strings.ravel(), format=dt_format, exact=True).values
+    return convert_datetime64_to_timestamps(datetimes, result_units, local).reshape(dt_strings.shape)
+
+# endregion
+
+
 def driver():
     dt_as_string = '05.13.2018 18:02:46.787811'
     dt_format = '%m.%d.%Y %H:%M:%S.%f'
@@ -36,6 +97,11 @@ def driver():
     timestamp = 1526248966787810981
     print(convert_timestamp_to_dtstring(timestamp, Units.Nanosecs))
 
+    timestamps = np.array([timestamp, timestamp + 1], dtype=np.int64)
+    dt_strings = convert_timestamps_to_dtstrings(timestamps, '%m.%d.%Y %H:%M:%S.%f')
+    print(dt_strings, convert_timestamps_to_dtstrings(timestamps))
+    print(convert_dtstrings_to_timestamps(convert_timestamps_to_dtstrings(timestamps), '%Y-%m-%dT%H:%M:%S.%f'))
+
 
 if __name__ == '__main__':
     driver()
@@ -0,0 +1,102 @@
+'''
+Process-wide cache of decoded tick days for Api, keyed by (root, instrument, year, month, day) and bounded by a
+memory budget in bytes with least-recently-used eviction. With disk=True a day missing from the memory cache is read
+from its TickStore column store when one converted from the current h5 file exists; otherwise it is decoded from the
+h5 file and converted, so that later loads (in any process) read the store instead of decoding it again.
+The budget and the disk cache can be set with the TICKDATA_CACHE_BYTES and TICKDATA_DISK_CACHE=1 environment
+variables, or with Api.configure_cache(). Every load gets its own frame over read-only views of the cached frame's
+column arrays, so no caller can modify the day that the other callers share.
+'''
+
+import collections
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+class DayCache:
+    def __init__(self, max_bytes=1 << 30, disk=False):
+        self.max_bytes = max_bytes
+        self.disk = disk
+        self.days = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def from_environment():
+        return DayCache(int(os.environ.get('TICKDATA_CACHE_BYTES', 1 << 30)),
+                        os.environ.get('TICKDATA_DISK_CACHE') == '1')
+
+    @staticmethod
+    def share(df):
+        # a new frame, on the same index, over read-only views of the cached frame's numpy columns: renaming,
+        # replacing or adding columns stays private to it, and writing into its columns (through .loc, .iloc or
+        # to_numpy()) raises instead of changing the shared day. Columns of extension dtypes, which tick data does
+        # not have, are shared as they are. A pandas that consolidates the arrays copies them instead
+        #
+        columns = {}
+        for name, column in df.items():
+            if isinstance(column.dtype, np.dtype):
+                values = column.to_numpy().view()
+                values.flags.writeable = False
+                columns[name] = values
+            else:
+                columns[name] = column
+        return pd.DataFrame(columns, index=df.index, copy=False)
+
+    @staticmethod
+    def get_size(df):
+        return int(df.memory_usage(index=True, deep=True).sum())
+
+    def get(self, key):
+        with self.lock:
+            entry = self.days.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.days.move_to_end(key)
+            self.hits += 1
+            return DayCache.share(entry[0])
+
+    def put(self, key, df):
+        # frames are shared by every Api that loads the day, which gets them through share()
+        size = DayCache.get_size(df)
+        with self.lock:
+            if key in self.days:
+                self.bytes -= self.days.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.days[key] = (df, size)
+            self.bytes += size
+            self.evict()
+
+    def evict(self):
+        while self.bytes > self.max_bytes and self.days:
+            key, (df, size) = self.days.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.days.clear()
+            self.bytes = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {'days': len(self.days),
+                    'bytes': self.bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_ratio': self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0}
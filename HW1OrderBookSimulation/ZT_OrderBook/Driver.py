@@ -9,11 +9,11 @@ def main():
     #
     api = Api()
 
-    # load appropriate h5 file corresponding to a instrument and specific day
+    # load the day of an instrument: memory-mapped columns if TickStore.py has converted it, else the h5 file
     #
     instruments = Api.get_instrument_names()
     year, month, day = '2018', '06', '13'
-    api.load_h5(instruments[3], year, month, day)
+    api.load(instruments[3], year, month, day)
 
     # get timestamps
     #
@@ -23,10 +23,9 @@ def main():
         print(timestamps[0], convert_timestamp_to_dtstring(timestamps[0]))
         print(timestamps[-1], convert_timestamp_to_dtstring(timestamps[-1]))
 
-    index = 0
-    for timestamp in timestamps:
-        print(index, timestamp, convert_timestamp_to_dtstring(timestamp))
-        index += 1
+    dt_strings = convert_timestamps_to_dtstrings(timestamps)
+    for index, (timestamp, dt_string) in enumerate(zip(timestamps, dt_strings)):
+        print(index, timestamp, dt_string)
 
     # get order_book
     # get book_balance
@@ -0,0 +1,175 @@
+'''
+Columnar tick store. convert_day turns a day's foreground.h5 into one fixed-dtype .npy file per column plus a small
+meta.json, in a 'columns' directory next to it. ColumnStore opens such a day by memory-mapping the columns on first
+access, so opening is near-instant, only the columns used are read, and processes reading the same day share pages.
+Usage: python TickStore.py [root]   converts every foreground.h5 under root (default TickData_ZT) not yet converted
+'''
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+STORE_DIRECTORY = 'columns'
+META_FILENAME = 'meta.json'
+
+
+def get_store_directory(h5_filename):
+    return os.path.join(os.path.dirname(h5_filename), STORE_DIRECTORY)
+
+
+def get_append_number(columns):
+    # every column but timestamp ends with the same _<number>
+    append_number = None
+    for column_name in columns:
+        if column_name == 'timestamp': continue
+        number = column_name[column_name.rfind('_') + 1:]
+        if append_number is None:
+            append_number = number
+        elif append_number != number:
+            raise Exception("Not all columns have the same end number")
+    return append_number
+
+
+def convert_frame(df, directory, source=None):
+    # write into a temporary directory of this conversion's own and swap it in, so readers never see a half written
+    # day and concurrent conversions of the same day do not write into each other's files
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    temporary = tempfile.mkdtemp(prefix=os.path.basename(directory) + '.tmp', dir=parent)
+    columns = []
+    for i, column_name in enumerate(df.columns):
+        values = df[column_name].to_numpy()
+        if values.dtype == object:
+            values = values.astype(str)
+        filename = '{0:04d}.npy'.format(i)
+        np.save(os.path.join(temporary, filename), np.ascontiguousarray(values))
+        columns.append({'name': column_name, 'file': filename, 'dtype': values.dtype.str})
+    timestamps = df['timestamp'].to_numpy()
+    meta = {'format': FORMAT_VERSION,
+            'rows': len(df),
+            'columns': columns,
+            'append_number': get_append_number(df.columns),
+            'sorted_timestamps': bool((np.diff(timestamps) > 0).all()),
+            'source': source,
+            'source_mtime': os.path.getmtime(source) if source is not None else None}
+    with open(os.path.join(temporary, META_FILENAME), 'w') as f:
+        json.dump(meta, f, indent=1)
+    swap_directory(temporary, directory)
+    return directory
+
+
+def swap_directory(temporary, directory):
+    # move the previous store aside and the new one into place: processes that have the previous store memory-mapped
+    # keep their pages, as its files are unlinked rather than overwritten. If another conversion got its store into
+    # place first, that one (made from the same source) is kept
+    previous = '{0}.old{1}'.format(directory, uuid.uuid4().hex)
+    try:
+        os.rename(directory, previous)
+    except FileNotFoundError:
+        previous = None
+    try:
+        os.rename(temporary, directory)
+    except OSError:
+        shutil.rmtree(temporary, ignore_errors=True)
+    if previous is not None:
+        shutil.rmtree(previous, ignore_errors=True)
+
+
+def is_converted(h5_filename):
+    meta_filename = os.path.join(get_store_directory(h5_filename), META_FILENAME)
+    if not os.path.exists(meta_filename):
+        return False
+    with open(meta_filename) as f:
+        meta = json.load(f)
+    return meta['format'] == FORMAT_VERSION and meta['source_mtime'] == os.path.getmtime(h5_filename)
+
+
+def convert_day(h5_filename, force=False):
+    if force or not is_converted(h5_filename):
+        convert_frame(pd.read_hdf(h5_filename, 'main'), get_store_directory(h5_filename), h5_filename)
+    return get_store_directory(h5_filename)
+
+
+def get_current_store_directory(h5_filename):
+    # the store to read the day from, None if the h5 file must be read: a store converted from the current h5 file,
+    # or one left stale by a newer h5 file once converted again, or one whose h5 file is gone
+    #
+    directory = get_store_directory(h5_filename)
+    if os.path.exists(h5_filename):
+        if is_converted(h5_filename):
+            return directory
+        if ColumnStore.exists(directory):
+            return convert_day(h5_filename, force=True)
+        return None
+    return directory if ColumnStore.exists(directory) else None
+
+
+def convert_all(root='TickData_ZT', force=False):
+    converted = []
+    for directory, subdirectories, filenames in sorted(os.walk(root)):
+        if 'foreground.h5' in filenames:
+            h5_filename = os.path.join(directory, 'foreground.h5')
+            if force or not is_converted(h5_filename):
+                convert_day(h5_filename, force=True)
+                converted.append(h5_filename)
+    return converted
+
+
+class ColumnStore:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, META_FILENAME)) as f:
+            self.meta = json.load(f)
+        if self.meta['format'] != FORMAT_VERSION:
+            raise ValueError('Unsupported tick store format {0} in {1}'.format(self.meta['format'], directory))
+        self.files = {column['name']: column['file'] for column in self.meta['columns']}
+        self.columns = [column['name'] for column in self.meta['columns']]
+        self.append_number = self.meta['append_number']
+        self.arrays = {}
+        self.rows = None
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, META_FILENAME))
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def __contains__(self, column_name):
+        return column_name in self.files
+
+    def __getitem__(self, column_name):
+        # read-only memory map of the column, opened on first access
+        array = self.arrays.get(column_name)
+        if array is None:
+            array = np.load(os.path.join(self.directory, self.files[column_name]), mmap_mode='r')
+            self.arrays[column_name] = array
+        return array
+
+    def row(self, timestamp):
+        timestamps = self['timestamp']
+        if self.meta['sorted_timestamps']:
+            i = int(np.searchsorted(timestamps, timestamp))
+            if i < len(timestamps) and timestamps[i] == timestamp:
+                return i
+            raise KeyError(timestamp)
+        if self.rows is None:
+            self.rows = {t: i for i, t in enumerate(timestamps.tolist())}
+        return self.rows[timestamp]
+
+    def to_frame(self, columns=None):
+        columns = self.columns if columns is None else columns
+        df = pd.DataFrame({column_name: self[column_name] for column_name in columns})
+        return df.set_index('timestamp', drop=False) if 'timestamp' in df else df
+
+
+if __name__ == '__main__':
+    for filename in convert_all(sys.argv[1] if len(sys.argv) > 1 else 'TickData_ZT'):
+        print('converted', filename)
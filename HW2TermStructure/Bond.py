@@ -1,5 +1,7 @@
 import math
 
+import numpy as np
+
 
 class Bond(object):
 
@@ -44,6 +46,84 @@ class Bond(object):
         price += face_value / math.pow(1.0 + ytm, number_of_coupon_payments)
         return price
 
+    @staticmethod
+    def compute_prices(face_value, coupon, ytm, number_of_coupon_payments):
+        # compute_price for arrays of bonds (per-period coupon rates and yields), with the closed-form annuity
+        # (1 - (1 + ytm)^-n) / ytm in place of the sum over coupons
+        face_value, coupon, ytm, n = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in
+                                                            (face_value, coupon, ytm, number_of_coupon_payments)])
+        log_discount = -n * np.log1p(ytm)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            annuity = np.where(ytm == 0.0, n, -np.expm1(log_discount) / ytm)
+        return face_value * (coupon * annuity + np.exp(log_discount))
+
+    @staticmethod
+    def compute_price_derivatives(face_value, coupon, ytm, number_of_coupon_payments):
+        # price and its first and second derivatives in the per-period yield, for arrays of bonds. Near a zero yield,
+        # where the closed forms cancel, the derivatives are their limits at zero (the price stays exact)
+        face_value, coupon, ytm, n = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in
+                                                            (face_value, coupon, ytm, number_of_coupon_payments)])
+        log_discount = -n * np.log1p(ytm)
+        discount = np.exp(log_discount)
+        discount_1 = -n * discount / (1.0 + ytm)
+        discount_2 = n * (n + 1.0) * discount / (1.0 + ytm) ** 2
+        small = np.abs(ytm) < 1e-4
+        with np.errstate(divide='ignore', invalid='ignore'):
+            annuity = np.where(ytm == 0.0, n, -np.expm1(log_discount) / ytm)
+            annuity_1 = np.where(small, -n * (n + 1.0) / 2.0, (-discount_1 - annuity) / ytm)
+            annuity_2 = np.where(small, n * (n + 1.0) * (n + 2.0) / 3.0, (-discount_2 - 2.0 * annuity_1) / ytm)
+        return (face_value * (coupon * annuity + discount),
+                face_value * (coupon * annuity_1 + discount_1),
+                face_value * (coupon * annuity_2 + discount_2))
+
+    @staticmethod
+    def compute_ytms(face_value, coupon, compounding_frequency_per_annum, number_of_coupon_payments, price,
+                     tolerance=1e-14, max_iterations=100):
+        # compute_ytm for arrays of bonds, all solved at once: coupons and yields in percent per annum, prices in
+        # percent of face value. Halley steps on the bonds not yet converged, kept inside a bracket that starts as
+        # compute_ytm's 0% to 100% and falls back to bisection when a step leaves it; -1.0 where there is no root
+        # (an end of the bracket within compute_ytm's price tolerance of the price counts as one)
+        face_value, coupon, frequency, n, price = np.broadcast_arrays(*[
+            np.asarray(x, dtype=np.float64) for x in (face_value, coupon, compounding_frequency_per_annum,
+                                                      number_of_coupon_payments, price)])
+        coupon = coupon / 100.0 / frequency
+        target = price / 100.0 * face_value
+        low = np.zeros(coupon.shape)
+        high = 100.0 / 100.0 / frequency
+        valid = (Bond.compute_prices(face_value, coupon, low, n) - target >= -0.0001) & \
+                (Bond.compute_prices(face_value, coupon, high, n) - target <= 0.0001)
+
+        # start from the yield of a bullet bond paying the discount evenly over its life
+        ytm = np.clip((coupon * face_value + (face_value - target) / np.maximum(n, 1.0)) / target, low, high)
+        active = np.flatnonzero(valid)
+        low, high = low[active], high[active]
+        for _ in range(max_iterations):
+            if len(active) == 0:
+                break
+            y = ytm[active]
+            p, p_1, p_2 = Bond.compute_price_derivatives(face_value[active], coupon[active], y, n[active])
+            f = p - target[active]
+            # the price falls as the yield rises
+            low = np.where(f > 0.0, y, low)
+            high = np.where(f < 0.0, y, high)
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                step = -2.0 * f * p_1 / (2.0 * p_1 * p_1 - f * p_2)
+            y_next = y + step
+            outside = ~np.isfinite(y_next) | (y_next <= low) | (y_next >= high)
+            y_next = np.where(outside, (low + high) / 2.0, y_next)
+            done = (f == 0.0) | (np.abs(y_next - y) <= tolerance * (1.0 + np.abs(y))) | (high - low <= tolerance)
+            ytm[active] = np.where(f == 0.0, y, y_next)
+            active, low, high = active[~done], low[~done], high[~done]
+        return np.where(valid, ytm * 100.0 * frequency, -1.0)
+
+    @staticmethod
+    def compute_bond_ytms(bonds):
+        # compute_ytms of Bond objects, in the same order
+        return Bond.compute_ytms([bond._face_value for bond in bonds], [bond._coupon for bond in bonds],
+                                 [bond._compounding_frequency_per_annum for bond in bonds],
+                                 [bond._number_of_coupon_payments for bond in bonds],
+                                 [bond._price for bond in bonds])
+
     def compute_ytm(self):
         ytm, tolerance = 0.0, 0.0001
         a, b, c = 0.0, 100.0, 0.0